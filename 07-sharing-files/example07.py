@@ -1,297 +1,226 @@
 import argparse
-import grp
 import mmap
 import os
-from pathlib import Path
-import pwd
 import signal
-from socket import sethostname
-import subprocess
 import sys
 
 from lib import libc
-
-
-def read_subuids(uid: int) -> range:
-    name = pwd.getpwuid(uid)[0]
-    return read_ids(uid, name, '/etc/subuid')
-
-
-def read_subgids(gid: int) -> range:
-    name = grp.getgrgid(gid)[0]
-    return read_ids(gid, name, '/etc/subgid')
-
-
-def read_ids(id_: int, name: str, filename: str) -> range:
-    # subuid/subgid can use names or numbers, so we check for both.
-    names = [str(id_), name]
-    with open(filename, 'r') as f:
-        for line in f:
-            entry, start, count = line.split(':')
-            if entry in names:
-                return range(int(start), int(start) + int(count))
-
-    raise Exception(f'User {name} not found in {filename}')
-
-
-def make_id_maps(
-        subids: range,
-        cont_id: int | None,
-        host_id: int) -> list[str]:
-    '''
-    Return a set of mappings formatted for use with newuidmap/newgidmap. subids
-    is a set of host ids (uids or gids) for the namespace ids to be mapped to.
-    Inside the namespace these will be mapped to 0.. until all have been used.
-    If cont_id is provided, it is skipped in this step.
-
-    cont_id and host_id define an extra mapping for one host id to one
-    container id, generally used for mapping the user's own uid and primary
-    gid. If cont_id is None no additional mapping is added.
-    '''
-    # Use an arbitrary large upper value for container ids, we'll just go until
-    # host ids are exhausted.
-    container_ids = range(10_000_000)
-    container_ranges: list[range] = []
-    host_ranges: list[range] = []
-    if cont_id is None:
-        container_ranges.append(container_ids)
-        host_ranges.append(subids)
-    else:
-        container_ranges.append(range(cont_id, cont_id + 1))
-        host_ranges.append(range(host_id, host_id + 1))
-
-        # Make sure to exclude cont_id from container_ranges.
-        c1 = range(container_ids.start, cont_id)
-        c2 = range(cont_id + 1, container_ids.stop)
-
-        # c1 and c2 can be 0-length ranges in some cases, such as cont_id == 0.
-        if c1:
-            container_ranges.append(c1)
-
-        if c2:
-            container_ranges.append(c2)
-
-        host_ranges.append(subids)
-
-    result: list[int] = []
-
-    while host_ranges:
-        # Take the first range from each, produce a mapping using as many
-        # elements of both as possible, reinsert any remainder and repeat until
-        # host_ranges is exhausted.
-        crange = container_ranges.pop(0)
-        hrange = host_ranges.pop(0)
-
-        length = min(len(crange), len(hrange))
-        result.extend([crange.start, hrange.start, length])
-
-        # Update crange and hrange
-        crange = range(crange.start + length, crange.stop)
-        hrange = range(hrange.start + length, hrange.stop)
-
-        if crange:
-            container_ranges.insert(0, crange)
-
-        if hrange:
-            host_ranges.insert(0, hrange)
-
-    return [str(x) for x in result]
-
-
-def get_user_uid(user: str) -> int:
-    if user.isdigit():
-        return int(user)
-
-    return pwd.getpwnam(user).pw_uid
-
-
-def mount(source: str, target: str, filesystemtype: str,
-          mountflags: int) -> None:
-    '''
-    Like mount(2), with the added step of remounting read-only for bind mounts
-    with the MS_RDONLY flag, similar to what mount(8) does. mount(2) ignores
-    most other flags (MS_RDONLY included) when MS_BIND is present.
-    '''
-
-    libc.mount(source, target, filesystemtype, mountflags)
-
-    ro_bind = libc.MS_BIND | libc.MS_RDONLY
-    if mountflags & ro_bind == ro_bind:
-        libc.mount('', target, '',
-                   libc.MS_REMOUNT | libc.MS_BIND | libc.MS_RDONLY)
-
-
-def parse_volumes(volumes: list[str] | None) -> list[tuple[str, str, int]]:
-    if volumes is None:
-        return []
-
-    result: list[tuple[str, str, int]] = []
-    for volume_arg in volumes:
-        parts = volume_arg.split(':')
-
-        match parts:
-            case [host_part, cont_part] | [host_part, cont_part, 'ro']:
-                result.append((host_part, cont_part, libc.MS_RDONLY))
-            case [host_part, cont_part, 'rw']:
-                result.append((host_part, cont_part, 0))
-            case _:
-                raise Exception(
-                        f'Failed parsing --volume argument value {volume_arg}')
-
-    return result
+from lib.cgroup import Cgroup
+from lib.container import (
+        add_arguments,
+        config_from_args,
+        idmap_volume_trees,
+        make_id_maps,
+        namespace_flags,
+        open_volume_trees,
+        plan_mounts,
+        read_subgids,
+        read_subuids,
+        setup_child,
+)
+from lib.idmap import apply_id_maps
+from lib.init import run_init
+from lib.net import make_backend
+from lib.overlay import make_upper_dir, remove_upper_dir
+from lib.registry import Registry, default_registry_path
+from lib.slices import default_allocator
+from lib.telemetry import Sampler, print_summary, summarize
+from lib.trace import LaunchTrace, append_record
 
 
 def main() -> int:
     parser = argparse.ArgumentParser(
             description='Run a command in a new namespace')
+    add_arguments(parser)
     parser.add_argument(
-            '--hostname',
-            help='set hostname in the new namespace')
+            '--trace',
+            metavar='FILE',
+            help='append the timing of each launch phase to FILE as a line '
+                 'of JSON, see lib/trace.py')
     parser.add_argument(
-            '--map-uid', '-m',
-            type=int,
-            default=1100,
-            help="uid inside the container to which the current user's uid "
-                 "should be mapped")
+            '--telemetry',
+            metavar='FILE',
+            help="sample the container's resource use while it runs, write "
+                 'the samples to FILE as lines of JSON and print a summary '
+                 'at the end, see lib/telemetry.py')
     parser.add_argument(
-            '--map-gid', '-g',
-            type=int,
-            default=1100,
-            help="gid inside the container to which the current user's gid "
-                 "should be mapped")
+            '--sample-interval',
+            type=float,
+            default=1.0,
+            metavar='SECONDS',
+            help='time between --telemetry samples (default: %(default)s)')
     parser.add_argument(
-            '--root', '-r',
-            help='chroot to the given root file system')
-    parser.add_argument(
-            '--user', '-u',
-            help='set user ID (by name or UID) inside the namespace')
-    parser.add_argument(
-            '--volume', '-v',
-            action='append',
-            metavar='HOST_VOL:CONT_VOL[:MODE]',
-            help='mount HOST_VOL from the host as CONT_VOL in the container '
-                 'using MODE (ro or rw)')
+            '--registry',
+            nargs='?',
+            const=default_registry_path(),
+            metavar='FILE',
+            help='record the container in a registry database while it runs, '
+                 'see lib/registry.py (default FILE: %(const)s)')
     parser.add_argument(
             'cmd',
             nargs='+',
             help='command (and arguments) to run')
 
     args = parser.parse_args(sys.argv[1:])
-    if args.volume and not args.root:
-        parser.error('--volume can only be used with --root')
-    volumes = parse_volumes(args.volume)
+    config = config_from_args(parser, args)
 
     uid = os.geteuid()
     gid = os.getegid()
 
-    uid_maps = make_id_maps(read_subuids(uid), args.map_uid, uid)
-    gid_maps = make_id_maps(read_subgids(gid), args.map_gid, gid)
-
-    # Make a shared memory semaphore
+    # With --id-slice the maps come from the slice leased to the child.
+    uid_maps: list[str] = []
+    gid_maps: list[str] = []
+    if not config.id_slice:
+        uid_maps = make_id_maps(read_subuids(uid), config.map_uid, uid)
+        gid_maps = make_id_maps(read_subgids(gid), config.map_gid, gid)
+    mounts = plan_mounts(config)
+    # Idmapped volumes are cloned here for the child to inherit.
+    trees = open_volume_trees(config)
+
+    upper_dir = None
+    if config.overlay:
+        upper_dir = make_upper_dir(config.overlay)
+
+    # Make a shared memory semaphore, with room for the child's timestamps
+    # after it.
     sem = mmap.mmap(
             -1,
-            libc.SIZEOF_SEM_T,
+            libc.SIZEOF_SEM_T + LaunchTrace.SIZE,
             mmap.MAP_SHARED | mmap.MAP_ANONYMOUS)
 
     libc.sem_init(sem, True, 0)
 
+    trace = None
+    if args.trace:
+        trace = LaunchTrace(sem, libc.SIZEOF_SEM_T)
+
     def child() -> int:
         # Wait for parent to set up uidmap and gidmap.
         libc.sem_wait(sem)
 
-        # Set the hostname
-        if args.hostname is not None:
-            sethostname(args.hostname)
+        env = setup_child(config, mounts, upper_dir, trees, trace)
 
-        proc_flags = (libc.MS_NOSUID | libc.MS_NODEV | libc.MS_RELATIME |
-                      libc.MS_NOEXEC)
-
-        mounts = [
-                # (source, target, type, flags)
-                ('proc', 'proc', 'proc', proc_flags),
-        ]
-
-        chroot_mounts = [
-                # (source, target, type, flags)
-                ('/dev/null', 'dev/null', '', libc.MS_BIND),
-                ('/dev/full', 'dev/full', '', libc.MS_BIND),
-                ('/dev/ptmx', 'dev/ptmx', '', libc.MS_BIND),
-                ('/dev/random', 'dev/random', '', libc.MS_BIND),
-                ('/dev/urandom', 'dev/urandom', '', libc.MS_BIND),
-                ('/dev/zero', 'dev/zero', '', libc.MS_BIND),
-                ('/dev/tty', 'dev/tty', '', libc.MS_BIND),
-                # Sysfs can't be mounted in a user namespace unless it's also
-                # in a network namespace. Apparently this has something to do
-                # with accessing network devices via /sys/class/net.
-                # For some reason bind mount /sys requires recursive.
-                ('/sys', 'sys', '', libc.MS_BIND | libc.MS_REC),
-                ('/etc/resolv.conf', 'etc/resolv.conf', '', libc.MS_BIND),
-        ]
-
-        if args.root:
-            mount_root = args.root
-            mounts += chroot_mounts
-        else:
-            mount_root = '/'
-
-        for host_dir, cont_dir, fstype, flags in mounts:
-            full_target = str(Path(mount_root) / cont_dir)
-            mount(host_dir, full_target, fstype, flags)
+        if trace:
+            trace.mark('exec_start')
+        if config.init:
+            run_init(args.cmd, env, trace)
+        os.execvpe(args.cmd[0], args.cmd, env)
 
-        # Mount --volumes
-        for host_dir, cont_dir, flags in volumes:
-            full_target = str(Path(mount_root) / cont_dir.lstrip('/'))
-            mount(host_dir, full_target, '', libc.MS_BIND | flags)
+    cgroup = None
+    if config.cgroup:
+        cgroup = Cgroup.create(config.cgroup)
+
+    net = make_backend(config.net)
+    flags = namespace_flags(config)
+    registry = Registry(args.registry) if args.registry else None
+
+    if trace:
+        trace.mark('start')
+    if cgroup:
+        # Only clone3 can start the child directly in its cgroup, so it's
+        # never outside of its limits.
+        cgroup_fd = cgroup.open_fd()
+        child_pid, pidfd = libc.clone3(child, flags, cgroup_fd)
+        os.close(pidfd)
+        os.close(cgroup_fd)
+    else:
+        child_pid = libc.clone(child, 100_000, signal.SIGCHLD | flags)
+    if trace:
+        trace.cloned()
+
+    container_id = None
+    id_slice = None
+    try:
+        if config.id_slice:
+            # Leased to the child, so that the slice is freed if it exits
+            # without this process releasing it.
+            id_slice = default_allocator().lease(child_pid)
+            uid_maps, gid_maps = id_slice.id_maps(config.map_uid,
+                                                  config.map_gid)
+        if registry:
+            container_id = registry.add(
+                    child_pid, flags, args.cmd, root=config.root,
+                    cgroup=cgroup.path if cgroup else None,
+                    upper_dir=upper_dir,
+                    keep_upper=bool(config.overlay and config.overlay.keep),
+                    uid_maps=uid_maps, gid_maps=gid_maps)
+        id_map_result = apply_id_maps(child_pid, uid_maps, gid_maps)
+        if trace:
+            trace.mark('id_maps')
+        # idmap_volume_trees closes the fds whatever happens.
+        opened, trees = trees, []
+        idmap_volume_trees(opened, child_pid)
+        if trace:
+            trace.mark('volumes')
+        net.start(child_pid)
+        if trace:
+            trace.mark('net')
+    except BaseException:
+        # Don't leave the child waiting forever, and undo everything set up
+        # for it. It never got to its upper dir, so that's still empty.
+        os.kill(child_pid, signal.SIGKILL)
+        (_, status) = os.waitpid(child_pid, 0)
+        for fd, _, _ in trees:
+            os.close(fd)
+        net.stop()
+        if cgroup:
+            cgroup.remove()
+        if upper_dir is not None:
+            os.rmdir(upper_dir)
+        if id_slice:
+            default_allocator().release(id_slice)
+        if registry:
+            if container_id:
+                registry.exited(container_id,
+                                os.waitstatus_to_exitcode(status))
+                registry.remove(container_id)
+            registry.close()
+        raise
+
+    # Marked first, since the child can wake before sem_post returns.
+    if trace:
+        trace.mark('released')
 
-        if args.root:
-            os.chroot(args.root)
-            # chroot doesn't actually change the current directory:
-            os.chdir(args.root)
+    # Signal child that its environment is ready
+    libc.sem_post(sem)
 
-        env: dict[str, str] = {}
+    if trace:
+        trace.wait_exec()
+        append_record(args.trace,
+                      trace.record(id_map_method=id_map_result.method,
+                                   init=config.init))
+
+    if args.telemetry:
+        sampler = Sampler(child_pid, cgroup)
+        pidfd = os.pidfd_open(child_pid)
+        with open(args.telemetry, 'w') as f:
+            sampler.run(pidfd, args.sample_interval, f)
+        os.close(pidfd)
+        sampler.close()
+        print_summary(summarize(sampler.samples))
 
-        if 'TERM' in os.environ:
-            env['TERM'] = os.environ['TERM']
+    (_, status) = os.waitpid(child_pid, 0)
+    exitcode = os.waitstatus_to_exitcode(status)
+    if registry and container_id:
+        registry.exited(container_id, exitcode)
+    net.stop()
 
-        # Clear supplementary groups
-        os.setgroups([])
+    if cgroup:
+        cgroup.remove()
 
-        if args.user:
-            uid = get_user_uid(args.user)
+    if config.overlay and upper_dir is not None:
+        if config.overlay.keep:
+            print(f'overlay changes kept in {upper_dir}', file=sys.stderr)
         else:
-            uid = os.geteuid()
-
-        try:
-            user_info = pwd.getpwuid(uid)
-            env['HOME'] = user_info.pw_dir
-            os.setgid(user_info.pw_gid)
-            os.initgroups(user_info.pw_name, user_info.pw_gid)
-            # Change to the user's home dir, but only if we're in a chroot.
-            # Without a chroot this is likely to fail due to permissions.
-            if args.root:
-                os.chdir(user_info.pw_dir)
-        except KeyError:
-            # Don't require the uid to be found in passwd.
-            pass
-
-        os.setuid(uid)
-
-        os.execvpe(args.cmd[0], args.cmd, env)
-
-    child_pid = libc.clone(
-            child,
-            100_000,
-            signal.SIGCHLD | libc.CLONE_NEWUSER | libc.CLONE_NEWPID |
-            libc.CLONE_NEWUTS | libc.CLONE_NEWNS)
+            remove_upper_dir(upper_dir, uid_maps, gid_maps)
 
-    subprocess.run(['newuidmap', str(child_pid)] + uid_maps, check=True)
-    subprocess.run(['newgidmap', str(child_pid)] + gid_maps, check=True)
+    if id_slice:
+        default_allocator().release(id_slice)
 
-    # Signal child that its environment is ready
-    libc.sem_post(sem)
-
-    (_, status) = os.waitpid(child_pid, 0)
-    exitcode = os.waitstatus_to_exitcode(status)
+    if registry:
+        if container_id:
+            registry.remove(container_id)
+        registry.close()
 
     if exitcode < 0:
         print(f'child process exited with signal {-exitcode}', file=sys.stderr)
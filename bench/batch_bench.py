@@ -0,0 +1,58 @@
+import argparse
+import asyncio
+import sys
+import time
+
+from lib.aio import Container
+from lib.batch import DEFAULT_PARALLEL, launch_many, plan_from_config
+from lib.container import Config
+from lib.spec import LaunchPlan
+
+
+async def one_by_one(config: Config, count: int) -> float:
+    # Independent Containers started together, each reading the subid files,
+    # planning its mounts and making its own semaphore, as before batches.
+    start = time.perf_counter()
+    containers = [Container(config, ['true']) for _ in range(count)]
+    await asyncio.gather(*(container.start() for container in containers))
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*(container.wait() for container in containers))
+    return elapsed
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+            description='Compare launching a batch of containers with '
+                        'launch_many against starting independent ones')
+    parser.add_argument(
+            '--root',
+            default='alpine/alpine-root',
+            help='root file system for the launches (default: %(default)s)')
+    parser.add_argument(
+            '--count', '-n',
+            type=int,
+            default=500,
+            help='containers in the batch (default: %(default)s)')
+    args = parser.parse_args(sys.argv[1:])
+
+    config = Config(root=args.root)
+    elapsed = asyncio.run(one_by_one(config, args.count))
+    print(f'{"independent Containers":<32} {elapsed * 1e3:8.1f} ms  '
+          f'{args.count / elapsed:6.0f} launches/s')
+
+    shared = plan_from_config(config, ['true'])
+    plans = [LaunchPlan(shared.config, shared.argv, shared.env,
+                        shared.uid_maps, shared.gid_maps, shared.mounts, '')
+             for _ in range(args.count)]
+    for parallel in sorted({8, DEFAULT_PARALLEL, 128}):
+        result = asyncio.run(launch_many(plans, parallel=parallel))
+        print(f'{f"launch_many, parallel {parallel}":<32} '
+              f'{result.release_time * 1e3:8.1f} ms  '
+              f'{result.launches_per_second():6.0f} launches/s  '
+              f'(cloning {result.clone_time * 1e3:.1f} ms)')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
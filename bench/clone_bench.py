@@ -0,0 +1,67 @@
+from ctypes import byref, create_string_buffer
+import os
+import resource
+import signal
+import sys
+import time
+from typing import Any, Callable
+
+from lib import libc
+from lib.common import get_os_error
+
+
+def legacy_clone(fn: Callable[[], int], size: int, flags: int) -> int:
+    '''
+    libc.clone as it was before StackPool, kept for comparison: a new zeroed
+    stack buffer and a new ctypes callback on every call.
+    '''
+    def fn_wrapper(_: None) -> int:
+        return fn()
+
+    stack: Any = byref(create_string_buffer(size), size)
+    res = libc._libc.clone(libc._child_func_type(fn_wrapper), stack, flags,
+                           None)
+    if res < 0:
+        raise get_os_error()
+
+    return int(res)
+
+
+def run(name: str, clone: Callable[[Callable[[], int], int, int], int],
+        count: int, size: int) -> None:
+    flags = signal.SIGCHLD
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    elapsed = 0.0
+    for _ in range(count):
+        start = time.perf_counter()
+        pid = clone(lambda: 0, size, flags)
+        elapsed += time.perf_counter() - start
+        os.waitpid(pid, 0)
+
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    parent_faults = self_after.ru_minflt - self_before.ru_minflt
+    child_faults = children_after.ru_minflt - children_before.ru_minflt
+
+    print(f'{name:<8} {elapsed / count * 1e6:8.1f} us per clone  '
+          f'{parent_faults / count:6.1f} parent faults  '
+          f'{child_faults / count:6.1f} child faults')
+
+
+def main() -> int:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    # The size the examples use, and a bigger one where the zero filling of
+    # the old stacks stands out.
+    for size in (100_000, 1_000_000):
+        print(f'stack size {size}:')
+        for _ in range(2):
+            run('legacy', legacy_clone, count, size)
+            run('pooled', libc.clone, count, size)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
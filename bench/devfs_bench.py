@@ -0,0 +1,101 @@
+import json
+import os
+import sys
+import tempfile
+import time
+
+from lib import libc
+from lib.container import CLONE_FLAGS, make_id_maps, read_subgids, read_subuids
+from lib.devfs import DEFAULT_DEV, setup_dev
+from lib.idmap import apply_id_maps
+
+# The device nodes that used to be bind mounted one by one onto placeholder
+# files in the root file system.
+PER_FILE_DEVICES = ['null', 'full', 'ptmx', 'random', 'urandom', 'zero', 'tty']
+
+
+def per_file(dev: bytes) -> None:
+    # As the mounts were done before devfs: one mount(2) call per device.
+    for name in PER_FILE_DEVICES:
+        libc.mount(b'/dev/' + name.encode(), os.path.join(dev, name.encode()),
+                   b'', libc.MS_BIND)
+
+
+def make_dirs(base: str, count: int, placeholders: bool) -> list[bytes]:
+    dirs: list[bytes] = []
+    for i in range(count):
+        dev = os.path.join(base, f'dev{i}')
+        os.makedirs(dev)
+        if placeholders:
+            for name in PER_FILE_DEVICES:
+                open(os.path.join(dev, name), 'w').close()
+        dirs.append(os.fsencode(dev))
+
+    return dirs
+
+
+def run(count: int) -> dict[str, float]:
+    # This runs on a private tmpfs that goes away with the mount namespace, so
+    # there's no need to clean up.
+    base = tempfile.mkdtemp()
+    results: dict[str, float] = {}
+
+    # Placeholder files are part of the root file system in the per-file
+    # approach, so creating them isn't timed.
+    dirs = make_dirs(os.path.join(base, 'per-file'), count, True)
+    start = time.perf_counter()
+    for dev in dirs:
+        per_file(dev)
+    results['per_file_us'] = (time.perf_counter() - start) / count * 1e6
+
+    dirs = make_dirs(os.path.join(base, 'tmpfs'), count, False)
+    start = time.perf_counter()
+    for dev in dirs:
+        setup_dev(dev, DEFAULT_DEV)
+    results['tmpfs_us'] = (time.perf_counter() - start) / count * 1e6
+
+    return results
+
+
+def main() -> int:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    uid = os.geteuid()
+    gid = os.getegid()
+    uid_maps = make_id_maps(read_subuids(uid), 0, uid)
+    gid_maps = make_id_maps(read_subgids(gid), 0, gid)
+
+    read_fd, write_fd = os.pipe()
+    sems = libc.SemArray(1)
+
+    def child() -> int:
+        libc.sem_wait(sems[0])
+        # Keep the mounts out of the host's /tmp.
+        libc.mount(b'tmpfs', b'/tmp', b'tmpfs', 0)
+        with os.fdopen(write_fd, 'w') as f:
+            json.dump(run(count), f)
+        return 0
+
+    child_pid = libc.clone(child, 100_000, CLONE_FLAGS)
+    os.close(write_fd)
+    apply_id_maps(child_pid, uid_maps, gid_maps)
+    libc.sem_post(sems[0])
+
+    with os.fdopen(read_fd) as f:
+        output = f.read()
+    os.waitpid(child_pid, 0)
+
+    results = json.loads(output)
+    per_file_us = results['per_file_us']
+    tmpfs_us = results['tmpfs_us']
+    print(f'per-file binds ({len(PER_FILE_DEVICES)} devices): '
+          f'{per_file_us:8.1f} us')
+    print(f'tmpfs /dev ({len(DEFAULT_DEV.devices)} devices, '
+          f'{len(DEFAULT_DEV.mounts)} mounts, '
+          f'{len(DEFAULT_DEV.symlinks)} symlinks): {tmpfs_us:8.1f} us')
+    print(f'difference: {tmpfs_us - per_file_us:+8.1f} us per container')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+import random
+import sys
+import timeit
+
+from lib.idmap import MAX_ID_MAP_LINES, build_id_map
+
+
+def legacy_make_id_maps(
+        subids: range,
+        cont_id: int | None,
+        host_id: int) -> list[str]:
+    '''
+    make_id_maps as it was before build_id_map, kept for comparison. It only
+    accepts a single range of subordinate ids.
+    '''
+    container_ids = range(10_000_000)
+    container_ranges: list[range] = []
+    host_ranges: list[range] = []
+    if cont_id is None:
+        container_ranges.append(container_ids)
+        host_ranges.append(subids)
+    else:
+        container_ranges.append(range(cont_id, cont_id + 1))
+        host_ranges.append(range(host_id, host_id + 1))
+
+        c1 = range(container_ids.start, cont_id)
+        c2 = range(cont_id + 1, container_ids.stop)
+
+        if c1:
+            container_ranges.append(c1)
+
+        if c2:
+            container_ranges.append(c2)
+
+        host_ranges.append(subids)
+
+    result: list[int] = []
+
+    while host_ranges:
+        crange = container_ranges.pop(0)
+        hrange = host_ranges.pop(0)
+
+        length = min(len(crange), len(hrange))
+        result.extend([crange.start, hrange.start, length])
+
+        crange = range(crange.start + length, crange.stop)
+        hrange = range(hrange.start + length, hrange.stop)
+
+        if crange:
+            container_ranges.insert(0, crange)
+
+        if hrange:
+            host_ranges.insert(0, hrange)
+
+    return [str(x) for x in result]
+
+
+def fragmented_ranges(count: int, size: int, seed: int) -> list[range]:
+    '''
+    Return count ranges of size ids with random gaps between them, shuffled
+    and with some duplicated, like a messy subuid file.
+    '''
+    rng = random.Random(seed)
+    ranges: list[range] = []
+    start = 100_000
+    for _ in range(count):
+        start += rng.randrange(1, 4) * size
+        ranges.append(range(start, start + size))
+
+    ranges += rng.sample(ranges, count // 10)
+    rng.shuffle(ranges)
+    return ranges
+
+
+def report(name: str, seconds: float, lines: int) -> None:
+    print(f'{name:<40} {seconds * 1e6:10.1f} us  {lines:4d} lines')
+
+
+def main() -> int:
+    number = 200
+
+    single = range(100_000, 100_000 + 65536)
+    t = timeit.timeit(
+            lambda: legacy_make_id_maps(single, 1100, 1000),
+            number=number) / number
+    lines = len(legacy_make_id_maps(single, 1100, 1000)) // 3
+    report('legacy, one range', t, lines)
+
+    t = timeit.timeit(
+            lambda: build_id_map([single], {1100: 1000}),
+            number=number) / number
+    report('build_id_map, one range', t, len(build_id_map([single],
+                                                           {1100: 1000})))
+
+    for count in (10, 100, 1000, 10_000):
+        ranges = fragmented_ranges(count, 65536, count)
+        pins = {1100 + i: 1000 + i for i in range(8)}
+        # The legacy function can only use the first range of the file,
+        # so it maps far fewer ids.
+        t = timeit.timeit(
+                lambda: legacy_make_id_maps(ranges[0], 1100, 1000),
+                number=number) / number
+        lines = len(legacy_make_id_maps(ranges[0], 1100, 1000)) // 3
+        report(f'legacy, {count} ranges (first only)', t, lines)
+
+        t = timeit.timeit(
+                lambda: build_id_map(ranges, pins),
+                number=number) / number
+        lines = len(build_id_map(ranges, pins))
+        report(f'build_id_map, {count} ranges, 8 pins', t, lines)
+
+    print(f'(maps are capped at {MAX_ID_MAP_LINES} lines)')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from lib.aio import Container
+from lib.container import Config
+from lib.image import mount_image, umount_image
+from lib.overlay import Overlay
+
+
+async def launch_times(config: Config, count: int) -> list[float]:
+    times: list[float] = []
+    for _ in range(count):
+        start = time.perf_counter()
+        container = Container(config, ['true'])
+        await container.start()
+        await container.wait()
+        times.append(time.perf_counter() - start)
+
+    return times
+
+
+def report(name: str, times: list[float]) -> None:
+    print(f'{name:<48} p50 {statistics.median(times) * 1e3:7.3f} ms  '
+          f'mean {statistics.mean(times) * 1e3:7.3f} ms')
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+            description='Time mounting squashfs or erofs images, and '
+                        'launches with them as the root against a directory')
+    parser.add_argument(
+            '--root',
+            default='alpine/alpine-root',
+            help='directory root to compare with (default: %(default)s)')
+    parser.add_argument(
+            '--count', '-n',
+            type=int,
+            default=200,
+            help='launches for each root (default: %(default)s)')
+    parser.add_argument(
+            'images',
+            nargs='+',
+            help='image files, of different sizes to see what size costs')
+    args = parser.parse_args(sys.argv[1:])
+
+    report(f'directory {args.root}',
+           asyncio.run(launch_times(Config(root=args.root, overlay=Overlay()),
+                                    args.count)))
+
+    with tempfile.TemporaryDirectory() as image_dir:
+        for image in args.images:
+            size = os.path.getsize(image) / 2**20
+            start = time.perf_counter()
+            root = mount_image(image, image_dir)
+            first = time.perf_counter() - start
+            start = time.perf_counter()
+            mount_image(image, image_dir)
+            again = time.perf_counter() - start
+            print(f'{image} ({size:.0f} MiB): first mount '
+                  f'{first * 1e3:.3f} ms, already mounted {again * 1e3:.3f} '
+                  f'ms')
+
+            config = Config(root=root, overlay=Overlay(), image=image)
+            report(f'image {os.path.basename(image)}',
+                   asyncio.run(launch_times(config, args.count)))
+            umount_image(image, image_dir)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,134 @@
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import statistics
+import sys
+import threading
+import time
+
+from lib import libc
+from lib.aio import Container
+from lib.container import Config, make_id_maps, read_subgids, read_subuids
+from lib.idmap import apply_id_maps
+from lib.net import BACKENDS, bring_up_loopback
+
+# Bytes sent for each throughput measurement, and the size of each send.
+TRANSFER_BYTES = 1 << 30
+CHUNK = 1 << 18
+
+
+async def launch_times(config: Config, count: int) -> list[float]:
+    times: list[float] = []
+    for _ in range(count):
+        start = time.perf_counter()
+        container = Container(config, ['true'])
+        await container.start()
+        await container.wait()
+        times.append(time.perf_counter() - start)
+
+    return times
+
+
+def loopback_throughput() -> float:
+    '''
+    Send TRANSFER_BYTES over TCP on 127.0.0.1 in this process's network
+    namespace, and return the rate in MB per second.
+    '''
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+
+        def receive() -> None:
+            conn, _ = listener.accept()
+            with conn:
+                while conn.recv(CHUNK):
+                    pass
+
+        receiver = threading.Thread(target=receive)
+        receiver.start()
+
+        data = bytes(CHUNK)
+        start = time.perf_counter()
+        with socket.create_connection(listener.getsockname()) as sender:
+            for _ in range(TRANSFER_BYTES // CHUNK):
+                sender.sendall(data)
+        receiver.join()
+        elapsed = time.perf_counter() - start
+
+    return TRANSFER_BYTES / elapsed / 1e6
+
+
+def netns_throughput() -> float:
+    '''
+    Run loopback_throughput in a child in new user and network namespaces.
+    '''
+    uid = os.geteuid()
+    gid = os.getegid()
+    uid_maps = make_id_maps(read_subuids(uid), 0, uid)
+    gid_maps = make_id_maps(read_subgids(gid), 0, gid)
+
+    read_fd, write_fd = os.pipe()
+    sems = libc.SemArray(1)
+
+    def child() -> int:
+        os.close(read_fd)
+        libc.sem_wait(sems[0])
+        bring_up_loopback()
+        with os.fdopen(write_fd, 'w') as f:
+            json.dump(loopback_throughput(), f)
+        return 0
+
+    pid, pidfd = libc.clone3(child,
+                             libc.CLONE_NEWUSER | libc.CLONE_NEWNET)
+    os.close(write_fd)
+    os.close(pidfd)
+    apply_id_maps(pid, uid_maps, gid_maps)
+    libc.sem_post(sems[0])
+
+    with os.fdopen(read_fd) as f:
+        output = f.read()
+    os.waitpid(pid, 0)
+
+    rate: float = json.loads(output)
+    return rate
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+            description='Time container launches with each network mode, '
+                        'and loopback throughput with and without a network '
+                        'namespace')
+    parser.add_argument(
+            '--root',
+            default='alpine/alpine-root',
+            help='root file system for the launches (default: %(default)s)')
+    parser.add_argument(
+            '--count', '-n',
+            type=int,
+            default=200,
+            help='launches for each mode (default: %(default)s)')
+    args = parser.parse_args(sys.argv[1:])
+
+    for name in sorted(BACKENDS):
+        if name == 'slirp' and shutil.which('slirp4netns') is None:
+            print(f'{name:<10} (slirp4netns is not installed)')
+            continue
+
+        config = Config(root=args.root, net=name)
+        times = asyncio.run(launch_times(config, args.count))
+        print(f'{name:<10} launch p50 '
+              f'{statistics.median(times) * 1e3:7.3f} ms  mean '
+              f'{statistics.mean(times) * 1e3:7.3f} ms')
+
+    print(f'loopback throughput, host namespace: '
+          f'{loopback_throughput():8.0f} MB/s')
+    print(f'loopback throughput, new namespace:  '
+          f'{netns_throughput():8.0f} MB/s')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
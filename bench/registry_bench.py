@@ -0,0 +1,71 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import timeit
+
+from lib.registry import Registry
+
+UID_MAPS = ['0', '200000', '1100', '1100', '0', '1', '1101', '201100', '64436']
+
+
+def add(registry: Registry) -> str:
+    # Records this process, since add needs a pid that's running.
+    return registry.add(os.getpid(), 0x7c020000, ['sh', '-c', 'true'],
+                        root='alpine/alpine-root',
+                        upper_dir='/tmp/overlay-abcdefgh',
+                        uid_maps=UID_MAPS, gid_maps=UID_MAPS)
+
+
+def report(name: str, seconds: float) -> None:
+    print(f'{name:<40} {seconds * 1e6:10.1f} us')
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+            description='Time what the registry adds to each launch, and '
+                        'lookups in a registry with many entries')
+    parser.add_argument(
+            '--entries', '-n',
+            type=int,
+            default=50_000,
+            help='entries to fill the registry with (default: %(default)s)')
+    args = parser.parse_args(sys.argv[1:])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        registry = Registry(os.path.join(tmp, 'registry.db'))
+        number = 2000
+
+        def launch() -> None:
+            # Everything a launcher does with the registry for one container.
+            id_ = add(registry)
+            registry.exited(id_, 0)
+            registry.remove(id_)
+
+        report('add, exited and remove (one launch)',
+               timeit.timeit(launch, number=number) / number)
+
+        start = time.perf_counter()
+        ids = [add(registry) for _ in range(args.entries)]
+        report(f'add, filling to {args.entries} entries',
+               (time.perf_counter() - start) / args.entries)
+
+        probe = ids[len(ids) // 2]
+        report(f'get by id, {args.entries} entries',
+               timeit.timeit(lambda: registry.get(probe),
+                             number=number) / number)
+        report(f'find_pid, {args.entries} entries',
+               timeit.timeit(lambda: registry.find_pid(1),
+                             number=number) / number)
+        report(f'entries (list), {args.entries} entries',
+               timeit.timeit(registry.entries, number=5) / 5)
+        report(f'one launch, {args.entries} entries',
+               timeit.timeit(launch, number=number) / number)
+        registry.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
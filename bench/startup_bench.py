@@ -0,0 +1,326 @@
+import argparse
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+import importlib.util
+import json
+import os
+from pathlib import Path
+import platform
+import pwd
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from types import ModuleType
+from typing import Any
+
+from lib import libc
+from lib.container import (
+        CLONE_FLAGS,
+        Config,
+        make_id_maps,
+        plan_mounts,
+        read_subgids,
+        read_subuids,
+)
+from lib.devfs import setup_dev
+from lib.idmap import apply_id_maps
+from lib.mounts import do_mounts
+from lib.subids import SubidIndex
+from lib.trace import percentiles, summarize
+
+REPO = Path(__file__).resolve().parent.parent
+
+# Example programs with a launch path worth timing, and whether they take a
+# root file system.
+EXAMPLES = {
+        '03': ('03-clone-and-more-namespaces/example03.py', False),
+        '04': ('04-more-mappings-and-root-file-system/example04.py', False),
+        '05': ('05-using-chroot-and-mounts/example05.py', True),
+        '06': ('06-set-user-and-groups/example06.py', True),
+        '07': ('07-sharing-files/example07.py', True),
+}
+
+# What every launch runs.
+PAYLOAD = ['true']
+
+
+def launch(argv: list[str], env: dict[str, str],
+           cwd: str) -> dict[str, float]:
+    '''
+    Run one example to completion. Returns its wall time and, from the
+    child's rusage, CPU time and peak RSS.
+    '''
+    start = time.monotonic()
+    proc = subprocess.Popen(argv, env=env, cwd=cwd)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    wall = time.monotonic() - start
+    # Popen would otherwise try to wait for it again.
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    if proc.returncode != 0:
+        raise Exception(f'{argv} exited with {proc.returncode}')
+
+    return {
+        'wall_ms': wall * 1000,
+        'cpu_ms': (rusage.ru_utime + rusage.ru_stime) * 1000,
+        'maxrss_kb': rusage.ru_maxrss,
+    }
+
+
+def concurrency_levels(max_concurrency: int) -> list[int]:
+    # Powers of two up to max_concurrency, and max_concurrency itself.
+    levels = [1]
+    while levels[-1] * 2 < max_concurrency:
+        levels.append(levels[-1] * 2)
+    if levels[-1] != max_concurrency:
+        levels.append(max_concurrency)
+
+    return levels
+
+
+def bench_example(name: str, root: str | None, runs: int, warmup: int,
+                  concurrency: int) -> dict[str, Any]:
+    path, takes_root = EXAMPLES[name]
+    argv = [sys.executable, str(REPO / path)]
+    # The examples chdir to the root path after chroot, which only works if
+    # it's relative, so run them from the directory holding the root.
+    cwd, root_name = os.path.split(os.path.abspath(root or '.'))
+    if takes_root:
+        argv += ['--root', root_name]
+
+    env = dict(os.environ, PYTHONPATH=str(REPO))
+    trace_path = None
+    if name == '07':
+        fd, trace_path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+        argv += ['--trace', trace_path]
+    argv += ['--'] + PAYLOAD
+
+    for _ in range(warmup):
+        launch(argv, env, cwd)
+    if trace_path:
+        # Leave the warmup runs out of the phase times.
+        os.truncate(trace_path, 0)
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        start = time.monotonic()
+        samples = list(executor.map(lambda _: launch(argv, env, cwd),
+                                    range(runs)))
+        elapsed = time.monotonic() - start
+
+    result: dict[str, Any] = {
+        'runs': runs,
+        'concurrency': concurrency,
+        'launches_per_s': runs / elapsed,
+    }
+    for key in ('wall_ms', 'cpu_ms'):
+        values = [s[key] for s in samples]
+        result[key] = percentiles(values)
+        result[key]['mean'] = statistics.fmean(values)
+    result['maxrss_kb'] = max(s['maxrss_kb'] for s in samples)
+
+    if trace_path:
+        with open(trace_path) as f:
+            result['phases_ms'] = summarize([f])
+        os.unlink(trace_path)
+
+    return result
+
+
+def load_example(name: str) -> ModuleType:
+    path = REPO / EXAMPLES[name][0]
+    spec = importlib.util.spec_from_file_location(f'example{name}', path)
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def time_us(fn: Callable[[], object], number: int) -> float:
+    return timeit.timeit(fn, number=number) / number * 1e6
+
+
+def micro_ids(number: int) -> dict[str, float]:
+    uid = os.geteuid()
+    name = pwd.getpwuid(uid).pw_name
+    subuids = read_subuids(uid)
+    example04 = load_example('04')
+
+    def lib_read_ids() -> list[range]:
+        # A new index, so the file is parsed each time as in a new process.
+        return SubidIndex('/etc/subuid',
+                          lambda id_: pwd.getpwuid(id_).pw_name).require(uid)
+
+    return {
+        'read_ids_example04_us': time_us(
+                lambda: example04.read_ids(uid, name, '/etc/subuid'), number),
+        'read_ids_lib_us': time_us(lib_read_ids, number),
+        'make_id_maps_example04_us': time_us(
+                lambda: example04.make_id_maps(subuids[0], 1100, uid),
+                number),
+        'make_id_maps_lib_us': time_us(
+                lambda: make_id_maps(subuids, 1100, uid), number),
+    }
+
+
+def _mount_setup(number: int) -> dict[str, float]:
+    # Runs in a child with its own user, pid and mount namespaces. Each
+    # iteration gets a fresh skeleton root on a private tmpfs, so mounts don't
+    # stack, and only the mounting is timed.
+    libc.mount(b'tmpfs', b'/tmp', b'tmpfs', 0)
+    base = tempfile.mkdtemp()
+    configs: list[Config] = []
+    for i in range(number):
+        config = Config(root=os.path.join(base, str(i)))
+        assert config.root is not None
+        for d in ('proc', 'sys', 'dev', 'etc'):
+            os.makedirs(os.path.join(config.root, d))
+        open(os.path.join(config.root, 'etc/resolv.conf'), 'w').close()
+        configs.append(config)
+
+    start = time.perf_counter()
+    for config in configs:
+        assert config.root is not None
+        setup_dev(os.fsencode(os.path.join(config.root, 'dev')), config.dev)
+        do_mounts(plan_mounts(config))
+    elapsed = time.perf_counter() - start
+
+    return {'mount_setup_us': elapsed / number * 1e6}
+
+
+def micro_mounts(number: int) -> dict[str, float]:
+    uid = os.geteuid()
+    gid = os.getegid()
+    uid_maps = make_id_maps(read_subuids(uid), 0, uid)
+    gid_maps = make_id_maps(read_subgids(gid), 0, gid)
+
+    read_fd, write_fd = os.pipe()
+    sems = libc.SemArray(1)
+
+    def child() -> int:
+        libc.sem_wait(sems[0])
+        with os.fdopen(write_fd, 'w') as f:
+            json.dump(_mount_setup(number), f)
+        return 0
+
+    child_pid = libc.clone(child, 100_000, CLONE_FLAGS)
+    os.close(write_fd)
+    apply_id_maps(child_pid, uid_maps, gid_maps)
+    libc.sem_post(sems[0])
+
+    with os.fdopen(read_fd) as f:
+        output = f.read()
+    _, status = os.waitpid(child_pid, 0)
+    if status != 0 or not output:
+        raise Exception('Mount setup benchmark failed')
+
+    results: dict[str, float] = json.loads(output)
+    return results
+
+
+def environment() -> dict[str, Any]:
+    '''
+    Describe what the results were measured on, so runs can be compared.
+    '''
+    try:
+        commit = subprocess.run(
+                ['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True,
+                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit': commit,
+        'kernel': platform.release(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+            description='Benchmark container startup with the example '
+                        'programs, and parts of it in isolation')
+    parser.add_argument(
+            '--root', '-r',
+            help='root file system for the examples that use one, which must '
+                 'have true in its PATH')
+    parser.add_argument(
+            '--examples',
+            default=','.join(EXAMPLES),
+            help='comma separated examples to run (default: %(default)s)')
+    parser.add_argument(
+            '--runs', '-n',
+            type=int,
+            default=1000,
+            help='launches per example and concurrency level')
+    parser.add_argument(
+            '--warmup',
+            type=int,
+            default=10,
+            help='untimed launches before each measurement')
+    parser.add_argument(
+            '--max-concurrency', '-j',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='highest number of launches in flight, measured along with '
+                 'powers of two below it')
+    parser.add_argument(
+            '--micro-runs',
+            type=int,
+            default=1000,
+            help='iterations of each micro benchmark')
+    parser.add_argument(
+            '--no-micro',
+            action='store_true',
+            help='skip the micro benchmarks')
+    parser.add_argument(
+            '--output', '-o',
+            help='write results to this file as JSON')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    examples = [e for e in args.examples.split(',') if e]
+    for name in examples:
+        if name not in EXAMPLES:
+            parser.error(f'unknown example {name}')
+        if EXAMPLES[name][1] and not args.root:
+            parser.error(f'example {name} needs --root')
+
+    results: dict[str, Any] = {'environment': environment(), 'launch': {}}
+
+    if not args.no_micro:
+        results['micro'] = micro_ids(args.micro_runs)
+        results['micro'].update(micro_mounts(args.micro_runs))
+        for key, value in results['micro'].items():
+            print(f'{key:<28} {value:10.1f}')
+
+    for name in examples:
+        levels: dict[str, Any] = {}
+        for concurrency in concurrency_levels(args.max_concurrency):
+            r = bench_example(name, args.root, args.runs, args.warmup,
+                              concurrency)
+            levels[str(concurrency)] = r
+            wall = r['wall_ms']
+            print(f'example{name} x{concurrency:<3} '
+                  f'{r["launches_per_s"]:8.1f} launches/s  '
+                  f'wall p50 {wall["p50"]:7.2f} p95 {wall["p95"]:7.2f} '
+                  f'p99 {wall["p99"]:7.2f} ms  '
+                  f'cpu {r["cpu_ms"]["mean"]:6.2f} ms  '
+                  f'rss {r["maxrss_kb"]} kB')
+        results['launch'][name] = levels
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,269 @@
+from ctypes import c_void_p
+import os
+import signal
+
+from . import libc
+from .cgroup import Cgroup
+from .container import (
+        Config,
+        VolumeTree,
+        idmap_volume_trees,
+        make_id_maps,
+        namespace_flags,
+        open_volume_trees,
+        plan_mounts,
+        read_subgids,
+        read_subuids,
+        setup_child,
+)
+from .idmap import apply_id_maps_async
+from .init import run_init
+from .mounts import Mount
+from .net import make_backend
+from .overlay import make_upper_dir, remove_upper_dir_async
+from .registry import Registry
+from .slices import IdSlice, default_allocator
+from .supervisor import wait_pidfd
+
+
+class Container:
+    '''
+    A container running one command, for use from asyncio:
+
+        container = Container(config, ['ls', '/'])
+        await container.start()
+        exitcode = await container.wait()
+
+    start only waits for the id maps to be applied, and wait waits for the
+    child's pidfd to become readable, so any number of containers can be
+    started and waited for at once on one event loop.
+
+    stdin, stdout and stderr are fds for the command to use, by default the
+    ones of this process. env is added to the command's environment.
+    uid_maps, gid_maps and mounts can be given when they're already known,
+    as from a compiled spec (see lib/spec.py), otherwise they're worked out
+    from config by start. With config.id_slice the id maps are always those
+    of the slice leased to the container, see lib/slices.py.
+
+    If the config has cgroup limits, the container runs in its own cgroup,
+    and once it has exited, cgroup_stats has that cgroup's accounting.
+
+    With a registry, the container is recorded there from when it's cloned
+    until wait has cleaned up after it, and id is its id there. sem is a
+    semaphore for the child to wait on before its setup, as from a SemArray
+    shared by a batch of containers, otherwise it gets one of its own.
+    '''
+
+    def __init__(self, config: Config, argv: list[str],
+                 env: dict[str, str] | None = None,
+                 stdin: int | None = None, stdout: int | None = None,
+                 stderr: int | None = None,
+                 uid_maps: list[str] | None = None,
+                 gid_maps: list[str] | None = None,
+                 mounts: list[Mount] | None = None,
+                 registry: Registry | None = None,
+                 sem: c_void_p | None = None) -> None:
+        self.config = config
+        self.argv = argv
+        self.env = env or {}
+        self.fds = [stdin, stdout, stderr]
+        self.pid: int | None = None
+        self.returncode: int | None = None
+        self._pidfd = -1
+        self._upper_dir: str | None = None
+        self.cgroup: Cgroup | None = None
+        self.cgroup_stats: dict[str, int] | None = None
+        self._uid_maps = uid_maps
+        self._gid_maps = gid_maps
+        self._mounts = mounts
+        self._net = make_backend(config.net)
+        self._registry = registry
+        self.id: str | None = None
+        self._sem = sem
+        self._sem_array: libc.SemArray | None = None
+        self._trees: list[VolumeTree] = []
+        self._flags = 0
+        self._id_slice: IdSlice | None = None
+        self._released = False
+
+    def _child(self, sem: c_void_p, mounts: list[Mount],
+               upper_dir: str | None, trees: list[VolumeTree]) -> int:
+        # The child shares the event loop's wakeup fd, which must not get
+        # its signals.
+        signal.set_wakeup_fd(-1)
+
+        # Wait for parent to set up uidmap and gidmap.
+        libc.sem_wait(sem)
+
+        env = setup_child(self.config, mounts, upper_dir, trees)
+        env.update(self.env)
+
+        for target, fd in enumerate(self.fds):
+            if fd is not None:
+                os.dup2(fd, target)
+
+        if self.config.init:
+            run_init(self.argv, env)
+        os.execvpe(self.argv[0], self.argv, env)
+
+    async def start(self) -> None:
+        '''
+        Start the container, returning once the child is running its setup.
+        '''
+        self.clone()
+        await self.release()
+
+    def clone(self) -> None:
+        '''
+        The first half of start: clone the child, which then waits for
+        release. Starting many containers this way first and releasing them
+        after keeps the clones close together, see lib/batch.py.
+        '''
+        if self.pid is not None:
+            raise Exception('Container has already been started')
+
+        uid = os.geteuid()
+        gid = os.getegid()
+        if self.config.id_slice:
+            # release replaces them with the maps of the leased slice.
+            self._uid_maps = []
+            self._gid_maps = []
+        if self._uid_maps is None:
+            self._uid_maps = make_id_maps(read_subuids(uid),
+                                          self.config.map_uid, uid)
+        if self._gid_maps is None:
+            self._gid_maps = make_id_maps(read_subgids(gid),
+                                          self.config.map_gid, gid)
+
+        mounts = self._mounts
+        if mounts is None:
+            mounts = plan_mounts(self.config)
+        if self._sem is None:
+            self._sem_array = libc.SemArray(1)
+            self._sem = self._sem_array[0]
+        sem = self._sem
+
+        cgroup_fd = None
+        try:
+            if self.config.overlay:
+                self._upper_dir = make_upper_dir(self.config.overlay)
+            self._trees = open_volume_trees(self.config)
+            trees = self._trees
+
+            if self.config.cgroup:
+                self.cgroup = Cgroup.create(self.config.cgroup)
+                cgroup_fd = self.cgroup.open_fd()
+
+            self._flags = namespace_flags(self.config)
+            self.pid, self._pidfd = libc.clone3(
+                    lambda: self._child(sem, mounts, self._upper_dir, trees),
+                    self._flags,
+                    cgroup_fd)
+        except BaseException:
+            self._undo_setup()
+            raise
+        finally:
+            if cgroup_fd is not None:
+                os.close(cgroup_fd)
+
+    def _undo_setup(self) -> None:
+        # Release what clone set up for a child that never started. The child
+        # never got to the upper dir, so it's still empty.
+        for fd, _, _ in self._trees:
+            os.close(fd)
+        self._trees = []
+        if self.cgroup:
+            self.cgroup.remove()
+            self.cgroup = None
+        if self._upper_dir is not None:
+            os.rmdir(self._upper_dir)
+            self._upper_dir = None
+
+    async def release(self) -> None:
+        '''
+        The second half of start: apply the id maps of a child made by
+        clone, and let it go on with its setup.
+        '''
+        if self.pid is None or self._sem is None:
+            raise Exception('Container has not been cloned')
+        assert self._uid_maps is not None
+        assert self._gid_maps is not None
+
+        try:
+            if self.config.id_slice:
+                self._id_slice = default_allocator().lease(self.pid)
+                self._uid_maps, self._gid_maps = self._id_slice.id_maps(
+                        self.config.map_uid, self.config.map_gid)
+            if self._registry:
+                self.id = self._registry.add(
+                        self.pid, self._flags, self.argv,
+                        root=self.config.root,
+                        cgroup=self.cgroup.path if self.cgroup else None,
+                        upper_dir=self._upper_dir,
+                        keep_upper=bool(self.config.overlay and
+                                        self.config.overlay.keep),
+                        uid_maps=self._uid_maps, gid_maps=self._gid_maps)
+            await apply_id_maps_async(self.pid, self._uid_maps,
+                                      self._gid_maps)
+            trees, self._trees = self._trees, []
+            idmap_volume_trees(trees, self.pid)
+            await self._net.start_async(self.pid)
+        except BaseException:
+            for fd, _, _ in self._trees:
+                os.close(fd)
+            self._trees = []
+            signal.pidfd_send_signal(self._pidfd, signal.SIGKILL)
+            await self.wait()
+            raise
+
+        # Signal child that its environment is ready
+        self._released = True
+        libc.sem_post(self._sem)
+
+    async def wait(self) -> int:
+        '''
+        Wait for the container to exit and return its exit code, negative if
+        it was killed by a signal.
+        '''
+        if self.returncode is not None:
+            return self.returncode
+        if self.pid is None:
+            raise Exception('Container has not been started')
+
+        # If this is cancelled the child is still there to wait for again, so
+        # the pidfd is only closed once it has been reaped.
+        self.returncode = await wait_pidfd(self._pidfd)
+        os.close(self._pidfd)
+        self._pidfd = -1
+        if self._registry and self.id:
+            self._registry.exited(self.id, self.returncode)
+        self._net.stop()
+
+        if self.cgroup:
+            # The cgroup goes away with the container, so keep its accounting.
+            self.cgroup_stats = self.cgroup.stats()
+            await self.cgroup.remove_async()
+
+        if self.config.overlay and self._upper_dir is not None:
+            if not self._released:
+                # Killed before its setup, so it's still empty, and with
+                # id_slice there may be no maps to remove it with.
+                os.rmdir(self._upper_dir)
+            elif not self.config.overlay.keep:
+                assert self._uid_maps is not None
+                assert self._gid_maps is not None
+                await remove_upper_dir_async(self._upper_dir, self._uid_maps,
+                                             self._gid_maps)
+
+        if self._id_slice:
+            default_allocator().release(self._id_slice)
+        if self._registry and self.id:
+            self._registry.remove(self.id)
+
+        return self.returncode
+
+    def send_signal(self, sig: int) -> None:
+        if self.pid is None or self.returncode is not None:
+            raise Exception('Container is not running')
+
+        signal.pidfd_send_signal(self._pidfd, sig)
@@ -0,0 +1,241 @@
+import argparse
+import asyncio
+from dataclasses import dataclass
+import os
+import shlex
+import signal
+import sys
+import time
+
+from . import libc
+from .aio import Container
+from .container import (
+        Config,
+        add_arguments,
+        config_from_args,
+        default_state_dir,
+        make_id_maps,
+        plan_mounts,
+        read_subgids,
+        read_subuids,
+)
+from .registry import Registry, default_registry_path
+from .spec import LaunchPlan, container_from_plan, load_plan
+
+# Id maps applied at once by default. Each takes a newuidmap and a newgidmap
+# process unless this process can write the maps itself.
+DEFAULT_PARALLEL = 32
+
+
+@dataclass
+class BatchResult:
+    '''
+    What happened to a batch launched by launch_many. errors has an entry
+    for each plan, the exception if its container failed to start, and
+    exitcodes has the exit code of each one that started. clone_time is the
+    time taken to clone every child, and release_time the time until the
+    last was released, both from the start of the batch.
+    '''
+    errors: list[BaseException | None]
+    exitcodes: list[int | None]
+    clone_time: float
+    release_time: float
+
+    @property
+    def started(self) -> int:
+        return self.errors.count(None)
+
+    def launches_per_second(self) -> float:
+        return self.started / self.release_time if self.release_time else 0.0
+
+
+def plan_from_config(config: Config, argv: list[str]) -> LaunchPlan:
+    '''
+    Resolve config the way a Container would, for launching argv. The plan
+    can be copied for any number of commands with the same config, so the
+    subid files are read and the mounts planned only once.
+    '''
+    uid = os.geteuid()
+    gid = os.getegid()
+    return LaunchPlan(config, argv, {},
+                      make_id_maps(read_subuids(uid), config.map_uid, uid),
+                      make_id_maps(read_subgids(gid), config.map_gid, gid),
+                      plan_mounts(config), '')
+
+
+async def launch_many(plans: list[LaunchPlan], stagger: float = 0.0,
+                      parallel: int = DEFAULT_PARALLEL,
+                      registry: Registry | None = None) -> BatchResult:
+    '''
+    Launch a container for each plan and wait for all of them to exit.
+
+    Every child is cloned first, in one loop, each waiting on its own slot
+    of one shared SemArray. Their id maps are then applied, parallel at a
+    time, and each is released as soon as its maps are done. With stagger,
+    the releases are spaced that many seconds apart, so that the commands
+    don't all start at the same moment.
+    '''
+    sems = libc.SemArray(len(plans))
+    containers = [container_from_plan(plan, sem=sems[i], registry=registry)
+                  for i, plan in enumerate(plans)]
+
+    start = time.perf_counter()
+    cloned: list[Container] = []
+    try:
+        for container in containers:
+            container.clone()
+            cloned.append(container)
+    except BaseException:
+        # Don't leave the others waiting forever.
+        for container in cloned:
+            container.send_signal(signal.SIGKILL)
+        await asyncio.gather(*(container.wait() for container in cloned))
+        raise
+    clone_time = time.perf_counter() - start
+
+    limit = asyncio.Semaphore(parallel)
+    release_start = time.perf_counter()
+
+    async def release(index: int, container: Container) -> None:
+        if stagger:
+            delay = release_start + index * stagger - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        async with limit:
+            await container.release()
+
+    results = await asyncio.gather(
+            *(release(i, container) for i, container in enumerate(containers)),
+            return_exceptions=True)
+    release_time = time.perf_counter() - start
+
+    errors: list[BaseException | None] = []
+    for result in results:
+        errors.append(result if isinstance(result, BaseException) else None)
+
+    async def wait(container: Container, error: BaseException | None
+                   ) -> int | None:
+        return None if error else await container.wait()
+
+    exitcodes = await asyncio.gather(
+            *(wait(container, error)
+              for container, error in zip(containers, errors)))
+
+    return BatchResult(errors, list(exitcodes), clone_time, release_time)
+
+
+def _read_commands(path: str) -> list[list[str]]:
+    # One command per line, split like a shell would, skipping blank lines
+    # and comments.
+    commands: list[list[str]] = []
+    with open(path) as f:
+        for line in f:
+            argv = shlex.split(line, comments=True)
+            if argv:
+                commands.append(argv)
+
+    return commands
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+            description='Launch many containers at once, each running a '
+                        'command or a spec file, and report how fast they '
+                        'were launched')
+    add_arguments(parser)
+    parser.add_argument(
+            '--commands',
+            metavar='FILE',
+            help='run each line of FILE as a command, with the container '
+                 'options given here')
+    parser.add_argument(
+            '--spec',
+            action='append',
+            default=[],
+            metavar='FILE',
+            help='run the container described by a spec file, see '
+                 'lib/spec.py (can be given more than once)')
+    parser.add_argument(
+            '--count', '-n',
+            type=int,
+            default=1,
+            help='launch each command and spec this many times '
+                 '(default: %(default)s)')
+    parser.add_argument(
+            '--stagger',
+            type=float,
+            default=0.0,
+            metavar='SECONDS',
+            help='time between the start of one container and the next '
+                 '(default: %(default)s)')
+    parser.add_argument(
+            '--parallel',
+            type=int,
+            default=DEFAULT_PARALLEL,
+            help='id maps to apply at once (default: %(default)s)')
+    parser.add_argument(
+            '--cache-dir',
+            default=os.path.join(default_state_dir(), 'plans'),
+            help='where compiled spec files are cached (default: '
+                 '%(default)s)')
+    parser.add_argument(
+            '--registry',
+            nargs='?',
+            const=default_registry_path(),
+            metavar='FILE',
+            help='record the containers in a registry database while they '
+                 'run, see lib/registry.py (default FILE: %(const)s)')
+    parser.add_argument(
+            'cmd',
+            nargs='*',
+            help='a command (and arguments) to run, with the container '
+                 'options given here')
+
+    args = parser.parse_args(sys.argv[1:])
+    config = config_from_args(parser, args)
+    if args.count < 1 or args.parallel < 1:
+        parser.error('--count and --parallel must be at least 1')
+
+    commands = _read_commands(args.commands) if args.commands else []
+    if args.cmd:
+        commands.append(args.cmd)
+    if not commands and not args.spec:
+        parser.error('nothing to launch, give a command, --commands or '
+                     '--spec')
+
+    plans: list[LaunchPlan] = []
+    if commands:
+        shared = plan_from_config(config, commands[0])
+        for argv in commands:
+            plans.append(LaunchPlan(shared.config, argv, shared.env,
+                                    shared.uid_maps, shared.gid_maps,
+                                    shared.mounts, ''))
+    for path in args.spec:
+        plans.append(load_plan(path, args.cache_dir))
+    plans *= args.count
+
+    registry = Registry(args.registry) if args.registry else None
+    try:
+        result = asyncio.run(launch_many(plans, args.stagger, args.parallel,
+                                         registry))
+    finally:
+        if registry:
+            registry.close()
+
+    for plan, error in zip(plans, result.errors):
+        if error:
+            print(f'{shlex.join(plan.argv)}: failed to start: {error}',
+                  file=sys.stderr)
+    failed = sum(1 for code in result.exitcodes if code)
+
+    print(f'launched {result.started} of {len(plans)} containers in '
+          f'{result.release_time * 1e3:.1f} ms '
+          f'({result.launches_per_second():.0f} launches/s, cloning took '
+          f'{result.clone_time * 1e3:.1f} ms), {failed} exited with an '
+          f'error', file=sys.stderr)
+
+    return 0 if result.started == len(plans) and not failed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
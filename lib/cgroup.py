@@ -0,0 +1,278 @@
+import asyncio
+from dataclasses import dataclass, field
+import errno
+import os
+import tempfile
+import time
+
+# How many times, and how often, to try removing a cgroup that processes are
+# still leaving.
+_RMDIR_TRIES = 100
+_RMDIR_DELAY = 0.001
+
+
+@dataclass
+class CgroupLimits:
+    '''
+    Resource limits for a container's cgroup, as written to the cgroup v2
+    interface files. cpu is for cpu.max, such as '50000 100000' for half a
+    CPU, memory for memory.max (such as '512M') and pids for pids.max. io
+    entries are lines for io.max, such as '8:0 wbps=1048576'. None leaves
+    the limit unset.
+
+    parent is the cgroup to create container cgroups in, either as the
+    absolute path of its directory, such as /sys/fs/cgroup/user.slice/x, or
+    as a path relative to the cgroup2 mount, such as user.slice/x. None
+    means the cgroup of this process, which is the one delegated to the user
+    when running under something like
+    systemd-run --user --scope -p Delegate=yes.
+    '''
+    cpu: str | None = None
+    memory: str | None = None
+    pids: str | None = None
+    io: list[str] = field(default_factory=list)
+    parent: str | None = None
+
+    def controllers(self) -> list[str]:
+        wanted = [('cpu', self.cpu), ('memory', self.memory),
+                  ('pids', self.pids), ('io', self.io)]
+        return [name for name, value in wanted if value]
+
+    def parent_path(self) -> str:
+        '''
+        Return the directory of the parent cgroup.
+        '''
+        if self.parent is None:
+            return own_cgroup()
+
+        return os.path.join(cgroup2_mount(), self.parent)
+
+
+def cgroup2_mount() -> str:
+    '''
+    Return where the cgroup v2 hierarchy is mounted, which is
+    /sys/fs/cgroup on most systems and /sys/fs/cgroup/unified on hybrid
+    ones.
+    '''
+    with open('/proc/self/mountinfo') as f:
+        for line in f:
+            # Optional fields come before the '-' separator, the file system
+            # type right after it.
+            fields = line.split()
+            sep = fields.index('-')
+            if fields[sep + 1] == 'cgroup2':
+                return fields[4]
+
+    raise Exception('cgroup v2 is not mounted')
+
+
+def own_cgroup() -> str:
+    '''
+    Return the path of this process's cgroup v2 cgroup.
+    '''
+    with open('/proc/self/cgroup') as f:
+        for line in f:
+            if line.startswith('0::'):
+                path = line[3:].rstrip('\n')
+                return os.path.join(cgroup2_mount(), path.lstrip('/'))
+
+    raise Exception('Process is not in a cgroup v2 hierarchy')
+
+
+def _read(path: str) -> str:
+    with open(path) as f:
+        return f.read()
+
+
+def _write(path: str, value: str) -> None:
+    # Interface files want each value in a single write.
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        os.write(fd, value.encode())
+    finally:
+        os.close(fd)
+
+
+def enable_controllers(parent: str, controllers: list[str]) -> None:
+    '''
+    Make controllers available to the children of the parent cgroup. A cgroup
+    with processes in it can't do that (apart from the root), so if this
+    process is in parent, it's moved to a new child of parent named
+    launcher first, as in the usual layout of a delegated cgroup. Other
+    processes in parent are left alone, and an Exception is raised.
+    '''
+    if not controllers:
+        return
+
+    available = _read(os.path.join(parent, 'cgroup.controllers')).split()
+    missing = [c for c in controllers if c not in available]
+    if missing:
+        raise Exception(f'Controllers {", ".join(missing)} are not delegated '
+                        f'to {parent}')
+
+    enabled = _read(os.path.join(parent, 'cgroup.subtree_control')).split()
+    needed = ' '.join(f'+{c}' for c in controllers if c not in enabled)
+    if not needed:
+        return
+
+    subtree_control = os.path.join(parent, 'cgroup.subtree_control')
+    try:
+        _write(subtree_control, needed)
+    except OSError as e:
+        if e.errno != errno.EBUSY:
+            raise
+        if os.path.realpath(parent) != os.path.realpath(own_cgroup()):
+            raise Exception(f'Cannot enable controllers in {parent}, it has '
+                            f'processes in it') from e
+        launcher = os.path.join(parent, 'launcher')
+        os.makedirs(launcher, exist_ok=True)
+        _write(os.path.join(launcher, 'cgroup.procs'), str(os.getpid()))
+        _write(subtree_control, needed)
+
+
+# Interface files with accounting, for parse_stat.
+STAT_FILES = ('cpu.stat', 'memory.current', 'memory.peak', 'io.stat')
+
+
+def parse_stat(name: str, text: str, result: dict[str, int]) -> None:
+    '''
+    Add the contents of one of STAT_FILES to result: everything in cpu.stat,
+    memory.current and memory.peak as memory_current and memory_peak, and
+    io.stat summed over devices as io_rbytes, io_wbytes, etc. Empty text,
+    as for a file that the cgroup's controllers don't provide, adds nothing.
+    '''
+    if name == 'cpu.stat':
+        for line in text.splitlines():
+            key, value = line.split()
+            result[key] = int(value)
+    elif name == 'io.stat':
+        for line in text.splitlines():
+            # Each line is the device followed by key=value pairs.
+            for item in line.split()[1:]:
+                key, value = item.split('=')
+                result[f'io_{key}'] = result.get(f'io_{key}', 0) + int(value)
+    elif text.strip():
+        result[name.replace('.', '_')] = int(text)
+
+
+class Cgroup:
+    '''
+    A cgroup for one container. Create it with create before cloning, start
+    the child in it with open_fd and libc.clone3 (CLONE_INTO_CGROUP), and
+    remove it once the child has exited.
+    '''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    @classmethod
+    def create(cls, limits: CgroupLimits) -> 'Cgroup':
+        parent = limits.parent_path()
+        enable_controllers(parent, limits.controllers())
+
+        cgroup = cls(tempfile.mkdtemp(prefix='container-', dir=parent))
+        try:
+            settings = [('cpu.max', limits.cpu), ('memory.max', limits.memory),
+                        ('pids.max', limits.pids)]
+            for name, value in settings:
+                if value:
+                    cgroup.write(name, value)
+            for line in limits.io:
+                cgroup.write('io.max', line)
+        except BaseException:
+            cgroup.remove()
+            raise
+
+        return cgroup
+
+    def read(self, name: str) -> str:
+        return _read(os.path.join(self.path, name))
+
+    def write(self, name: str, value: str) -> None:
+        _write(os.path.join(self.path, name), value)
+
+    def open_fd(self) -> int:
+        '''
+        Return an fd for the cgroup, for libc.clone3's cgroup_fd.
+        '''
+        return os.open(self.path, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+
+    def add(self, pid: int) -> None:
+        '''
+        Move pid into the cgroup, for children that weren't started in it.
+        '''
+        self.write('cgroup.procs', str(pid))
+
+    def stats(self) -> dict[str, int]:
+        '''
+        Return accounting for the cgroup, as far as its controllers provide
+        it. See parse_stat for what's included.
+        '''
+        result: dict[str, int] = {}
+        for name in STAT_FILES:
+            parse_stat(name, self._read_optional(name), result)
+
+        return result
+
+    def _read_optional(self, name: str) -> str:
+        try:
+            return self.read(name)
+        except FileNotFoundError:
+            return ''
+
+    def kill(self) -> None:
+        '''
+        Kill everything in the cgroup.
+        '''
+        try:
+            self.write('cgroup.kill', '1')
+        except FileNotFoundError:
+            # Linux before 5.14.
+            pass
+
+    def try_rmdir(self) -> bool:
+        '''
+        Remove the cgroup if it's empty. Returns False if there are still
+        processes in it. A cgroup that's already gone, say removed by gc,
+        counts as removed.
+        '''
+        try:
+            os.rmdir(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            if e.errno != errno.EBUSY:
+                raise
+            return False
+
+        return True
+
+    def remove(self) -> None:
+        '''
+        Kill anything left in the cgroup and remove it.
+        '''
+        self.kill()
+
+        # Killed processes take a moment to leave the cgroup.
+        for _ in range(_RMDIR_TRIES):
+            if self.try_rmdir():
+                return
+            time.sleep(_RMDIR_DELAY)
+
+        if not self.try_rmdir():
+            raise OSError(errno.EBUSY, os.strerror(errno.EBUSY), self.path)
+
+    async def remove_async(self) -> None:
+        '''
+        Like remove, but lets other tasks run while killed processes leave
+        the cgroup.
+        '''
+        self.kill()
+
+        for _ in range(_RMDIR_TRIES):
+            if self.try_rmdir():
+                return
+            await asyncio.sleep(_RMDIR_DELAY)
+
+        if not self.try_rmdir():
+            raise OSError(errno.EBUSY, os.strerror(errno.EBUSY), self.path)
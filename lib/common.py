@@ -1,6 +1,8 @@
 from ctypes.util import find_library
 import os
 import ctypes
+import stat
+from typing import BinaryIO
 
 
 def load_lib(name: str) -> ctypes.CDLL:
@@ -21,3 +23,24 @@ def get_os_error() -> OSError:
     '''
     e = ctypes.get_errno()
     return OSError(e, os.strerror(e))
+
+
+def open_private(path: str) -> BinaryIO | None:
+    '''
+    Open path for reading in binary mode, but only if it's a regular file
+    that belongs to this process's effective user and that no one else can
+    write. Returns None if it doesn't exist or isn't such a file. Use this
+    for caches, where whoever can write the file decides what is read back.
+    '''
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC)
+    except OSError:
+        return None
+
+    st = os.fstat(fd)
+    if (not stat.S_ISREG(st.st_mode) or st.st_uid != os.geteuid() or
+            st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+        os.close(fd)
+        return None
+
+    return open(fd, 'rb')
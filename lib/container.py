@@ -0,0 +1,491 @@
+import argparse
+from dataclasses import dataclass, field
+import os
+from pathlib import Path
+import pwd
+import signal
+from socket import sethostname
+
+from . import libc
+from .cgroup import CgroupLimits
+from .devfs import DEFAULT_DEV, DevSpec, setup_dev
+from .idmap import build_id_map, can_write_id_maps, id_map_args
+from .mounts import (Mount, attach_tree, clone_tree, do_mounts,
+                     set_tree_attrs)
+from .net import BACKENDS, bring_up_loopback
+from .image import mount_image
+from .overlay import Overlay, mount_overlay
+from .subids import subgids, subuids
+from .trace import LaunchTrace
+
+# Namespaces created for every container, as flags for clone3.
+NAMESPACE_FLAGS = (libc.CLONE_NEWUSER | libc.CLONE_NEWPID | libc.CLONE_NEWUTS |
+                   libc.CLONE_NEWNS)
+
+# The same for clone. SIGCHLD is included so that the parent can wait for the
+# child normally.
+CLONE_FLAGS = signal.SIGCHLD | NAMESPACE_FLAGS
+
+# Environment variable naming the directory that launcher state, such as
+# named containers and compiled specs, is kept in.
+STATE_DIR_ENV = 'ROOTLESS_STATE_DIR'
+
+# (host_path, container_path, flags, idmap)
+Volume = tuple[str, str, int, bool]
+
+# A detached copy of an idmapped volume: (fd, target, flags)
+VolumeTree = tuple[int, bytes, int]
+
+
+@dataclass
+class Config:
+    '''
+    Everything needed to set up a container, apart from the command to run in
+    it. This corresponds to the command line options of example07. If the
+    root is a mounted image (see lib/image.py), image is the image file.
+    '''
+    root: str | None = None
+    hostname: str | None = None
+    user: str | None = None
+    map_uid: int | None = 1100
+    map_gid: int | None = 1100
+    volumes: list[Volume] = field(default_factory=list)
+    dev: DevSpec = field(default_factory=lambda: DEFAULT_DEV)
+    overlay: Overlay | None = None
+    cgroup: CgroupLimits | None = None
+    init: bool = False
+    net: str = 'host'
+    id_slice: bool = False
+    image: str | None = None
+
+
+def namespace_flags(config: Config) -> int:
+    '''
+    Return the CLONE_NEW* flags for config: NAMESPACE_FLAGS, plus
+    CLONE_NEWNET if its network backend uses a network namespace.
+    '''
+    if BACKENDS[config.net].netns:
+        return NAMESPACE_FLAGS | libc.CLONE_NEWNET
+
+    return NAMESPACE_FLAGS
+
+
+def default_state_dir() -> str:
+    '''
+    Return the directory for launcher state: $ROOTLESS_STATE_DIR if it's
+    set, otherwise rootless-containers under $XDG_RUNTIME_DIR, or under /tmp
+    with the uid in the name if there's no runtime directory.
+    '''
+    state_dir = os.environ.get(STATE_DIR_ENV)
+    if state_dir:
+        return state_dir
+
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'rootless-containers')
+
+    return f'/tmp/rootless-containers-{os.geteuid()}'
+
+
+def default_image_dir() -> str:
+    '''
+    Return the directory that images used as roots are mounted under.
+    '''
+    return os.path.join(default_state_dir(), 'images')
+
+
+def read_subuids(uid: int) -> list[range]:
+    # Without the setuid helpers nothing else checks the ranges against
+    # /etc/subuid, so don't take them from the cache on trust.
+    return subuids.require(uid, verify=can_write_id_maps())
+
+
+def read_subgids(gid: int) -> list[range]:
+    return subgids.require(gid, verify=can_write_id_maps())
+
+
+def make_id_maps(
+        subids: list[range],
+        cont_id: int | None,
+        host_id: int) -> list[str]:
+    '''
+    Return a set of mappings formatted for use with newuidmap/newgidmap. subids
+    is a list of ranges of host ids (uids or gids) for the namespace ids to be
+    mapped to. Inside the namespace these will be mapped to 0.. until all have
+    been used. If cont_id is provided, it is skipped in this step.
+
+    cont_id and host_id define an extra mapping for one host id to one
+    container id, generally used for mapping the user's own uid and primary
+    gid. If cont_id is None no additional mapping is added.
+    '''
+    pins = {} if cont_id is None else {cont_id: host_id}
+    return id_map_args(build_id_map(subids, pins))
+
+
+def get_user_uid(user: str) -> int:
+    if user.isdigit():
+        return int(user)
+
+    return pwd.getpwnam(user).pw_uid
+
+
+def parse_volumes(volumes: list[str] | None) -> list[Volume]:
+    if volumes is None:
+        return []
+
+    result: list[Volume] = []
+    for volume_arg in volumes:
+        parts = volume_arg.split(':')
+
+        match parts:
+            case [host_part, cont_part]:
+                result.append((host_part, cont_part, libc.MS_RDONLY, False))
+            case [host_part, cont_part, mode]:
+                options = set(mode.split(','))
+                if (not options <= {'ro', 'rw', 'idmap'} or
+                        {'ro', 'rw'} <= options):
+                    raise Exception(
+                            f'Failed parsing --volume argument value '
+                            f'{volume_arg}')
+                flags = 0 if 'rw' in options else libc.MS_RDONLY
+                result.append((host_part, cont_part, flags,
+                               'idmap' in options))
+            case _:
+                raise Exception(
+                        f'Failed parsing --volume argument value {volume_arg}')
+
+    return result
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    '''
+    Add the options that make up a Config to parser.
+    '''
+    parser.add_argument(
+            '--hostname',
+            help='set hostname in the new namespace')
+    parser.add_argument(
+            '--map-uid', '-m',
+            type=int,
+            default=1100,
+            help="uid inside the container to which the current user's uid "
+                 "should be mapped")
+    parser.add_argument(
+            '--map-gid', '-g',
+            type=int,
+            default=1100,
+            help="gid inside the container to which the current user's gid "
+                 "should be mapped")
+    parser.add_argument(
+            '--root', '-r',
+            help='chroot to the given root file system')
+    parser.add_argument(
+            '--image',
+            metavar='FILE',
+            help='use a squashfs or erofs image as the root file system, '
+                 'mounted read-only once and shared by every container that '
+                 'uses it, see lib/image.py (add --overlay to write to it)')
+    parser.add_argument(
+            '--user', '-u',
+            help='set user ID (by name or UID) inside the namespace')
+    parser.add_argument(
+            '--volume', '-v',
+            action='append',
+            metavar='HOST_VOL:CONT_VOL[:MODE]',
+            help='mount HOST_VOL from the host as CONT_VOL in the container '
+                 'using MODE (ro or rw, optionally with idmap to show file '
+                 'owners through the id maps, as in ro,idmap)')
+    parser.add_argument(
+            '--overlay',
+            action='store_true',
+            help='run on a copy-on-write overlay of the root file system, '
+                 'keeping changes on a tmpfs')
+    parser.add_argument(
+            '--overlay-dir',
+            metavar='DIR',
+            help='like --overlay, but keep changes in a new directory under '
+                 'DIR')
+    parser.add_argument(
+            '--keep-overlay',
+            action='store_true',
+            help="don't remove the --overlay-dir directory when the "
+                 "container exits")
+    parser.add_argument(
+            '--init',
+            action='store_true',
+            help='run the command under a minimal init that reaps zombies '
+                 'and forwards signals, see lib/init.py')
+    parser.add_argument(
+            '--net',
+            choices=sorted(BACKENDS),
+            default='host',
+            help="the container's network: the host's, only a loopback "
+                 'interface, or through slirp4netns (default: %(default)s)')
+    parser.add_argument(
+            '--id-slice',
+            action='store_true',
+            help='map the container to a slice of the subordinate ids that '
+                 'no other container with --id-slice is using, see '
+                 'lib/slices.py (not with --root or --image)')
+    parser.add_argument(
+            '--cpu-max',
+            metavar='QUOTA PERIOD',
+            help="limit CPU time with the container's cgroup, as in "
+                 "'50000 100000' for half a CPU")
+    parser.add_argument(
+            '--memory-max',
+            metavar='BYTES',
+            help='limit memory use, with a K, M or G suffix')
+    parser.add_argument(
+            '--pids-max',
+            metavar='COUNT',
+            help='limit the number of processes')
+    parser.add_argument(
+            '--io-max',
+            action='append',
+            metavar='LIMITS',
+            help="limit IO to a device, as in '8:0 wbps=1048576'")
+    parser.add_argument(
+            '--cgroup-parent',
+            metavar='PATH',
+            help='create the cgroup under PATH, a directory or a path '
+                 'relative to the cgroup2 mount (default: the cgroup of this '
+                 'process)')
+
+
+def config_from_args(
+        parser: argparse.ArgumentParser,
+        args: argparse.Namespace) -> Config:
+    '''
+    Build a Config from arguments parsed by a parser set up with
+    add_arguments. An --image is mounted here.
+    '''
+    if args.id_slice and (args.root or args.image):
+        # Their files are owned by the ids of the whole subordinate range,
+        # which only the first slice gets.
+        parser.error('--id-slice can not be used with --root or --image')
+
+    root = args.root
+    image = None
+    if args.image:
+        if args.root:
+            parser.error('--image and --root can not be used together')
+        image = os.path.abspath(args.image)
+        root = mount_image(image, default_image_dir())
+
+    if args.volume and not root:
+        parser.error('--volume can only be used with --root or --image')
+
+    overlay = None
+    if args.overlay or args.overlay_dir:
+        if not root:
+            parser.error('--overlay can only be used with --root or --image')
+        overlay = Overlay(args.overlay_dir, args.keep_overlay)
+    elif args.keep_overlay:
+        parser.error('--keep-overlay can only be used with --overlay-dir')
+
+    cgroup = None
+    if (args.cpu_max or args.memory_max or args.pids_max or args.io_max or
+            args.cgroup_parent):
+        cgroup = CgroupLimits(args.cpu_max, args.memory_max, args.pids_max,
+                              args.io_max or [], args.cgroup_parent)
+
+    return Config(
+            root=root,
+            hostname=args.hostname,
+            user=args.user,
+            map_uid=args.map_uid,
+            map_gid=args.map_gid,
+            volumes=parse_volumes(args.volume),
+            overlay=overlay,
+            cgroup=cgroup,
+            init=args.init,
+            net=args.net,
+            id_slice=args.id_slice,
+            image=image)
+
+
+def plan_mounts(config: Config) -> list[Mount]:
+    '''
+    Return the mounts needed for config, in order, with targets resolved
+    against the root. This can be done once before cloning so the child only
+    has to make the system calls.
+    '''
+    proc_flags = (libc.MS_NOSUID | libc.MS_NODEV | libc.MS_RELATIME |
+                  libc.MS_NOEXEC)
+
+    mounts = [
+            # (source, target, type, flags)
+            ('proc', 'proc', 'proc', proc_flags),
+    ]
+
+    # Sysfs can't be mounted in a user namespace unless it's also in a
+    # network namespace. Apparently this has something to do with accessing
+    # network devices via /sys/class/net. Otherwise the host's /sys is bind
+    # mounted, which for some reason requires recursive.
+    if BACKENDS[config.net].netns:
+        sys_mount = ('sysfs', 'sys', 'sysfs',
+                     libc.MS_RDONLY | libc.MS_NOSUID | libc.MS_NODEV |
+                     libc.MS_NOEXEC)
+    else:
+        sys_mount = ('/sys', 'sys', '', libc.MS_BIND | libc.MS_REC)
+
+    chroot_mounts = [
+            # (source, target, type, flags)
+            sys_mount,
+            ('/etc/resolv.conf', 'etc/resolv.conf', '', libc.MS_BIND),
+    ]
+
+    if config.root:
+        mount_root = config.root
+        mounts += chroot_mounts
+    else:
+        mount_root = '/'
+
+    # Mount --volumes, apart from idmapped ones, see open_volume_trees.
+    for host_dir, cont_dir, flags, idmap in config.volumes:
+        if not idmap:
+            mounts.append((host_dir, cont_dir.lstrip('/'), '',
+                           libc.MS_BIND | flags))
+
+    return [(os.fsencode(source), os.fsencode(Path(mount_root) / target),
+             os.fsencode(fstype), flags)
+            for source, target, fstype, flags in mounts]
+
+
+def open_volume_trees(config: Config) -> list[VolumeTree]:
+    '''
+    Make detached copies of config's idmapped volumes. This is done in the
+    parent before cloning, so that the child inherits the fds. Once the
+    child's id maps are written, call idmap_volume_trees.
+    '''
+    root = Path(config.root or '/')
+    return [(clone_tree(host_dir, 0),
+             os.fsencode(root / cont_dir.lstrip('/')), flags)
+            for host_dir, cont_dir, flags, idmap in config.volumes
+            if idmap]
+
+
+def idmap_volume_trees(trees: list[VolumeTree], pid: int) -> None:
+    '''
+    Idmap trees from open_volume_trees with the user namespace of pid, so
+    that a file owned by id N on the host appears owned by N in the
+    container, whatever the tree size. Then close the parent's fds for them.
+
+    The kernel only allows idmapping a mount for a process with CAP_SYS_ADMIN
+    in the user namespace that mounted the file system, which for host file
+    systems means a privileged parent.
+    '''
+    userns_fd = os.open(f'/proc/{pid}/ns/user', os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        for fd, _, flags in trees:
+            set_tree_attrs(fd, flags, userns_fd)
+    finally:
+        os.close(userns_fd)
+        for fd, _, _ in trees:
+            os.close(fd)
+
+
+def setup_child(config: Config,
+                mounts: list[Mount] | None = None,
+                upper_dir: str | None = None,
+                trees: list[VolumeTree] | None = None,
+                trace: LaunchTrace | None = None) -> dict[str, str]:
+    '''
+    Prepare the environment inside a freshly cloned child, after its id maps
+    have been written: hostname, mounts, chroot and user. mounts is the
+    result of plan_mounts(config), which is called here if it's not given.
+    upper_dir is the result of overlay.make_upper_dir, if config has an
+    overlay. trees are the idmapped volumes from open_volume_trees. If trace
+    is given the end of each step is marked in it. Returns the environment
+    variables that should be passed to the command.
+    '''
+    setup_root(config, mounts, upper_dir, trees, trace)
+    return switch_user(config, trace)
+
+
+def setup_root(config: Config,
+               mounts: list[Mount] | None = None,
+               upper_dir: str | None = None,
+               trees: list[VolumeTree] | None = None,
+               trace: LaunchTrace | None = None) -> None:
+    '''
+    The first part of setup_child: hostname, mounts and chroot.
+    '''
+    if trace:
+        trace.mark('woke')
+
+    # Set the hostname
+    if config.hostname is not None:
+        sethostname(config.hostname)
+
+    if BACKENDS[config.net].netns:
+        bring_up_loopback()
+
+    if mounts is None:
+        mounts = plan_mounts(config)
+
+    if config.root and config.overlay:
+        mount_overlay(config.root, upper_dir)
+
+    if config.root:
+        setup_dev(os.fsencode(Path(config.root) / 'dev'), config.dev)
+
+    do_mounts(mounts)
+
+    for fd, target, _ in trees or []:
+        attach_tree(fd, target)
+        os.close(fd)
+
+    if trace:
+        trace.mark('mounts')
+
+    if config.root:
+        # chroot doesn't change the current directory, so go there first,
+        # which also works when config.root is an absolute path.
+        os.chdir(config.root)
+        os.chroot('.')
+
+    if trace:
+        trace.mark('chroot')
+
+
+def switch_user(config: Config,
+                trace: LaunchTrace | None = None) -> dict[str, str]:
+    '''
+    The last part of setup_child: switch to config's user, as looked up in
+    the container's passwd file if it has one, and go to its home directory.
+    Returns the environment variables that should be passed to the command.
+    '''
+    env: dict[str, str] = {}
+
+    if 'TERM' in os.environ:
+        env['TERM'] = os.environ['TERM']
+
+    # Clear supplementary groups
+    os.setgroups([])
+
+    if config.user:
+        uid = get_user_uid(config.user)
+    else:
+        uid = os.geteuid()
+
+    try:
+        user_info = pwd.getpwuid(uid)
+        env['HOME'] = user_info.pw_dir
+        os.setgid(user_info.pw_gid)
+        os.initgroups(user_info.pw_name, user_info.pw_gid)
+        # Change to the user's home dir, but only if we're in a chroot.
+        # Without a chroot this is likely to fail due to permissions.
+        if config.root:
+            os.chdir(user_info.pw_dir)
+    except KeyError:
+        # Don't require the uid to be found in passwd.
+        pass
+
+    os.setuid(uid)
+
+    if trace:
+        trace.mark('user')
+
+    return env
@@ -0,0 +1,65 @@
+from dataclasses import dataclass, field
+import os
+
+from . import libc
+from .mounts import bind_mount
+
+
+@dataclass
+class DevSpec:
+    '''
+    What to put in a container's /dev. devices are names of host device nodes
+    to bind mount, since device nodes can't be created in a user namespace.
+    dirs are created first, then mounts are made on them as (name, type,
+    flags, data). symlinks maps names to link targets.
+    '''
+    devices: list[str] = field(default_factory=list)
+    dirs: list[str] = field(default_factory=list)
+    mounts: list[tuple[str, str, int, bytes]] = field(default_factory=list)
+    symlinks: dict[str, str] = field(default_factory=dict)
+
+
+DEFAULT_DEV = DevSpec(
+        devices=['null', 'full', 'random', 'urandom', 'zero', 'tty'],
+        dirs=['pts', 'shm'],
+        mounts=[
+            # A private devpts instance, so ptys in the container aren't
+            # shared with the host.
+            ('pts', 'devpts', libc.MS_NOSUID | libc.MS_NOEXEC,
+             b'newinstance,ptmxmode=0666,mode=0620'),
+            ('shm', 'tmpfs', libc.MS_NOSUID | libc.MS_NODEV,
+             b'mode=1777'),
+        ],
+        symlinks={
+            'ptmx': 'pts/ptmx',
+            'fd': '/proc/self/fd',
+            'stdin': '/proc/self/fd/0',
+            'stdout': '/proc/self/fd/1',
+            'stderr': '/proc/self/fd/2',
+        })
+
+
+def setup_dev(dev: bytes, spec: DevSpec = DEFAULT_DEV) -> None:
+    '''
+    Mount a tmpfs on dev and fill it according to spec. The directory only
+    has to exist, there's no need for placeholder files in the root file
+    system.
+    '''
+    libc.mount(b'tmpfs', dev, b'tmpfs', libc.MS_NOSUID | libc.MS_NOEXEC,
+               b'mode=755,size=65536k')
+
+    for name in spec.devices:
+        target = os.path.join(dev, os.fsencode(name))
+        # Bind mounts need something to mount on.
+        os.close(os.open(target, os.O_CREAT | os.O_WRONLY, 0o666))
+        bind_mount(b'/dev/' + os.fsencode(name), target, 0)
+
+    for name in spec.dirs:
+        os.mkdir(os.path.join(dev, os.fsencode(name)), 0o755)
+
+    for name, fstype, flags, data in spec.mounts:
+        target = os.path.join(dev, os.fsencode(name))
+        libc.mount(fstype, target, fstype, flags, data)
+
+    for name, link_target in spec.symlinks.items():
+        os.symlink(link_target, os.path.join(dev, os.fsencode(name)))
@@ -0,0 +1,343 @@
+import asyncio
+from bisect import bisect_left, bisect_right
+from collections.abc import Callable, Iterable, Iterator, Mapping
+from dataclasses import dataclass
+import heapq
+import os
+import signal
+import subprocess
+import sys
+import time
+import traceback
+
+from . import libc, libcap
+from .supervisor import wait_pidfd
+
+# The kernel accepts at most this many lines in uid_map and gid_map, see
+# user_namespaces(7).
+MAX_ID_MAP_LINES = 340
+
+# Ids are 32 bits, but (uid_t)-1 is reserved.
+_ID_LIMIT = 2**32 - 1
+
+# One line of an id map: (container start, host start, count).
+IdExtent = tuple[int, int, int]
+
+
+def _merged(ranges: Iterable[range]) -> Iterator[range]:
+    # Yield sorted, non-overlapping ranges covering the same ids as ranges,
+    # with overlapping and adjacent ranges combined. A heap means only the
+    # ranges that are used get sorted.
+    heap = [(r.start, r.stop) for r in ranges if r]
+    heapq.heapify(heap)
+    while heap:
+        start, stop = heapq.heappop(heap)
+        while heap and heap[0][0] <= stop:
+            stop = max(stop, heapq.heappop(heap)[1])
+        yield range(start, stop)
+
+
+def _without(ranges: Iterable[range], ids: list[int]) -> Iterator[range]:
+    # Yield the pieces of sorted, non-overlapping ranges left when the ids,
+    # which must be sorted, are removed.
+    i = 0
+    for r in ranges:
+        start = r.start
+        i = bisect_left(ids, start, i)
+        while i < len(ids) and ids[i] < r.stop:
+            if ids[i] > start:
+                yield range(start, ids[i])
+            start = ids[i] + 1
+            i += 1
+        if start < r.stop:
+            yield range(start, r.stop)
+
+
+def _coalesce(extents: list[IdExtent]) -> list[IdExtent]:
+    # Join extents that continue each other on both sides.
+    result: list[IdExtent] = []
+    for cont, host, count in sorted(extents):
+        if result:
+            last_cont, last_host, last_count = result[-1]
+            if (last_cont + last_count == cont and
+                    last_host + last_count == host):
+                result[-1] = (last_cont, last_host, last_count + count)
+                continue
+
+        result.append((cont, host, count))
+
+    return result
+
+
+def build_id_map(host_ranges: Iterable[range],
+                 pins: Mapping[int, int] | None = None) -> list[IdExtent]:
+    '''
+    Build an id map from any number of ranges of host ids, such as all of a
+    user's subuid ranges. pins maps container ids to the host ids they must
+    be mapped to, generally used for mapping the user's own uid and primary
+    gid.
+
+    The host ranges are merged and the pinned host ids removed from them, then
+    they are mapped in order to container ids starting at 0, skipping pinned
+    container ids. The result is the smallest set of extents describing the
+    mapping, sorted by container id. If that would be more than
+    MAX_ID_MAP_LINES, the pins are kept and the highest container ids are
+    left unmapped. Host ranges are only merged as far as needed to fill the
+    map, so a huge number of ranges costs little more than a few.
+    '''
+    if pins is None:
+        pins = {}
+
+    if len(set(pins.values())) != len(pins):
+        raise Exception('Each pinned host id can only be mapped once')
+
+    pinned = _coalesce([(cont, host, 1) for cont, host in pins.items()])
+    budget = max(MAX_ID_MAP_LINES - len(pinned), 0)
+    pinned_conts = sorted(pins)
+
+    # Extents come out in order of both container and host ids, and with a
+    # gap in one or the other between each, so none of them can be joined.
+    extents: list[IdExtent] = []
+    cont = 0
+    pi = 0
+    hosts = _without(_merged(host_ranges), sorted(pins.values()))
+    for hrange in hosts:
+        host = hrange.start
+        left = len(hrange)
+        while left:
+            # Skip pinned container ids.
+            while pi < len(pinned_conts) and pinned_conts[pi] <= cont:
+                if pinned_conts[pi] == cont:
+                    cont += 1
+                pi += 1
+            stop = pinned_conts[pi] if pi < len(pinned_conts) else _ID_LIMIT
+            length = min(left, stop - cont)
+            if length <= 0 or len(extents) == budget:
+                return _coalesce(pinned + extents)
+
+            extents.append((cont, host, length))
+            cont += length
+            host += length
+            left -= length
+
+    return _coalesce(pinned + extents)
+
+
+def map_id(extents: list[IdExtent], id_: int) -> int:
+    '''
+    Return the host id that container id id_ maps to with extents, as returned
+    by build_id_map. Raises an Exception if it isn't mapped.
+    '''
+    i = bisect_right(extents, id_, key=lambda e: e[0]) - 1
+    if i >= 0:
+        cont, host, count = extents[i]
+        if id_ < cont + count:
+            return host + id_ - cont
+
+    raise Exception(f'Id {id_} is not mapped')
+
+
+def id_map_args(extents: Iterable[IdExtent]) -> list[str]:
+    '''
+    Convert extents to the argument form used by newuidmap and newgidmap.
+    '''
+    return [str(x) for extent in extents for x in extent]
+
+
+@dataclass
+class IdMapResult:
+    '''
+    How apply_id_maps set up the maps. method is 'direct' when this process
+    wrote uid_map and gid_map itself, or 'helpers' when newuidmap and newgidmap
+    were used. seconds is the wall time it took.
+    '''
+    method: str
+    seconds: float
+
+
+def can_write_id_maps() -> bool:
+    '''
+    Return True if this process has CAP_SETUID and CAP_SETGID in its effective
+    set. With these, user_namespaces(7) allows writing any mapping of ids from
+    this namespace into the uid_map and gid_map of a child namespace, so the
+    setuid helpers aren't needed.
+    '''
+    with libcap.cap_get_proc() as caps:
+        return (
+            libcap.cap_get_flag(caps, libc.CAP_SETUID, libc.CAP_EFFECTIVE)
+            and libcap.cap_get_flag(caps, libc.CAP_SETGID,
+                                    libc.CAP_EFFECTIVE))
+
+
+def format_id_map(maps: list[str]) -> bytes:
+    '''
+    Convert maps in the newuidmap/newgidmap argument form produced by
+    make_id_maps to the uid_map/gid_map file format.
+    '''
+    lines = [' '.join(maps[i:i + 3]) + '\n' for i in range(0, len(maps), 3)]
+    return ''.join(lines).encode()
+
+
+def write_id_map(path: str, maps: list[str]) -> None:
+    # The kernel requires the whole map in a single write(2), so avoid
+    # buffered IO.
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        os.write(fd, format_id_map(maps))
+    finally:
+        os.close(fd)
+
+
+def start_id_map_helpers(pid: int, uid_maps: list[str],
+                         gid_maps: list[str]) -> list[subprocess.Popen[bytes]]:
+    '''
+    Start newuidmap and newgidmap for pid, without waiting for them. If
+    either can't be started, any that was is waited for before the error is
+    raised.
+    '''
+    commands = [['newuidmap', str(pid)] + uid_maps,
+                ['newgidmap', str(pid)] + gid_maps]
+    procs: list[subprocess.Popen[bytes]] = []
+    try:
+        for command in commands:
+            procs.append(subprocess.Popen(command))
+    except BaseException:
+        for proc in procs:
+            proc.wait()
+        raise
+
+    return procs
+
+
+def check_id_map_helpers(procs: list[subprocess.Popen[bytes]]) -> None:
+    '''
+    Raise CalledProcessError if any of the finished procs from
+    start_id_map_helpers failed.
+    '''
+    for proc in procs:
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+def run_id_map_helpers(pid: int, uid_maps: list[str],
+                       gid_maps: list[str]) -> None:
+    '''
+    Run newuidmap and newgidmap for pid at the same time, raising
+    CalledProcessError if either fails.
+    '''
+    procs = start_id_map_helpers(pid, uid_maps, gid_maps)
+
+    for proc in procs:
+        proc.wait()
+
+    check_id_map_helpers(procs)
+
+
+def apply_id_maps(pid: int, uid_maps: list[str],
+                  gid_maps: list[str]) -> IdMapResult:
+    '''
+    Apply id maps produced by make_id_maps to the user namespace of pid, using
+    the cheapest method available. See IdMapResult for the return value.
+    '''
+    start = time.monotonic()
+
+    if can_write_id_maps():
+        write_id_map(f'/proc/{pid}/uid_map', uid_maps)
+        write_id_map(f'/proc/{pid}/gid_map', gid_maps)
+        method = 'direct'
+    else:
+        run_id_map_helpers(pid, uid_maps, gid_maps)
+        method = 'helpers'
+
+    return IdMapResult(method, time.monotonic() - start)
+
+
+async def apply_id_maps_async(pid: int, uid_maps: list[str],
+                              gid_maps: list[str]) -> IdMapResult:
+    '''
+    Like apply_id_maps, but runs newuidmap and newgidmap as asyncio
+    subprocesses so that other tasks can go on while they run.
+    '''
+    start = time.monotonic()
+
+    if can_write_id_maps():
+        write_id_map(f'/proc/{pid}/uid_map', uid_maps)
+        write_id_map(f'/proc/{pid}/gid_map', gid_maps)
+        return IdMapResult('direct', time.monotonic() - start)
+
+    commands = [['newuidmap', str(pid)] + uid_maps,
+                ['newgidmap', str(pid)] + gid_maps]
+    procs = [await asyncio.create_subprocess_exec(*command)
+             for command in commands]
+    returncodes = await asyncio.gather(*(proc.wait() for proc in procs))
+
+    for command, returncode in zip(commands, returncodes):
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command)
+
+    return IdMapResult('helpers', time.monotonic() - start)
+
+
+def _userns_child(fn: Callable[[], int], sems: libc.SemArray) -> int:
+    libc.sem_wait(sems[0])
+    try:
+        res = fn()
+    except Exception:
+        traceback.print_exc()
+        res = 1
+
+    # The child exits without Python's usual cleanup, so make sure any
+    # output gets out.
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return res
+
+
+def run_in_userns(fn: Callable[[], int], uid_maps: list[str],
+                  gid_maps: list[str], flags: int = 0) -> int:
+    '''
+    Run fn in a child process in a new user namespace with the given id maps,
+    and return its exit code. This is useful for working on files owned by
+    ids that are only mapped in containers, such as a root file system.
+    fn's return value is the child's exit code, and an exception is printed
+    and gives 1. flags can add other CLONE_NEW* flags.
+    '''
+    sems = libc.SemArray(1)
+
+    child_pid = libc.clone(lambda: _userns_child(fn, sems), 100_000,
+                           signal.SIGCHLD | libc.CLONE_NEWUSER | flags)
+    apply_id_maps(child_pid, uid_maps, gid_maps)
+    libc.sem_post(sems[0])
+
+    (_, status) = os.waitpid(child_pid, 0)
+    return os.waitstatus_to_exitcode(status)
+
+
+async def run_in_userns_async(fn: Callable[[], int], uid_maps: list[str],
+                              gid_maps: list[str], flags: int = 0) -> int:
+    '''
+    Like run_in_userns, but applies the id maps with apply_id_maps_async and
+    waits for the child through its pidfd, so that other tasks can go on
+    while it runs.
+    '''
+    sems = libc.SemArray(1)
+
+    def child() -> int:
+        # The child shares the event loop's wakeup fd, which must not get
+        # its signals.
+        signal.set_wakeup_fd(-1)
+        return _userns_child(fn, sems)
+
+    child_pid, pidfd = libc.clone3(child, libc.CLONE_NEWUSER | flags)
+    try:
+        try:
+            await apply_id_maps_async(child_pid, uid_maps, gid_maps)
+        except BaseException:
+            signal.pidfd_send_signal(pidfd, signal.SIGKILL)
+            await wait_pidfd(pidfd)
+            raise
+
+        libc.sem_post(sems[0])
+        return await wait_pidfd(pidfd)
+    finally:
+        os.close(pidfd)
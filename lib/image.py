@@ -0,0 +1,223 @@
+import argparse
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import struct
+import subprocess
+import sys
+
+from . import libc, libcap
+
+# Where the magic number of each type of image is, and what it is.
+_MAGICS = (
+        ('squashfs', 0, b'hsqs'),
+        ('erofs', 1024, struct.pack('<I', 0xe0f5e1e2)),
+)
+
+# Programs that mount each type of image with FUSE, without privileges.
+_FUSE_MOUNTERS = {
+        'squashfs': 'squashfuse',
+        'erofs': 'erofsfuse',
+}
+
+
+def image_type(path: str) -> str:
+    '''
+    Return the file system type of the image at path, squashfs or erofs, or
+    raise an Exception if it's neither.
+    '''
+    with open(path, 'rb') as f:
+        for fstype, offset, magic in _MAGICS:
+            f.seek(offset)
+            if f.read(len(magic)) == magic:
+                return fstype
+
+    raise Exception(f'{path} is not a squashfs or erofs image')
+
+
+def _mount_point(image_dir: str, path: str) -> str:
+    # A new mount point for each version of the image, so that a changed
+    # image is never mistaken for the one already mounted.
+    st = os.stat(path)
+    key = repr((path, st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size))
+    return os.path.join(image_dir,
+                        hashlib.sha256(key.encode()).hexdigest()[:16])
+
+
+def can_mount_loop() -> bool:
+    '''
+    Return True if this process can set up loop devices and mount them, and
+    so mount images with the kernel's own squashfs and erofs. Those can't be
+    mounted in a user namespace, so this takes CAP_SYS_ADMIN; being allowed
+    to open /dev/loop-control, as the disk group often is, isn't enough.
+    '''
+    if not os.access('/dev/loop-control', os.R_OK | os.W_OK):
+        return False
+
+    with libcap.cap_get_proc() as caps:
+        return libcap.cap_get_flag(caps, libc.CAP_SYS_ADMIN,
+                                   libc.CAP_EFFECTIVE)
+
+
+def _attach_loop(path: str) -> tuple[int, int]:
+    # Returns the number of a free loop device now backed by path, and an fd
+    # for it. It's read only, and detaches itself once the fd is closed and
+    # it isn't mounted.
+    ctl_fd = os.open('/dev/loop-control', os.O_RDWR | os.O_CLOEXEC)
+    image_fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    config = bytearray(libc.SIZEOF_LOOP_CONFIG)
+    struct.pack_into('I', config, 0, image_fd)
+    struct.pack_into('I', config, libc.LOOP_CONFIG_FLAGS_OFFSET,
+                     libc.LO_FLAGS_READ_ONLY | libc.LO_FLAGS_AUTOCLEAR)
+    try:
+        while True:
+            index = fcntl.ioctl(ctl_fd, libc.LOOP_CTL_GET_FREE)
+            loop_fd = os.open(f'/dev/loop{index}', os.O_RDONLY | os.O_CLOEXEC)
+            try:
+                fcntl.ioctl(loop_fd, libc.LOOP_CONFIGURE, bytes(config))
+            except OSError as e:
+                os.close(loop_fd)
+                # Someone else took it first.
+                if e.errno == errno.EBUSY:
+                    continue
+                raise
+
+            return index, loop_fd
+    finally:
+        os.close(image_fd)
+        os.close(ctl_fd)
+
+
+def _mount_loop(path: str, fstype: str, mount_point: str) -> None:
+    index, loop_fd = _attach_loop(path)
+    try:
+        libc.mount(f'/dev/loop{index}', mount_point, fstype,
+                   libc.MS_RDONLY | libc.MS_NODEV | libc.MS_NOSUID)
+    finally:
+        os.close(loop_fd)
+
+
+def _mount_fstype(mount_point: str) -> str | None:
+    # The file system type of what's mounted on mount_point, from
+    # /proc/self/mountinfo, or None if nothing is. The last mount wins.
+    fstype = None
+    with open('/proc/self/mountinfo') as f:
+        for line in f:
+            fields, _, rest = line.partition(' - ')
+            target = fields.split()[4]
+            # Spaces and such are escaped as octal.
+            target = target.encode().decode('unicode_escape')
+            if target == mount_point:
+                fstype = rest.split()[0]
+
+    return fstype
+
+
+def _mount_fuse(path: str, fstype: str, mount_point: str) -> None:
+    mounter = _FUSE_MOUNTERS[fstype]
+    if shutil.which(mounter) is None:
+        raise Exception(f'Mounting {fstype} images without privileges needs '
+                        f'{mounter} to be installed')
+
+    # allow_other, since the container's processes run as other host ids.
+    # Without privileges this needs user_allow_other in /etc/fuse.conf.
+    subprocess.run([mounter, '-o', 'ro,allow_other', path, mount_point],
+                   check=True)
+
+
+def mount_image(path: str, image_dir: str) -> str:
+    '''
+    Mount the squashfs or erofs image at path read-only under image_dir, and
+    return where. An image is mounted once, and every container with it as
+    its root uses the same mount, so they share its page cache, and only the
+    parts that are read are ever read from disk. It stays mounted until
+    umount_image is called.
+
+    The kernel mounts the image through a loop device if this process has
+    CAP_SYS_ADMIN, otherwise, or if the kernel refuses, squashfuse or
+    erofsfuse mounts it.
+    '''
+    path = os.path.realpath(path)
+    fstype = image_type(path)
+    os.makedirs(image_dir, mode=0o700, exist_ok=True)
+
+    # Held while mounting, so that concurrent launchers mount it once.
+    lock_fd = os.open(os.path.join(image_dir, '.lock'),
+                      os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        mount_point = _mount_point(image_dir, path)
+        if os.path.ismount(mount_point):
+            return mount_point
+
+        os.makedirs(mount_point, mode=0o755, exist_ok=True)
+        if can_mount_loop():
+            try:
+                _mount_loop(path, fstype, mount_point)
+            except PermissionError:
+                # The kernel can still refuse, as when CAP_SYS_ADMIN is only
+                # in a user namespace that doesn't own the mount namespace.
+                _mount_fuse(path, fstype, mount_point)
+        else:
+            _mount_fuse(path, fstype, mount_point)
+    finally:
+        os.close(lock_fd)
+
+    return mount_point
+
+
+def umount_image(path: str, image_dir: str) -> bool:
+    '''
+    Unmount the image at path if mount_image mounted it under image_dir, and
+    return whether it was. Containers still using it keep it until they exit.
+    '''
+    mount_point = _mount_point(image_dir, os.path.realpath(path))
+    if not os.path.ismount(mount_point):
+        return False
+
+    # Unmounted the way it was mounted, whatever this process can do now.
+    fstype = _mount_fstype(os.path.realpath(mount_point))
+    if fstype is not None and fstype.startswith('fuse'):
+        fusermount = shutil.which('fusermount3') or 'fusermount'
+        subprocess.run([fusermount, '-u', '-z', mount_point], check=True)
+    else:
+        libc.umount2(mount_point, libc.MNT_DETACH)
+    os.rmdir(mount_point)
+    return True
+
+
+def main() -> int:
+    # Imported here, since container imports this module.
+    from .container import default_image_dir
+
+    parser = argparse.ArgumentParser(
+            description='Mount and unmount the squashfs and erofs images used '
+                        'with --image')
+    parser.add_argument(
+            '--image-dir',
+            default=default_image_dir(),
+            help='where images are mounted (default: %(default)s)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    mount_parser = subparsers.add_parser(
+            'mount',
+            help='mount an image, if it is not already, and print where')
+    mount_parser.add_argument('image')
+    umount_parser = subparsers.add_parser(
+            'umount',
+            help='unmount an image')
+    umount_parser.add_argument('image')
+
+    args = parser.parse_args(sys.argv[1:])
+    if args.command == 'mount':
+        print(mount_image(args.image, args.image_dir))
+    elif not umount_image(args.image, args.image_dir):
+        print(f'{args.image} is not mounted', file=sys.stderr)
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
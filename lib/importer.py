@@ -0,0 +1,286 @@
+import argparse
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+import gzip
+import os
+import sys
+import tarfile
+import time
+from typing import IO, BinaryIO
+
+from . import libc
+from .container import read_subgids, read_subuids
+from .idmap import (IdExtent, build_id_map, id_map_args, map_id,
+                    run_in_userns)
+
+# Files bigger than this are written as they're read instead of being handed
+# to the thread pool, to bound memory use.
+_MAX_QUEUED_FILE = 8 << 20
+
+
+@dataclass
+class ImportStats:
+    files: int = 0
+    bytes: int = 0
+    skipped: int = 0
+    seconds: float = 0.0
+
+    def __str__(self) -> str:
+        seconds = max(self.seconds, 1e-9)
+        return (f'{self.files} files, {self.bytes / 1e6:.1f} MB in '
+                f'{self.seconds:.2f} s: {self.files / seconds:.0f} files/s, '
+                f'{self.bytes / 1e6 / seconds:.1f} MB/s '
+                f'({self.skipped} skipped)')
+
+
+def _write_file(path: str, data: bytes | IO[bytes], mode: int, uid: int,
+                gid: int, mtime: float) -> None:
+    # O_NOFOLLOW so a symlink from the archive can't redirect the write.
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW,
+                 0o600)
+    try:
+        if isinstance(data, bytes):
+            os.write(fd, data)
+        else:
+            with os.fdopen(os.dup(fd), 'wb') as f:
+                while chunk := data.read(1 << 20):
+                    f.write(chunk)
+        os.fchown(fd, uid, gid)
+        os.fchmod(fd, mode)
+        os.utime(fd, (mtime, mtime))
+    finally:
+        os.close(fd)
+
+
+def _member_path(dest: str, name: str) -> str | None:
+    # Keep everything under dest, ignoring leading slashes and refusing
+    # members that climb out with '..'.
+    name = os.path.normpath(name.lstrip('/'))
+    if name == '.' or name == '..' or name.startswith('../'):
+        return None
+
+    return os.path.join(dest, name)
+
+
+def _remove_existing(path: str) -> None:
+    try:
+        os.unlink(path)
+    except (FileNotFoundError, IsADirectoryError):
+        pass
+
+
+def _open_tar(archive: BinaryIO) -> tarfile.TarFile:
+    # An .apk is several gzip members one after another (signature, control
+    # data, then the package files), and tarfile only reads the first, so
+    # decompress gzip here. Each member holds a piece of tar, hence
+    # ignore_zeros for any end of archive blocks in between.
+    peek = getattr(archive, 'peek', None)
+    if peek is not None and peek(2)[:2] == b'\x1f\x8b':
+        return tarfile.open(fileobj=gzip.GzipFile(fileobj=archive, mode='rb'),
+                            mode='r|', ignore_zeros=True)
+
+    return tarfile.open(fileobj=archive, mode='r|*')
+
+
+def import_archive(
+        archive: BinaryIO,
+        dest: str,
+        shift_uid: Callable[[int], int] = lambda x: x,
+        shift_gid: Callable[[int], int] = lambda x: x,
+        workers: int = 8,
+        skip: Callable[[str], bool] = lambda name: False) -> ImportStats:
+    '''
+    Extract a tar archive (compressed or not) read from archive into dest,
+    writing file contents with a pool of worker threads. Owners are set to
+    shift_uid and shift_gid of the archive's ids, so a root can be written
+    with the ids a container's id maps give without a separate chown pass.
+    Members for which skip returns True are left out. Device nodes are
+    skipped since they can't be created in a user namespace.
+
+    Symlinks in the archive are created as they are, so dest should be '/'
+    after chrooting to the new root, as main does, unless the archive is
+    trusted.
+    '''
+    stats = ImportStats()
+    start = time.monotonic()
+    dirs: list[tuple[str, tarfile.TarInfo]] = []
+    known_dirs: set[str] = set()
+    # The most recent write of each path, so hard links wait for their target.
+    written: dict[str, Future[None]] = {}
+    pending: deque[Future[None]] = deque()
+
+    def make_parent(path: str) -> None:
+        parent = os.path.dirname(path)
+        if parent not in known_dirs:
+            os.makedirs(parent, exist_ok=True)
+            known_dirs.add(parent)
+
+    with ThreadPoolExecutor(workers) as executor, _open_tar(archive) as tar:
+        for member in tar:
+            path = _member_path(dest, member.name)
+            if path is None or skip(member.name):
+                stats.skipped += 1
+                continue
+
+            uid = shift_uid(member.uid)
+            gid = shift_gid(member.gid)
+            make_parent(path)
+
+            if member.isdir():
+                os.makedirs(path, 0o700, exist_ok=True)
+                known_dirs.add(path)
+                dirs.append((path, member))
+                continue
+
+            if path in written:
+                # The archive has this path twice, the later one wins.
+                written[path].result()
+
+            if member.isreg():
+                data = tar.extractfile(member)
+                assert data is not None
+                _remove_existing(path)
+                if member.size > _MAX_QUEUED_FILE:
+                    _write_file(path, data, member.mode, uid, gid,
+                                member.mtime)
+                    future: Future[None] = Future()
+                    future.set_result(None)
+                else:
+                    future = executor.submit(
+                            _write_file, path, data.read(), member.mode, uid,
+                            gid, member.mtime)
+                    pending.append(future)
+                written[path] = future
+                stats.files += 1
+                stats.bytes += member.size
+            elif member.issym():
+                _remove_existing(path)
+                os.symlink(member.linkname, path)
+                os.lchown(path, uid, gid)
+            elif member.islnk():
+                target = _member_path(dest, member.linkname)
+                if target is None:
+                    stats.skipped += 1
+                    continue
+                if target in written:
+                    written[target].result()
+                _remove_existing(path)
+                os.link(target, path)
+            elif member.isfifo():
+                _remove_existing(path)
+                os.mkfifo(path, member.mode)
+                os.chown(path, uid, gid)
+            else:
+                stats.skipped += 1
+
+            # Don't let reading get too far ahead of writing.
+            while len(pending) > workers * 4:
+                pending.popleft().result()
+
+        for future in pending:
+            future.result()
+
+    # Set directory modes last, deepest first, in case they aren't writable.
+    for path, member in reversed(dirs):
+        os.chown(path, shift_uid(member.uid), shift_gid(member.gid))
+        os.chmod(path, member.mode)
+        os.utime(path, (member.mtime, member.mtime))
+
+    stats.seconds = time.monotonic() - start
+    return stats
+
+
+def _is_apk_metadata(name: str) -> bool:
+    # .apk packages are tar archives with signature and metadata files such as
+    # .PKGINFO and .SIGN.RSA.* at the top level.
+    return '/' not in name.rstrip('/') and name.startswith('.')
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+            description='Import tar archives and .apk packages into a root '
+                        'file system')
+    parser.add_argument(
+            '--map-uid', '-m',
+            type=int,
+            default=1100,
+            help="uid to which the current user's uid is mapped, as used "
+                 "when running containers")
+    parser.add_argument(
+            '--map-gid', '-g',
+            type=int,
+            default=1100,
+            help="gid to which the current user's gid is mapped, as used "
+                 "when running containers")
+    parser.add_argument(
+            '--workers', '-j',
+            type=int,
+            default=8,
+            help='number of threads writing files')
+    parser.add_argument(
+            '--no-userns',
+            action='store_true',
+            help="don't use a user namespace, shift ids in this process "
+                 "instead (requires CAP_CHOWN and CAP_SYS_CHROOT)")
+    parser.add_argument(
+            'root',
+            help='directory to import into, created if needed')
+    parser.add_argument(
+            'archives',
+            nargs='+',
+            help='tar archives or .apk files to import')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    uid = os.geteuid()
+    gid = os.getegid()
+    uid_extents = build_id_map(read_subuids(uid), {args.map_uid: uid})
+    gid_extents = build_id_map(read_subgids(gid), {args.map_gid: gid})
+
+    def import_all(dest: str, shift_uid: Callable[[int], int],
+                   shift_gid: Callable[[int], int]) -> int:
+        total = ImportStats()
+        for archive, f in zip(args.archives, files):
+            skip = _is_apk_metadata if archive.endswith('.apk') else \
+                lambda name: False
+            stats = import_archive(f, dest, shift_uid, shift_gid,
+                                   args.workers, skip)
+            print(f'{archive}: {stats}')
+            total.files += stats.files
+            total.bytes += stats.bytes
+            total.skipped += stats.skipped
+            total.seconds += stats.seconds
+
+        if len(args.archives) > 1:
+            print(f'total: {total}')
+        return 0
+
+    os.makedirs(args.root, exist_ok=True)
+    # Open everything before chrooting.
+    files = [open(archive, 'rb') for archive in args.archives]
+
+    if args.no_userns:
+        def shift(extents: list[IdExtent]) -> Callable[[int], int]:
+            return lambda id_: map_id(extents, id_)
+
+        os.chroot(args.root)
+        return import_all('/', shift(uid_extents), shift(gid_extents))
+
+    def in_userns() -> int:
+        # In the user namespace the kernel does the shifting. Chroot, in a
+        # new mount namespace, so that symlinks in the archives resolve inside
+        # the root.
+        os.chroot(args.root)
+        return import_all('/', lambda x: x, lambda x: x)
+
+    return run_in_userns(
+            in_userns,
+            id_map_args(uid_extents),
+            id_map_args(gid_extents),
+            libc.CLONE_NEWNS)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+import os
+import signal
+from typing import NoReturn
+
+from . import libc
+from .supervisor import waitid_exitcode
+from .trace import LaunchTrace
+
+# Signals that are passed on to the command.
+FORWARD_SIGNALS = {
+        signal.SIGHUP,
+        signal.SIGINT,
+        signal.SIGQUIT,
+        signal.SIGTERM,
+        signal.SIGUSR1,
+        signal.SIGUSR2,
+        signal.SIGWINCH,
+}
+
+# Python ignores these, and ignored signals stay ignored across exec.
+_RESTORE_SIGNALS = (signal.SIGPIPE, signal.SIGXFSZ)
+
+
+def run_init(argv: list[str], env: dict[str, str],
+             trace: LaunchTrace | None = None) -> NoReturn:
+    '''
+    Run argv as the child of a minimal init, in place of exec'ing it
+    directly as PID 1 of the container's PID namespace. The init reaps every
+    child that exits, including orphans that get reparented to it, and
+    passes FORWARD_SIGNALS on to the command. Signals that the kernel sent,
+    such as a ^C from a terminal, already went to the command's process
+    group and aren't forwarded again.
+
+    The init exits with the command's exit code, or 128 plus the signal
+    number if it was killed by a signal, and the kernel then kills anything
+    left in the namespace.
+
+    Signals are taken synchronously with sigwaitinfo rather than with
+    handlers, so the init does nothing at all until a signal arrives, and
+    blocking them also gets them delivered to a PID 1 that has no handlers.
+    '''
+    waited = FORWARD_SIGNALS | {signal.SIGCHLD}
+    signal.pthread_sigmask(signal.SIG_BLOCK, waited)
+
+    # posix_spawn uses vfork, which is much cheaper than forking all of
+    # Python, and resets the command's signal mask and dispositions.
+    pid = os.posix_spawnp(argv[0], argv, env,
+                          setsigmask=(),
+                          setsigdef=(*waited, *_RESTORE_SIGNALS))
+    if trace:
+        trace.detach()
+
+    while True:
+        info = signal.sigwaitinfo(waited)
+        if info.si_signo != signal.SIGCHLD:
+            if info.si_code != libc.SI_KERNEL:
+                os.kill(pid, info.si_signo)
+            continue
+
+        # One SIGCHLD can stand for any number of exited children.
+        while True:
+            try:
+                result = os.waitid(os.P_ALL, 0, os.WEXITED | os.WNOHANG)
+            except ChildProcessError:
+                result = None
+            if result is None:
+                break
+
+            if result.si_pid == pid:
+                exitcode = waitid_exitcode(result)
+                os._exit(exitcode if exitcode >= 0 else 128 - exitcode)
@@ -1,15 +1,38 @@
 from ctypes import (
     CFUNCTYPE,
+    POINTER,
+    PyDLL,
+    Structure,
+    addressof,
     byref,
     c_char_p,
     c_int,
+    c_long,
+    c_size_t,
     c_ubyte,
     c_uint,
+    c_uint64,
     c_ulong,
     c_void_p,
     create_string_buffer,
+    pythonapi,
+    sizeof,
 )
-from mmap import mmap
+import itertools
+from mmap import (
+    MAP_ANONYMOUS,
+    MAP_PRIVATE,
+    MAP_SHARED,
+    PAGESIZE,
+    PROT_READ,
+    PROT_WRITE,
+    mmap,
+)
+import os
+from os import fsencode
+import signal
+import sys
+import traceback
 from typing import Any, Callable, cast
 
 from .common import get_os_error, load_lib
@@ -27,21 +50,129 @@ def unshare(flags: int) -> None:
         raise get_os_error()
 
 
+# Also new in os in Python 3.12.
+_libc.setns.argtypes = [c_int, c_int]
+_libc.setns.restype = c_int
+
+
+def setns(fd: int, nstype: int) -> None:
+    '''
+    Call setns(2). fd is either a /proc/PID/ns file, with nstype 0 or the
+    matching CLONE_NEW* flag, or a pidfd, with nstype any combination of
+    CLONE_NEW* flags to join all of those namespaces of the process at once.
+    '''
+    if _libc.setns(fd, nstype) < 0:
+        raise get_os_error()
+
+
+_libc.mmap.argtypes = [c_void_p, c_size_t, c_int, c_int, c_int, c_long]
+_libc.mmap.restype = c_void_p
+_libc.mprotect.argtypes = [c_void_p, c_size_t, c_int]
+_libc.mprotect.restype = c_int
+_libc.munmap.argtypes = [c_void_p, c_size_t]
+_libc.munmap.restype = c_int
+
+_MAP_FAILED = c_void_p(-1).value
+
+
+class StackPool:
+    '''
+    Stacks for clone, of at least size bytes each. Every stack is mapped with
+    MAP_STACK and has a PROT_NONE guard page below it, so an overflow faults
+    instead of running into other memory. Released stacks are kept for reuse
+    instead of being unmapped, and since they've already been touched they
+    don't take new page faults in the parent.
+
+    Without CLONE_VM the child runs on its own copy-on-write copy of the
+    stack, so the stack can be released as soon as clone returns, and clone
+    does that when given a size. With CLONE_VM the child uses the stack
+    itself, and it must not be released until the child has exited or
+    exec'd.
+    '''
+
+    def __init__(self, size: int) -> None:
+        # Round up to whole pages.
+        self.size = -(-size // PAGESIZE) * PAGESIZE
+        self._free: list[int] = []
+        self._mapped: list[int] = []
+
+    def _map(self) -> int:
+        length = PAGESIZE + self.size
+        base = _libc.mmap(None, length, PROT_READ | PROT_WRITE,
+                          MAP_PRIVATE | MAP_ANONYMOUS | MAP_STACK, -1, 0)
+        if base == _MAP_FAILED:
+            raise get_os_error()
+
+        if _libc.mprotect(base, PAGESIZE, PROT_NONE) < 0:
+            e = get_os_error()
+            _libc.munmap(base, length)
+            raise e
+
+        self._mapped.append(base)
+        return cast(int, base)
+
+    def acquire(self) -> c_void_p:
+        '''
+        Return a stack, as the pointer to its top that clone takes.
+        '''
+        base = self._free.pop() if self._free else self._map()
+        return c_void_p(base + PAGESIZE + self.size)
+
+    def release(self, stack: c_void_p) -> None:
+        assert stack.value is not None
+        self._free.append(stack.value - self.size - PAGESIZE)
+
+    def close(self) -> None:
+        '''
+        Unmap all stacks, which must not be in use.
+        '''
+        for base in self._mapped:
+            _libc.munmap(base, PAGESIZE + self.size)
+        self._mapped.clear()
+        self._free.clear()
+
+
+# Stack pools used by clone, by size.
+_stack_pools: dict[int, StackPool] = {}
+
 _child_func_type = CFUNCTYPE(c_int, c_void_p)
 _libc.clone.argtypes = [_child_func_type, c_void_p, c_int, c_void_p]
 _libc.clone.restype = c_int
 
+# Functions for clone to run in children, by a key that is passed to the child
+# as clone's arg. This lets a single trampoline serve every call, instead of
+# making a new ctypes callback each time.
+_child_fns: dict[int, Callable[[], int]] = {}
+_child_keys = itertools.count(1)
+
+
+def _run_child(key: int) -> int:
+    try:
+        return _child_fns[key]()
+    except BaseException:
+        traceback.print_exc()
+        # The child exits without Python's usual cleanup, so make sure the
+        # traceback gets out.
+        sys.stderr.flush()
+        return 1
+
+
+_trampoline = _child_func_type(_run_child)
+
 
 def clone(
         fn: Callable[[], int],
         stack_or_size: c_void_p | int,
         flags: int) -> int:
     '''
-    Call clone(2). fn is the function to call in the new process. stack_or_size
-    can be an int giving the size of the stack to create for the child process,
-    or a ctypes c_void_p wrapping the void* that will be passed directly to
-    clone(2) for the stack argument. flags is passed as the flags argument to
-    clone(2). The remaining arguments to clone(2) are not supported.
+    Call clone(2). fn is the function to call in the new process, and its
+    return value is the exit code of the child (1 if it raises).
+    stack_or_size can be an int giving the size of the stack for the child
+    process, or a ctypes c_void_p wrapping the void* that will be passed
+    directly to clone(2) for the stack argument. With a size, the stack comes
+    from a StackPool and is reused by later calls, which can't be done with
+    CLONE_VM. flags is passed as the flags argument to clone(2). The
+    remaining arguments to clone(2) are not supported.
 
     Note that fn does not take an argument, and clone also can't be provided
     the arg argument that would normally be passed to fn. Since this is
@@ -50,18 +181,27 @@ def clone(
 
     Returns the child PID on success, raises OSError on failure.
     '''
-
-    # wrap fn with a function that matches child_func_type, but just ignores
-    # the unused argument.
-    def fn_wrapper(_: None) -> int:
-        return fn()
-
+    pool = None
     if isinstance(stack_or_size, int):
-        stack: Any = byref(create_string_buffer(stack_or_size), stack_or_size)
+        if flags & CLONE_VM:
+            raise ValueError('clone needs an explicit stack with CLONE_VM')
+        pool = _stack_pools.get(stack_or_size)
+        if pool is None:
+            pool = _stack_pools[stack_or_size] = StackPool(stack_or_size)
+        stack = pool.acquire()
     else:
         stack = stack_or_size
 
-    res = _libc.clone(_child_func_type(fn_wrapper), stack, flags, None)
+    key = next(_child_keys)
+    _child_fns[key] = fn
+    try:
+        res = _libc.clone(_trampoline, stack, flags, key)
+    finally:
+        del _child_fns[key]
+        if pool is not None:
+            # The child has its own copy of the stack.
+            pool.release(stack)
+
     if res < 0:
         raise get_os_error()
 
@@ -69,6 +209,85 @@ def clone(
     return cast(int, res)
 
 
+class CloneArgs(Structure):
+    _fields_ = [
+        ('flags', c_uint64),
+        ('pidfd', c_uint64),
+        ('child_tid', c_uint64),
+        ('parent_tid', c_uint64),
+        ('exit_signal', c_uint64),
+        ('stack', c_uint64),
+        ('stack_size', c_uint64),
+        ('tls', c_uint64),
+        ('set_tid', c_uint64),
+        ('set_tid_size', c_uint64),
+        ('cgroup', c_uint64),
+    ]
+
+
+# A PyDLL doesn't release the GIL during calls, which clone3 needs in the same
+# way that fork does.
+_pylibc = PyDLL(_libc._name, use_errno=True)
+_pylibc.syscall.restype = c_long
+pythonapi.PyOS_BeforeFork.restype = None
+pythonapi.PyOS_AfterFork_Parent.restype = None
+pythonapi.PyOS_AfterFork_Child.restype = None
+
+
+def clone3(
+        fn: Callable[[], int],
+        flags: int,
+        cgroup_fd: int | None = None,
+        exit_signal: int = signal.SIGCHLD) -> tuple[int, int]:
+    '''
+    Call clone3(2) with CLONE_PIDFD added to flags, and run fn in the child,
+    which exits with fn's return value (or 1 if it raises). If cgroup_fd is
+    given, it's an fd for a cgroup v2 directory that the child is started in
+    with CLONE_INTO_CGROUP. exit_signal is sent to the parent when the child
+    exits, which for SIGCHLD (the default) means it can be waited for
+    normally.
+
+    Unlike clone, the child doesn't get a new stack. It carries on from a copy
+    of the parent like it would with fork, and Python's usual fork handling
+    is done in both processes. flags can't include CLONE_VM.
+
+    Returns the child PID and a pidfd for it, raises OSError on failure. The
+    pidfd is close-on-exec.
+    '''
+    if flags & CLONE_VM:
+        # The child would run on the parent's stack, in the same memory.
+        raise ValueError('clone3 does not support CLONE_VM')
+
+    pidfd = c_int(-1)
+    args = CloneArgs(flags=flags | CLONE_PIDFD, pidfd=addressof(pidfd),
+                     exit_signal=exit_signal)
+    if cgroup_fd is not None:
+        args.flags |= CLONE_INTO_CGROUP
+        args.cgroup = cgroup_fd
+
+    pythonapi.PyOS_BeforeFork()
+    res = _pylibc.syscall(SYS_clone3, byref(args), sizeof(args))
+    if res == 0:
+        pythonapi.PyOS_AfterFork_Child()
+        code = 1
+        try:
+            code = fn()
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            # os._exit skips Python's cleanup, so make sure any output gets
+            # out.
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    pythonapi.PyOS_AfterFork_Parent()
+    if res < 0:
+        raise get_os_error()
+
+    return cast(int, res), pidfd.value
+
+
 _libc.sem_init.argtypes = [c_void_p, c_int, c_uint]
 _libc.sem_init.restype = c_int
 
@@ -115,18 +334,121 @@ def sem_post(sem: c_void_p | mmap) -> None:
         raise get_os_error()
 
 
+class SemArray:
+    '''
+    A set of process-shared semaphores in a single anonymous shared mapping,
+    each initialized to value. Indexing gives a pointer to one semaphore that
+    can be passed to sem_wait and sem_post. The mapping stays valid for as long
+    as the SemArray is referenced.
+    '''
+
+    def __init__(self, count: int, value: int = 0) -> None:
+        self._mem = mmap(-1, SIZEOF_SEM_T * count, MAP_SHARED | MAP_ANONYMOUS)
+        base = addressof((c_ubyte * len(self._mem)).from_buffer(self._mem))
+        self._sems = [c_void_p(base + i * SIZEOF_SEM_T) for i in range(count)]
+        for sem in self._sems:
+            sem_init(sem, True, value)
+
+    def __getitem__(self, index: int) -> c_void_p:
+        return self._sems[index]
+
+    def __len__(self) -> int:
+        return len(self._sems)
+
+
+_libc.prctl.argtypes = [c_int, c_ulong, c_ulong, c_ulong, c_ulong]
+_libc.prctl.restype = c_int
+
+
+def set_pdeathsig(sig: int) -> None:
+    '''
+    Ask the kernel to send sig to the calling process when its parent exits.
+    '''
+    if _libc.prctl(PR_SET_PDEATHSIG, sig, 0, 0, 0) < 0:
+        raise get_os_error()
+
+
 _libc.mount.argtypes = [c_char_p, c_char_p, c_char_p, c_ulong, c_void_p]
 _libc.mount.restype = c_int
 
 
-def mount(source: str, target: str, filesystemtype: str, mountflags: int,
+def mount(source: str | bytes, target: str | bytes,
+          filesystemtype: str | bytes, mountflags: int,
           data: bytes | None = None) -> None:
     res = _libc.mount(
-            source.encode(),
-            target.encode(),
-            filesystemtype.encode(),
+            fsencode(source),
+            fsencode(target),
+            fsencode(filesystemtype),
             mountflags,
             data)
 
     if res < 0:
         raise get_os_error()
+
+
+_libc.umount2.argtypes = [c_char_p, c_int]
+_libc.umount2.restype = c_int
+
+
+def umount2(target: str | bytes, flags: int) -> None:
+    if _libc.umount2(fsencode(target), flags) < 0:
+        raise get_os_error()
+
+
+# The "new" mount API, see open_tree(2), move_mount(2) and mount_setattr(2).
+# Paths can be str or bytes. Use an empty path with AT_EMPTY_PATH or
+# MOVE_MOUNT_F_EMPTY_PATH to refer to the fd itself. glibc only has wrappers
+# for these from 2.36, so they go through syscall, and older kernels fail with
+# ENOSYS.
+
+_libc.syscall.restype = c_long
+
+
+def open_tree(dirfd: int, path: str | bytes, flags: int) -> int:
+    '''
+    Call open_tree(2). With OPEN_TREE_CLONE this makes a detached copy of the
+    mount at path (the whole tree below it as well with AT_RECURSIVE), which
+    can be changed with mount_setattr and then attached with move_mount.
+    Returns the new fd.
+    '''
+    res = _libc.syscall(SYS_open_tree, c_int(dirfd), c_char_p(fsencode(path)),
+                        c_uint(flags))
+    if res < 0:
+        raise get_os_error()
+
+    return cast(int, res)
+
+
+def move_mount(from_dirfd: int, from_path: str | bytes, to_dirfd: int,
+               to_path: str | bytes, flags: int) -> None:
+    res = _libc.syscall(SYS_move_mount, c_int(from_dirfd),
+                        c_char_p(fsencode(from_path)), c_int(to_dirfd),
+                        c_char_p(fsencode(to_path)), c_uint(flags))
+    if res < 0:
+        raise get_os_error()
+
+
+class MountAttr(Structure):
+    _fields_ = [
+        ('attr_set', c_uint64),
+        ('attr_clr', c_uint64),
+        ('propagation', c_uint64),
+        ('userns_fd', c_uint64),
+    ]
+
+
+def mount_setattr(dirfd: int, path: str | bytes, flags: int,
+                  attr_set: int = 0, attr_clr: int = 0, propagation: int = 0,
+                  userns_fd: int = 0) -> None:
+    '''
+    Call mount_setattr(2) with a struct mount_attr built from the keyword
+    arguments. attr_set and attr_clr take MOUNT_ATTR_* flags, propagation
+    takes MS_SHARED, MS_PRIVATE, etc. userns_fd is only used with
+    MOUNT_ATTR_IDMAP.
+    '''
+    attr = MountAttr(attr_set, attr_clr, propagation, userns_fd)
+    res = _libc.syscall(SYS_mount_setattr, c_int(dirfd),
+                        c_char_p(fsencode(path)), c_uint(flags), byref(attr),
+                        c_size_t(sizeof(attr)))
+    if res < 0:
+        raise get_os_error()
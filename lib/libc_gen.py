@@ -25,6 +25,14 @@ CLONE_UNTRACED = 0x00800000
 CLONE_VFORK = 0x00004000
 CLONE_VM = 0x00000100
 
+CLONE_CLEAR_SIGHAND = 0x0100000000
+CLONE_INTO_CGROUP = 0x0200000000
+
+SYS_clone3 = 435
+SYS_open_tree = 428
+SYS_move_mount = 429
+SYS_mount_setattr = 442
+
 MS_REMOUNT = 0x00000020
 MS_BIND = 0x00001000
 MS_SHARED = 0x00100000
@@ -47,5 +55,53 @@ MS_SILENT = 0x00008000
 MS_STRICTATIME = 0x01000000
 MS_SYNCHRONOUS = 0x00000010
 MS_NOSYMFOLLOW = 0x00000100
+MNT_DETACH = 0x00000002
+
+AT_FDCWD = -100
+AT_EMPTY_PATH = 0x00001000
+AT_RECURSIVE = 0x00008000
+OPEN_TREE_CLONE = 0x00000001
+OPEN_TREE_CLOEXEC = 0x00080000
+MOVE_MOUNT_F_EMPTY_PATH = 0x00000004
+MOUNT_ATTR_RDONLY = 0x00000001
+MOUNT_ATTR_NOSUID = 0x00000002
+MOUNT_ATTR_NODEV = 0x00000004
+MOUNT_ATTR_NOEXEC = 0x00000008
+MOUNT_ATTR__ATIME = 0x00000070
+MOUNT_ATTR_RELATIME = 0000000000
+MOUNT_ATTR_NOATIME = 0x00000010
+MOUNT_ATTR_STRICTATIME = 0x00000020
+MOUNT_ATTR_NODIRATIME = 0x00000080
+MOUNT_ATTR_IDMAP = 0x00100000
+MOUNT_ATTR_NOSYMFOLLOW = 0x00200000
+
+PR_SET_PDEATHSIG = 1
+
+CAP_EFFECTIVE = 0
+CAP_PERMITTED = 1
+CAP_INHERITABLE = 2
+CAP_SETGID = 6
+CAP_SETUID = 7
+CAP_SYS_ADMIN = 21
+
+MAP_STACK = 0x00020000
+PROT_NONE = 0
+
+FICLONE = 0x40049409
+SIOCGIFFLAGS = 0x00008913
+SIOCSIFFLAGS = 0x00008914
+LOOP_CTL_GET_FREE = 0x00004c82
+LOOP_CONFIGURE = 0x00004c0a
+
+IFF_UP = 0x00000001
+IFNAMSIZ = 16
+
+LO_FLAGS_READ_ONLY = 0x00000001
+LO_FLAGS_AUTOCLEAR = 0x00000004
+
+SI_KERNEL = 128
 
 SIZEOF_SEM_T = 32
+SIZEOF_IFREQ = 40
+SIZEOF_LOOP_CONFIG = 304
+LOOP_CONFIG_FLAGS_OFFSET = 60
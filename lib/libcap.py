@@ -43,6 +43,26 @@ def cap_to_text(caps: _cap_t) -> bytes:
     return res
 
 
+_libcap.cap_get_flag.argtypes = [
+        _cap_t,
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.POINTER(ctypes.c_int)]
+_libcap.cap_get_flag.restype = ctypes.c_int
+
+
+def cap_get_flag(caps: _cap_t, cap: int, flag: int) -> bool:
+    '''
+    Return True if capability cap is set in the flag set
+    (libc.CAP_EFFECTIVE, libc.CAP_PERMITTED or libc.CAP_INHERITABLE) of caps.
+    '''
+    value = ctypes.c_int()
+    if _libcap.cap_get_flag(caps, cap, flag, ctypes.byref(value)) < 0:
+        raise get_os_error()
+
+    return bool(value.value)
+
+
 _libcap.cap_free.argtypes = [ctypes.c_void_p]
 _libcap.cap_free.restype = ctypes.c_int
 
@@ -0,0 +1,114 @@
+import errno
+import os
+
+from . import libc
+
+# (source, target, type, flags) as passed to mount(2).
+Mount = tuple[bytes, bytes, bytes, int]
+
+
+def mount(source: str, target: str, filesystemtype: str,
+          mountflags: int) -> None:
+    '''
+    Like mount(2), with the added step of remounting read-only for bind mounts
+    with the MS_RDONLY flag, similar to what mount(8) does. mount(2) ignores
+    most other flags (MS_RDONLY included) when MS_BIND is present.
+    '''
+
+    libc.mount(source, target, filesystemtype, mountflags)
+
+    ro_bind = libc.MS_BIND | libc.MS_RDONLY
+    if mountflags & ro_bind == ro_bind:
+        libc.mount('', target, '',
+                   libc.MS_REMOUNT | libc.MS_BIND | libc.MS_RDONLY)
+
+
+# MS_* flags that have a MOUNT_ATTR_* equivalent for mount_setattr.
+_MOUNT_ATTRS = [
+        (libc.MS_RDONLY, libc.MOUNT_ATTR_RDONLY),
+        (libc.MS_NOSUID, libc.MOUNT_ATTR_NOSUID),
+        (libc.MS_NODEV, libc.MOUNT_ATTR_NODEV),
+        (libc.MS_NOEXEC, libc.MOUNT_ATTR_NOEXEC),
+]
+
+
+def _mount_attrs(mountflags: int) -> int:
+    attr_set = 0
+    for ms_flag, attr in _MOUNT_ATTRS:
+        if mountflags & ms_flag:
+            attr_set |= attr
+
+    return attr_set
+
+
+def clone_tree(source: str | bytes, mountflags: int) -> int:
+    '''
+    Return an fd for a detached copy of the mount at source, with the whole
+    tree below it if mountflags includes MS_REC. Raises OSError with ENOSYS if
+    the kernel doesn't have the new mount API.
+    '''
+    tree_flags = libc.OPEN_TREE_CLONE | libc.OPEN_TREE_CLOEXEC
+    if mountflags & libc.MS_REC:
+        tree_flags |= libc.AT_RECURSIVE
+
+    return libc.open_tree(libc.AT_FDCWD, source, tree_flags)
+
+
+def set_tree_attrs(fd: int, mountflags: int,
+                   userns_fd: int | None = None) -> None:
+    '''
+    Apply MS_RDONLY, MS_NOSUID, MS_NODEV and MS_NOEXEC from mountflags to a
+    tree from clone_tree with a single mount_setattr. If userns_fd is given
+    the tree is also idmapped with the id maps of that user namespace.
+    '''
+    attr_flags = libc.AT_EMPTY_PATH
+    if mountflags & libc.MS_REC:
+        attr_flags |= libc.AT_RECURSIVE
+
+    attr_set = _mount_attrs(mountflags)
+    if userns_fd is not None:
+        attr_set |= libc.MOUNT_ATTR_IDMAP
+
+    if attr_set:
+        libc.mount_setattr(fd, b'', attr_flags, attr_set=attr_set,
+                           userns_fd=userns_fd or 0)
+
+
+def attach_tree(fd: int, target: str | bytes) -> None:
+    libc.move_mount(fd, b'', libc.AT_FDCWD, target,
+                    libc.MOVE_MOUNT_F_EMPTY_PATH)
+
+
+def bind_mount(source: str | bytes, target: str | bytes,
+               mountflags: int) -> None:
+    '''
+    Bind mount source on target using the new mount API. The source is cloned
+    with open_tree (with the whole tree below it if mountflags includes
+    MS_REC), MS_RDONLY, MS_NOSUID, MS_NODEV and MS_NOEXEC are applied to the
+    detached copy with a single mount_setattr, and only then is it attached
+    with move_mount. Unlike the mount/remount pair, a read-only bind is never
+    visible read-write.
+
+    Falls back to mount if the kernel doesn't have the new API, or has
+    open_tree and move_mount (Linux 5.2) but not mount_setattr (5.12).
+    '''
+    try:
+        fd = clone_tree(source, mountflags)
+        try:
+            set_tree_attrs(fd, mountflags)
+            attach_tree(fd, target)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        if e.errno != errno.ENOSYS:
+            raise
+        mount(os.fsdecode(source), os.fsdecode(target), '',
+              libc.MS_BIND | mountflags)
+
+
+def do_mounts(mounts: list[Mount]) -> None:
+    for source, target, fstype, flags in mounts:
+        if flags & libc.MS_BIND:
+            bind_mount(source, target, flags)
+        else:
+            libc.mount(source, target, fstype, flags)
@@ -0,0 +1,430 @@
+import argparse
+from dataclasses import asdict, dataclass
+import json
+import os
+from pathlib import Path
+import select
+import signal
+import sys
+from typing import NoReturn
+
+from . import libc
+from .cgroup import Cgroup
+from .container import (
+        NAMESPACE_FLAGS,
+        Config,
+        VolumeTree,
+        add_arguments,
+        config_from_args,
+        default_state_dir,
+        idmap_volume_trees,
+        make_id_maps,
+        namespace_flags,
+        open_volume_trees,
+        plan_mounts,
+        read_subgids,
+        read_subuids,
+        setup_root,
+        switch_user,
+)
+from .idmap import apply_id_maps
+from .overlay import make_upper_dir, remove_upper_dir
+from .slices import default_allocator
+from .supervisor import process_start_time
+
+# Seconds rm waits for a holder to exit after killing it.
+_KILL_TIMEOUT = 5.0
+
+
+@dataclass
+class NamedContainer:
+    '''
+    A container whose namespaces are kept alive by a holder process, so that
+    any number of commands can be run in it with enter. pid and start_time
+    identify the holder. uid_maps and gid_maps are kept for removing the
+    overlay directory, if there is one. namespaces are the CLONE_NEW* flags
+    of the namespaces the holder was cloned into. id_slice is True if the
+    id maps are those of a slice leased to the holder (see lib/slices.py).
+    '''
+    name: str
+    pid: int
+    start_time: int
+    root: str | None
+    user: str | None
+    uid_maps: list[str]
+    gid_maps: list[str]
+    cgroup: str | None = None
+    upper_dir: str | None = None
+    namespaces: int = NAMESPACE_FLAGS
+    id_slice: bool = False
+
+    def config(self, user: str | None = None) -> Config:
+        '''
+        Return a Config with what enter needs: the root and the user, which
+        is user if that's given.
+        '''
+        return Config(root=self.root, user=user or self.user)
+
+
+def _state_path(state_dir: str, name: str) -> Path:
+    if not name or '/' in name or name.startswith('.'):
+        raise Exception(f'Invalid container name {name!r}')
+
+    return Path(state_dir) / f'{name}.json'
+
+
+def load(state_dir: str, name: str) -> NamedContainer:
+    '''
+    Return the saved state of the named container, or raise an Exception if
+    there is none.
+    '''
+    path = _state_path(state_dir, name)
+    try:
+        data = json.loads(path.read_text())
+    except FileNotFoundError:
+        raise Exception(f'No container named {name}') from None
+
+    return NamedContainer(**data)
+
+
+def _save(state_dir: str, container: NamedContainer) -> None:
+    path = _state_path(state_dir, container.name)
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}')
+    tmp.write_text(json.dumps(asdict(container)))
+    os.replace(tmp, path)
+
+
+def names(state_dir: str) -> list[str]:
+    '''
+    Return the names of the saved containers in state_dir.
+    '''
+    try:
+        return sorted(p.stem for p in Path(state_dir).glob('*.json'))
+    except FileNotFoundError:
+        return []
+
+
+def open_holder(container: NamedContainer) -> int | None:
+    '''
+    Return a pidfd for container's holder, or None if it has exited.
+    '''
+    try:
+        pidfd = os.pidfd_open(container.pid)
+    except ProcessLookupError:
+        return None
+
+    # Checked after opening the pidfd, so that it can't refer to some other
+    # process that got the same PID.
+    try:
+        alive = process_start_time(container.pid) == container.start_time
+    except FileNotFoundError:
+        alive = False
+
+    if not alive:
+        os.close(pidfd)
+        return None
+
+    return pidfd
+
+
+def _hold(ready_fd: int) -> NoReturn:
+    # Run as PID 1 of the container: reap whatever gets reparented here, and
+    # exit when asked to, which takes the namespaces with it.
+    waited = {signal.SIGCHLD, signal.SIGTERM, signal.SIGINT}
+    signal.pthread_sigmask(signal.SIG_BLOCK, waited)
+
+    os.setsid()
+    null = os.open('/dev/null', os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(null, fd)
+    os.close(null)
+
+    os.write(ready_fd, b'\0')
+    os.close(ready_fd)
+
+    while True:
+        info = signal.sigwaitinfo(waited)
+        if info.si_signo != signal.SIGCHLD:
+            os._exit(0)
+
+        while True:
+            try:
+                result = os.waitid(os.P_ALL, 0, os.WEXITED | os.WNOHANG)
+            except ChildProcessError:
+                result = None
+            if result is None:
+                break
+
+
+def create(state_dir: str, name: str, config: Config) -> NamedContainer:
+    '''
+    Set up a container from config, as for example07, but with a holder
+    process in place of the command, and save it under name in state_dir.
+    The namespaces, mounts and cgroup stay until remove is called.
+    '''
+    path = _state_path(state_dir, name)
+    os.makedirs(state_dir, mode=0o700, exist_ok=True)
+    if path.exists():
+        container = load(state_dir, name)
+        pidfd = open_holder(container)
+        if pidfd is not None:
+            os.close(pidfd)
+            raise Exception(f'Container {name} already exists')
+        _cleanup(state_dir, container)
+
+    uid = os.geteuid()
+    gid = os.getegid()
+    # With id_slice the maps come from the slice leased to the holder.
+    uid_maps: list[str] = []
+    gid_maps: list[str] = []
+    if not config.id_slice:
+        uid_maps = make_id_maps(read_subuids(uid), config.map_uid, uid)
+        gid_maps = make_id_maps(read_subgids(gid), config.map_gid, gid)
+    mounts = plan_mounts(config)
+    sems = libc.SemArray(1)
+
+    trees: list[VolumeTree] = []
+    upper_dir = None
+    cgroup = None
+    pidfd = None
+    released = False
+    read_fd, write_fd = os.pipe()
+    try:
+        trees = open_volume_trees(config)
+        if config.overlay:
+            upper_dir = make_upper_dir(config.overlay)
+        if config.cgroup:
+            cgroup = Cgroup.create(config.cgroup)
+
+        def child() -> int:
+            os.close(read_fd)
+            libc.sem_wait(sems[0])
+            setup_root(config, mounts, upper_dir, trees)
+            _hold(write_fd)
+
+        cgroup_fd = cgroup.open_fd() if cgroup else None
+        try:
+            pid, pidfd = libc.clone3(child, namespace_flags(config), cgroup_fd)
+        finally:
+            if cgroup_fd is not None:
+                os.close(cgroup_fd)
+            os.close(write_fd)
+            write_fd = -1
+
+        if config.id_slice:
+            # Leased to the holder, so it's freed once the holder is gone.
+            uid_maps, gid_maps = default_allocator().lease(pid).id_maps(
+                    config.map_uid, config.map_gid)
+        apply_id_maps(pid, uid_maps, gid_maps)
+        # idmap_volume_trees closes the fds whatever happens.
+        opened, trees = trees, []
+        idmap_volume_trees(opened, pid)
+        released = True
+        libc.sem_post(sems[0])
+
+        # The holder writes a byte once it's set up, or exits without one.
+        if os.read(read_fd, 1) != b'\0':
+            raise Exception(f'Container {name} failed to set up')
+
+        container = NamedContainer(
+                name, pid, process_start_time(pid), config.root, config.user,
+                uid_maps, gid_maps, cgroup.path if cgroup else None,
+                upper_dir, namespace_flags(config), config.id_slice)
+        _save(state_dir, container)
+    except BaseException:
+        # Undo everything, as a one-shot container's launcher does once it
+        # exits. The holder has to be gone before its cgroup, upper dir and
+        # id slice can go.
+        for fd, _, _ in trees:
+            os.close(fd)
+        if pidfd is not None:
+            signal.pidfd_send_signal(pidfd, signal.SIGKILL)
+            os.waitid(os.P_PIDFD, pidfd, os.WEXITED)
+        if cgroup:
+            cgroup.remove()
+        if upper_dir and not released:
+            # The holder never got to it, and with id_slice there may be no
+            # maps to remove it with.
+            os.rmdir(upper_dir)
+        elif upper_dir:
+            remove_upper_dir(upper_dir, uid_maps, gid_maps)
+        if pidfd is not None and config.id_slice:
+            default_allocator().reclaim()
+        raise
+    finally:
+        os.close(read_fd)
+        if write_fd >= 0:
+            os.close(write_fd)
+        if pidfd is not None:
+            os.close(pidfd)
+
+    return container
+
+
+def enter(container: NamedContainer, argv: list[str],
+          user: str | None = None) -> int:
+    '''
+    Run argv in container as its user, or as user if that's given, and
+    return its exit code in the form used by os.waitstatus_to_exitcode. This
+    process joins the container's namespaces with a single setns on the
+    holder's pidfd and chroots to the holder's root, so there are no id maps
+    or mounts to set up, and only the command is cloned. It's left in those
+    namespaces, so call it last.
+    '''
+    pidfd = open_holder(container)
+    if pidfd is None:
+        raise Exception(f'Container {container.name} is not running')
+
+    cgroup_fd = None
+    try:
+        # Opened before joining the user namespace, which takes away access
+        # to the holder's /proc files and to the host's cgroups.
+        root_fd = os.open(f'/proc/{container.pid}/root',
+                          os.O_PATH | os.O_DIRECTORY | os.O_CLOEXEC)
+        if container.cgroup:
+            cgroup_fd = Cgroup(container.cgroup).open_fd()
+
+        libc.setns(pidfd, container.namespaces)
+        os.fchdir(root_fd)
+        os.chroot('.')
+        os.close(root_fd)
+    finally:
+        os.close(pidfd)
+
+    config = container.config(user)
+
+    def child() -> int:
+        env = switch_user(config)
+        os.execvpe(argv[0], argv, env)
+
+    # Joining a PID namespace only applies to children, so the command is
+    # cloned even though the rest of the setup is done.
+    try:
+        _, child_pidfd = libc.clone3(child, 0, cgroup_fd)
+    finally:
+        if cgroup_fd is not None:
+            os.close(cgroup_fd)
+
+    try:
+        result = os.waitid(os.P_PIDFD, child_pidfd, os.WEXITED)
+    finally:
+        os.close(child_pidfd)
+
+    assert result is not None
+    if result.si_code == os.CLD_EXITED:
+        return result.si_status
+
+    return -result.si_status
+
+
+def _cleanup(state_dir: str, container: NamedContainer) -> None:
+    if container.cgroup:
+        Cgroup(container.cgroup).remove()
+
+    if container.upper_dir:
+        remove_upper_dir(container.upper_dir, container.uid_maps,
+                         container.gid_maps)
+
+    if container.id_slice:
+        # The holder has exited, which makes its slice free to take back.
+        default_allocator().reclaim()
+
+    _state_path(state_dir, container.name).unlink(missing_ok=True)
+
+
+def remove(state_dir: str, name: str) -> None:
+    '''
+    Kill the named container's holder, which ends everything in it, and
+    remove its cgroup, overlay directory and saved state.
+    '''
+    container = load(state_dir, name)
+    pidfd = open_holder(container)
+    if pidfd is not None:
+        try:
+            signal.pidfd_send_signal(pidfd, signal.SIGKILL)
+            # The holder isn't a child of this process, so it can't be
+            # waited for, but its pidfd becomes readable when it exits.
+            readable, _, _ = select.select([pidfd], [], [], _KILL_TIMEOUT)
+            if not readable:
+                raise Exception(f'Container {name} did not exit')
+        finally:
+            os.close(pidfd)
+
+    _cleanup(state_dir, container)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+            description='Keep containers running by name and run commands '
+                        'in them')
+    parser.add_argument(
+            '--state-dir',
+            default=default_state_dir(),
+            metavar='DIR',
+            help='where to keep the state of named containers (default: '
+                 '%(default)s)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    create_parser = subparsers.add_parser(
+            'create',
+            help='set up a named container')
+    add_arguments(create_parser)
+    create_parser.add_argument('name')
+
+    exec_parser = subparsers.add_parser(
+            'exec',
+            help='run a command in a named container')
+    exec_parser.add_argument(
+            '--user', '-u',
+            help='run as this user (by name or UID) instead of the '
+                 "container's user")
+    exec_parser.add_argument('name')
+    exec_parser.add_argument(
+            'cmd',
+            nargs='+',
+            help='command (and arguments) to run')
+
+    rm_parser = subparsers.add_parser(
+            'rm',
+            help='stop and remove a named container')
+    rm_parser.add_argument('name')
+
+    subparsers.add_parser(
+            'ls',
+            help='list named containers')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.command == 'create':
+        config = config_from_args(create_parser, args)
+        if config.init:
+            create_parser.error('--init is not used with named containers')
+        if config.net == 'slirp':
+            create_parser.error('--net slirp is not supported for named '
+                                'containers')
+        container = create(args.state_dir, args.name, config)
+        print(container.pid)
+    elif args.command == 'exec':
+        exitcode = enter(load(args.state_dir, args.name), args.cmd,
+                         args.user)
+        if exitcode < 0:
+            print(f'child process exited with signal {-exitcode}',
+                  file=sys.stderr)
+            return 1
+        return exitcode
+    elif args.command == 'rm':
+        remove(args.state_dir, args.name)
+    else:
+        for name in names(args.state_dir):
+            container = load(args.state_dir, name)
+            pidfd = open_holder(container)
+            if pidfd is not None:
+                os.close(pidfd)
+            status = 'running' if pidfd is not None else 'exited'
+            print(f'{name}\t{container.pid}\t{status}\t{container.root}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
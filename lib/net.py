@@ -0,0 +1,175 @@
+import asyncio
+import fcntl
+import os
+import shutil
+import socket
+import struct
+import subprocess
+
+from . import libc
+
+# MTU for the tap device slirp4netns makes. Bigger than the usual 1500 means
+# fewer packets through the userspace stack, and much better throughput.
+_SLIRP_MTU = 65520
+
+
+def _ifreq(name: bytes, flags: int) -> bytes:
+    # struct ifreq with ifr_flags set, padded to its full size since the
+    # kernel copies all of it.
+    packed = struct.pack(f'{libc.IFNAMSIZ}sh', name, flags)
+    return packed.ljust(libc.SIZEOF_IFREQ, b'\0')
+
+
+def bring_up_loopback() -> None:
+    '''
+    Set the loopback interface of this process's network namespace up. In a
+    new network namespace lo is the only interface, and it starts out down.
+    '''
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        result = fcntl.ioctl(sock, libc.SIOCGIFFLAGS, _ifreq(b'lo', 0))
+        _, flags = struct.unpack_from(f'{libc.IFNAMSIZ}sh', result)
+        fcntl.ioctl(sock, libc.SIOCSIFFLAGS,
+                    _ifreq(b'lo', flags | libc.IFF_UP))
+
+
+class NetBackend:
+    '''
+    How a container gets its network. If netns is True the container is
+    cloned into a new network namespace, and brings up its loopback
+    interface itself while it sets up. start is called in the parent once
+    the child's id maps are written and before it's released, and stop once
+    it has exited. Backends that need to do more than the loopback
+    interface, like connecting the namespace to the outside, do it there.
+    '''
+    name = ''
+    netns = True
+
+    def start(self, pid: int) -> None:
+        pass
+
+    async def start_async(self, pid: int) -> None:
+        '''
+        Like start, but lets other asyncio tasks run while it waits.
+        '''
+        self.start(pid)
+
+    def stop(self) -> None:
+        pass
+
+
+class HostNet(NetBackend):
+    '''
+    Share the host's network namespace, as the examples always have.
+    '''
+    name = 'host'
+    netns = False
+
+
+class LoopbackNet(NetBackend):
+    '''
+    A network namespace with only the loopback interface, for jobs that
+    need no network. Nothing runs outside the container.
+    '''
+    name = 'loopback'
+
+
+class SlirpNet(NetBackend):
+    '''
+    A network namespace connected to the outside through slirp4netns, a
+    userspace TCP/IP stack that needs no privileges. It makes a tap0
+    interface in the namespace with the usual slirp addresses
+    (10.0.2.100, with 10.0.2.2 as the gateway and 10.0.2.3 for DNS).
+    slirp4netns exits when stop is called, or when this process exits
+    without calling it.
+    '''
+    name = 'slirp'
+
+    def __init__(self) -> None:
+        # Checked here, so that it fails before the container is cloned.
+        if shutil.which('slirp4netns') is None:
+            raise Exception('--net slirp needs slirp4netns to be installed')
+
+        self._proc: subprocess.Popen[bytes] | None = None
+        self._exit_fd = -1
+
+    def _command(self, pid: int, ready_fd: int,
+                 exit_fd: int) -> list[str]:
+        return ['slirp4netns', '--configure', f'--mtu={_SLIRP_MTU}',
+                '--disable-host-loopback', f'--ready-fd={ready_fd}',
+                f'--exit-fd={exit_fd}', str(pid), 'tap0']
+
+    def _spawn(self, pid: int) -> int:
+        # Returns the fd that slirp4netns writes to once it's ready. It exits
+        # when the other pipe is closed, which happens in stop, or when
+        # this process exits.
+        ready_r, ready_w = os.pipe()
+        exit_r, self._exit_fd = os.pipe()
+        try:
+            self._proc = subprocess.Popen(
+                    self._command(pid, ready_w, exit_r),
+                    pass_fds=(ready_w, exit_r))
+        except BaseException:
+            os.close(ready_r)
+            os.close(self._exit_fd)
+            self._exit_fd = -1
+            raise
+        finally:
+            os.close(ready_w)
+            os.close(exit_r)
+
+        return ready_r
+
+    def _check_ready(self, ready: bytes) -> None:
+        if ready != b'1':
+            self.stop()
+            raise Exception('slirp4netns failed to set up the network')
+
+    def start(self, pid: int) -> None:
+        ready_r = self._spawn(pid)
+        try:
+            ready = os.read(ready_r, 1)
+        finally:
+            os.close(ready_r)
+        self._check_ready(ready)
+
+    async def start_async(self, pid: int) -> None:
+        ready_r = self._spawn(pid)
+        loop = asyncio.get_running_loop()
+        readable: asyncio.Future[None] = loop.create_future()
+
+        def wake() -> None:
+            if not readable.done():
+                readable.set_result(None)
+
+        loop.add_reader(ready_r, wake)
+        try:
+            await readable
+            ready = os.read(ready_r, 1)
+        finally:
+            loop.remove_reader(ready_r)
+            os.close(ready_r)
+        self._check_ready(ready)
+
+    def stop(self) -> None:
+        if self._exit_fd >= 0:
+            os.close(self._exit_fd)
+            self._exit_fd = -1
+        if self._proc is not None:
+            self._proc.wait()
+            self._proc = None
+
+
+# Backends by the name used for --net.
+BACKENDS: dict[str, type[NetBackend]] = {
+        backend.name: backend for backend in (HostNet, LoopbackNet, SlirpNet)
+}
+
+
+def make_backend(name: str) -> NetBackend:
+    '''
+    Return a new instance of the backend called name.
+    '''
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise Exception(f'Unknown network mode {name}') from None
@@ -0,0 +1,99 @@
+from dataclasses import dataclass
+import os
+import shutil
+import tempfile
+
+from . import libc
+from .idmap import run_in_userns, run_in_userns_async
+
+
+@dataclass
+class Overlay:
+    '''
+    Settings for running a container on an overlay over its root, so the root
+    itself is never written. If upper_base is None the upper and work
+    directories are on a tmpfs inside the container, and go away with it.
+    Otherwise each container gets its own directory under upper_base, which
+    is removed when the container exits unless keep is True.
+    '''
+    upper_base: str | None = None
+    keep: bool = False
+
+
+def make_upper_dir(overlay: Overlay) -> str | None:
+    '''
+    Create the directory for one container's upper and work directories, if
+    overlay uses a directory on disk. Call this in the parent before cloning.
+    '''
+    if overlay.upper_base is None:
+        return None
+
+    os.makedirs(overlay.upper_base, exist_ok=True)
+    return tempfile.mkdtemp(prefix='overlay-', dir=overlay.upper_base)
+
+
+def mount_overlay(root: str, upper_dir: str | None) -> None:
+    '''
+    Mount an overlay on root with root as the lower layer, in the child after
+    its id maps are set and before anything else is mounted under root.
+    upper_dir is the result of make_upper_dir.
+    '''
+    # Keep a handle on the lower directory, since it may be covered by the
+    # tmpfs before the overlay is mounted.
+    lower_fd = os.open(root, os.O_PATH | os.O_DIRECTORY)
+    try:
+        if upper_dir is None:
+            libc.mount('tmpfs', root, 'tmpfs', 0, b'mode=755')
+            upper_dir = root
+
+        upper = os.path.join(upper_dir, 'upper')
+        work = os.path.join(upper_dir, 'work')
+        os.mkdir(upper, 0o755)
+        os.mkdir(work, 0o700)
+
+        # userxattr is needed to mount overlayfs in a user namespace.
+        options = (f'lowerdir=/proc/self/fd/{lower_fd},upperdir={upper},'
+                   f'workdir={work},userxattr')
+        libc.mount('overlay', root, 'overlay', 0, options.encode())
+    finally:
+        os.close(lower_fd)
+
+
+def _rmtree(path: str) -> None:
+    # Something else, such as gc, may be removing the same directory.
+    def ignore_missing(function: object, path: str,
+                       exc_info: tuple[type[BaseException], BaseException,
+                                       object]) -> None:
+        if not isinstance(exc_info[1], FileNotFoundError):
+            raise exc_info[1]
+
+    shutil.rmtree(path, onerror=ignore_missing)
+
+
+def remove_upper_dir(upper_dir: str, uid_maps: list[str],
+                     gid_maps: list[str]) -> None:
+    '''
+    Remove a directory made by make_upper_dir. Files in it can belong to any
+    id in the container, so this is done from a child in a user namespace with
+    the container's id maps, where all of them can be removed.
+    '''
+    def remove() -> int:
+        _rmtree(upper_dir)
+        return 0
+
+    if run_in_userns(remove, uid_maps, gid_maps) != 0:
+        raise Exception(f'Failed removing overlay directory {upper_dir}')
+
+
+async def remove_upper_dir_async(upper_dir: str, uid_maps: list[str],
+                                 gid_maps: list[str]) -> None:
+    '''
+    Like remove_upper_dir, but lets other asyncio tasks run while the child
+    removes the directory.
+    '''
+    def remove() -> int:
+        _rmtree(upper_dir)
+        return 0
+
+    if await run_in_userns_async(remove, uid_maps, gid_maps) != 0:
+        raise Exception(f'Failed removing overlay directory {upper_dir}')
@@ -0,0 +1,581 @@
+import argparse
+from collections import deque
+from collections.abc import Callable
+from dataclasses import dataclass, field
+import json
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import time
+from typing import Any
+
+from . import libc
+from .cgroup import Cgroup
+from .container import (
+        Config,
+        VolumeTree,
+        add_arguments,
+        config_from_args,
+        idmap_volume_trees,
+        make_id_maps,
+        namespace_flags,
+        open_volume_trees,
+        plan_mounts,
+        read_subgids,
+        read_subuids,
+        setup_child,
+)
+from .idmap import (
+        can_write_id_maps,
+        check_id_map_helpers,
+        start_id_map_helpers,
+        write_id_map,
+)
+from .init import run_init
+from .mounts import Mount
+from .overlay import make_upper_dir, remove_upper_dir
+from .supervisor import Exited, Supervisor
+
+# Upper limit on the size of a single request or reply. Requests carry argv and
+# env as JSON, so this only needs to be as big as a large environment.
+_MAX_MESSAGE = 1 << 20
+
+# Indexes into the semaphores shared with each warm child.
+_SEM_ID_MAPS = 0
+_SEM_LAUNCH = 1
+
+# Seconds refill waits after a child fails to set up, doubling with each
+# failure in a row up to the maximum.
+_BACKOFF_MIN = 0.1
+_BACKOFF_MAX = 30.0
+
+
+@dataclass
+class WarmChild:
+    '''
+    A cloned child that is waiting for its id maps, or has been given them
+    and is setting up, or has set up, its mounts, chroot and user. It is
+    parked in sem_wait until a command is handed to it with start. Its pidfd
+    is held by the pool's supervisor, as are those of helpers, the
+    newuidmap and newgidmap processes writing its id maps.
+    '''
+    pid: int
+    sock: socket.socket
+    sems: libc.SemArray
+    upper_dir: str | None = None
+    cgroup: Cgroup | None = None
+    trees: list[VolumeTree] = field(default_factory=list)
+    helpers: list[subprocess.Popen[bytes]] = field(default_factory=list)
+
+    def start(self, argv: list[str], env: dict[str, str],
+              fds: list[int]) -> None:
+        '''
+        Send the command, extra environment variables, and the fds to use as
+        stdin, stdout and stderr to the child, then release it.
+        '''
+        msg = json.dumps({'argv': argv, 'env': env}).encode()
+        socket.send_fds(self.sock, [msg], fds)
+        libc.sem_post(self.sems[_SEM_LAUNCH])
+
+    def close(self) -> None:
+        self.sock.close()
+        for fd, _, _ in self.trees:
+            os.close(fd)
+        self.trees = []
+
+
+def _warm_child(config: Config, mounts: list[Mount], upper_dir: str | None,
+                trees: list[VolumeTree], sock: socket.socket,
+                sems: libc.SemArray) -> int:
+    # Wait for parent to set up uidmap and gidmap.
+    libc.sem_wait(sems[_SEM_ID_MAPS])
+
+    env = setup_child(config, mounts, upper_dir, trees)
+
+    # Don't sit around forever if the pool goes away. This has to come after
+    # setup_child because changing credentials clears it.
+    libc.set_pdeathsig(signal.SIGKILL)
+
+    libc.sem_wait(sems[_SEM_LAUNCH])
+
+    msg, fds, _, _ = socket.recv_fds(sock, _MAX_MESSAGE, 3)
+    request = json.loads(msg)
+
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+
+    env.update(request['env'])
+    argv: list[str] = request['argv']
+
+    if config.init:
+        run_init(argv, env)
+    os.execvpe(argv[0], argv, env)
+
+
+class Pool:
+    '''
+    Keeps up to max_idle children cloned with their namespaces, id maps,
+    mounts and user already set up, so that launching a command only has to
+    hand it to a waiting child. Every child, idle or running a command, is
+    in supervisor until it has exited, and the results of supervisor.wait
+    go to handle_exit.
+
+    Nothing here waits for a child's setup: refill clones a child and starts
+    its id maps, and the child moves from starting to idle once
+    handle_exit has seen the id map helpers finish. Children that die before
+    they are used make refill back off, up to _BACKOFF_MAX seconds between
+    attempts, so a broken config doesn't clone children as fast as it can.
+    '''
+
+    def __init__(self, config: Config, max_idle: int) -> None:
+        self.config = config
+        self.max_idle = max_idle
+        self.idle: deque[WarmChild] = deque()
+        self.starting: dict[int, WarmChild] = {}
+        self.supervisor: Supervisor[WarmChild] = Supervisor()
+
+        uid = os.geteuid()
+        gid = os.getegid()
+        self._uid_maps = make_id_maps(read_subuids(uid), config.map_uid, uid)
+        self._gid_maps = make_id_maps(read_subgids(gid), config.map_gid, gid)
+        self._direct_id_maps = can_write_id_maps()
+        self._mounts = plan_mounts(config)
+
+        self._failures = 0
+        self._next_spawn = 0.0
+        self._closing = False
+
+    def needs_refill(self) -> bool:
+        return len(self.idle) + len(self.starting) < self.max_idle
+
+    def refill_delay(self) -> float:
+        '''
+        Return how long refill will hold off spawning after failures, or 0 if
+        it won't.
+        '''
+        return max(self._next_spawn - time.monotonic(), 0.0)
+
+    def spawn(self) -> WarmChild:
+        '''
+        Clone a new child and start its id maps. The child is added to
+        starting, or to idle if the id maps could be written directly.
+        '''
+        parent_sock, child_sock = socket.socketpair(
+                socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        child = WarmChild(0, parent_sock, libc.SemArray(2))
+        cgroup_fd = None
+        try:
+            if self.config.overlay:
+                child.upper_dir = make_upper_dir(self.config.overlay)
+            child.trees = open_volume_trees(self.config)
+            if self.config.cgroup:
+                child.cgroup = Cgroup.create(self.config.cgroup)
+                cgroup_fd = child.cgroup.open_fd()
+
+            # clone3 gives a pidfd for the child, with no window in which its
+            # PID could be reused, and starts it in its cgroup. Interrupting
+            # the pool with ^C also signals the children in its process group,
+            # and with CLONE_CLEAR_SIGHAND, parked children just go away
+            # quietly.
+            trees = child.trees
+            child.pid, pidfd = libc.clone3(
+                    lambda: _warm_child(self.config, self._mounts,
+                                        child.upper_dir, trees, child_sock,
+                                        child.sems),
+                    namespace_flags(self.config) | libc.CLONE_CLEAR_SIGHAND,
+                    cgroup_fd)
+        except BaseException:
+            self.release(child)
+            raise
+        finally:
+            child_sock.close()
+            if cgroup_fd is not None:
+                os.close(cgroup_fd)
+
+        self.supervisor.add(child.pid, pidfd, child)
+        self.starting[child.pid] = child
+
+        try:
+            if self._direct_id_maps:
+                write_id_map(f'/proc/{child.pid}/uid_map', self._uid_maps)
+                write_id_map(f'/proc/{child.pid}/gid_map', self._gid_maps)
+                self._id_maps_done(child)
+            else:
+                child.helpers = start_id_map_helpers(
+                        child.pid, self._uid_maps, self._gid_maps)
+                for proc in child.helpers:
+                    self.supervisor.add(proc.pid, os.pidfd_open(proc.pid),
+                                        child)
+        except BaseException:
+            # The caller counts the failure, so handle_exit shouldn't.
+            self.starting.pop(child.pid, None)
+            self.supervisor.send_signal(child.pid, signal.SIGKILL)
+            raise
+
+        return child
+
+    def _id_maps_done(self, child: WarmChild) -> None:
+        idmap_volume_trees(child.trees, child.pid)
+        child.trees = []
+        libc.sem_post(child.sems[_SEM_ID_MAPS])
+
+        del self.starting[child.pid]
+        self.idle.append(child)
+
+    def refill(self) -> None:
+        '''
+        Spawn a child if the pool is short of them and isn't backing off.
+        Errors are reported and count as failures for the back off.
+        '''
+        if not self.needs_refill() or self.refill_delay() > 0:
+            return
+
+        try:
+            self.spawn()
+        except Exception as e:
+            self._setup_failed(f'Could not start a warm child: {e}')
+
+    def _setup_failed(self, reason: str) -> None:
+        if self._closing:
+            return
+
+        self._failures += 1
+        delay = min(_BACKOFF_MIN * 2 ** (self._failures - 1), _BACKOFF_MAX)
+        self._next_spawn = time.monotonic() + delay
+        print(f'{reason}, starting the next one in {delay:.1f}s',
+              file=sys.stderr)
+
+    def take(self) -> WarmChild | None:
+        '''
+        Return a warm child, or None if none are idle.
+        '''
+        if self.idle:
+            return self.idle.popleft()
+
+        return None
+
+    def launch(self, child: WarmChild, argv: list[str], env: dict[str, str],
+               fds: list[int]) -> None:
+        '''
+        Start a command in child, from take. Raises OSError if the child has
+        died, in which case it's killed if need be and left to handle_exit.
+        '''
+        try:
+            child.start(argv, env, fds)
+        except OSError:
+            self.supervisor.send_signal(child.pid, signal.SIGKILL)
+            raise
+
+        self._failures = 0
+        self._next_spawn = 0.0
+
+    def handle_exit(self, exited: Exited[WarmChild]) -> None:
+        '''
+        Handle a process from supervisor.wait: either a child, which is
+        released, or one of a starting child's id map helpers.
+        '''
+        child = exited.data
+        if exited.pid != child.pid:
+            self._helper_exited(child, exited)
+            return
+
+        if child.pid in self.starting or child in self.idle:
+            self._setup_failed(f'Warm child {child.pid} exited with '
+                               f'{exited.exitcode} before it was used')
+        self.release(child)
+
+    def _helper_exited(self, child: WarmChild,
+                       exited: Exited[WarmChild]) -> None:
+        for proc in child.helpers:
+            if proc.pid == exited.pid:
+                # Reaped by the supervisor rather than by proc.wait.
+                proc.returncode = exited.exitcode
+
+        if any(proc.returncode is None for proc in child.helpers):
+            return
+        if child.pid not in self.starting:
+            # The child went away first.
+            return
+
+        try:
+            check_id_map_helpers(child.helpers)
+            self._id_maps_done(child)
+        except Exception as e:
+            print(f'Could not set up warm child {child.pid}: {e}',
+                  file=sys.stderr)
+            self.supervisor.send_signal(child.pid, signal.SIGKILL)
+
+    def release(self, child: WarmChild) -> None:
+        '''
+        Clean up after a child that has exited and been returned by the
+        supervisor.
+        '''
+        if child in self.idle:
+            self.idle.remove(child)
+        self.starting.pop(child.pid, None)
+
+        child.close()
+
+        if child.cgroup:
+            child.cgroup.remove()
+
+        overlay = self.config.overlay
+        if overlay and child.upper_dir is not None and not overlay.keep:
+            remove_upper_dir(child.upper_dir, self._uid_maps, self._gid_maps)
+
+    def close(self) -> None:
+        self._closing = True
+        for child in [*self.idle, *self.starting.values()]:
+            self.supervisor.send_signal(child.pid, signal.SIGKILL)
+        while self.idle or self.starting:
+            for exited in self.supervisor.wait():
+                self.handle_exit(exited)
+
+        # Children still running commands die with the pool, by their
+        # parent death signal.
+        self.supervisor.close()
+
+
+@dataclass
+class _Request:
+    conn: socket.socket
+    argv: list[str]
+    env: dict[str, str]
+    fds: list[int]
+
+
+def _parse_request(msg: bytes) -> tuple[list[str], dict[str, str]]:
+    '''
+    Return the argv and env of a request, raising ValueError if it isn't
+    valid.
+    '''
+    request = json.loads(msg)
+    if not isinstance(request, dict):
+        raise ValueError('Request is not an object')
+
+    argv = request.get('argv')
+    if (not isinstance(argv, list) or not argv or
+            not all(isinstance(arg, str) for arg in argv)):
+        raise ValueError('argv must be a non-empty list of strings')
+
+    env = request.get('env', {})
+    if (not isinstance(env, dict) or
+            not all(isinstance(k, str) and isinstance(v, str)
+                    for k, v in env.items())):
+        raise ValueError('env must map strings to strings')
+
+    return argv, env
+
+
+def _reply(conn: socket.socket, reply: dict[str, Any]) -> None:
+    try:
+        conn.send(json.dumps(reply).encode())
+    except OSError:
+        pass
+    conn.close()
+
+
+def _connected(conn: socket.socket) -> bool:
+    '''
+    Return whether the client on conn is still there to get a reply.
+    '''
+    try:
+        return conn.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) != b''
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+
+
+def serve(pool: Pool, path: str) -> None:
+    '''
+    Accept launch requests on the unix socket at path and run them in
+    children from pool. Each request gets a single reply with the command's
+    exit code, or an error for a request that isn't valid. Requests wait
+    for an idle child if there isn't one. Runs until interrupted.
+    '''
+    sel = selectors.DefaultSelector()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    listener.bind(path)
+    listener.listen()
+
+    Handler = Callable[[], None]
+
+    # Requests waiting for an idle child, and connections waiting for the
+    # exit code of a child, by PID.
+    pending: deque[_Request] = deque()
+    conns: dict[int, socket.socket] = {}
+
+    def reap() -> None:
+        for exited in pool.supervisor.wait(0):
+            pool.handle_exit(exited)
+            conn = conns.pop(exited.pid, None)
+            if conn is not None:
+                _reply(conn, {'exitcode': exited.exitcode})
+
+    def dispatch() -> None:
+        while pending:
+            request = pending[0]
+            if not _connected(request.conn):
+                # Nobody is waiting for this one any more.
+                pending.popleft()
+                for fd in request.fds:
+                    os.close(fd)
+                request.conn.close()
+                continue
+
+            child = pool.take()
+            if child is None:
+                return
+
+            try:
+                pool.launch(child, request.argv, request.env, request.fds)
+            except OSError:
+                # The child died while parked, so try the next one.
+                continue
+
+            pending.popleft()
+            for fd in request.fds:
+                os.close(fd)
+            conns[child.pid] = request.conn
+
+    def handle_request(conn: socket.socket) -> None:
+        sel.unregister(conn)
+        try:
+            msg, fds, _, _ = socket.recv_fds(conn, _MAX_MESSAGE, 3)
+        except OSError:
+            conn.close()
+            return
+        if not msg:
+            conn.close()
+            return
+
+        # These stay open in the server while the request waits, so warm
+        # children cloned by refill mustn't inherit them.
+        for fd in fds:
+            os.set_inheritable(fd, False)
+
+        try:
+            argv, env = _parse_request(msg)
+        except ValueError as e:
+            for fd in fds:
+                os.close(fd)
+            _reply(conn, {'error': str(e)})
+            return
+
+        pending.append(_Request(conn, argv, env, fds))
+
+    def accept() -> None:
+        conn, _ = listener.accept()
+        handler: Handler = lambda: handle_request(conn)
+        sel.register(conn, selectors.EVENT_READ, handler)
+
+    sel.register(listener, selectors.EVENT_READ, accept)
+    sel.register(pool.supervisor, selectors.EVENT_READ, reap)
+
+    try:
+        while True:
+            # Don't block while the pool is short of children, unless it's
+            # backing off, but let pending requests go first.
+            timeout = pool.refill_delay() if pool.needs_refill() else None
+            for key, _ in sel.select(timeout):
+                key.data()
+
+            dispatch()
+            pool.refill()
+    finally:
+        listener.close()
+        os.unlink(path)
+        pool.close()
+
+
+def run(path: str, argv: list[str], env: dict[str, str] | None = None) -> int:
+    '''
+    Ask the pool listening at path to run argv with this process's stdin,
+    stdout and stderr. env is added to the environment set up in the
+    container. Returns the exit code in the form used by
+    os.waitstatus_to_exitcode.
+    '''
+    if env is None:
+        env = {}
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET) as sock:
+        sock.connect(path)
+        msg = json.dumps({'argv': argv, 'env': env}).encode()
+        socket.send_fds(sock, [msg], [0, 1, 2])
+        reply = sock.recv(_MAX_MESSAGE)
+
+    if not reply:
+        raise Exception('Pool closed the connection without a reply')
+
+    result = json.loads(reply)
+    if 'error' in result:
+        raise Exception(f'Pool rejected the request: {result["error"]}')
+
+    exitcode: int = result['exitcode']
+    return exitcode
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+            description='Keep a pool of pre-forked containers ready to run '
+                        'commands')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser(
+            'serve',
+            help='run the pool daemon')
+    add_arguments(serve_parser)
+    serve_parser.add_argument(
+            '--max-idle', '-n',
+            type=int,
+            default=4,
+            help='number of set up children to keep waiting for commands')
+    serve_parser.add_argument(
+            'socket',
+            help='path of the unix socket to listen on')
+
+    run_parser = subparsers.add_parser(
+            'run',
+            help='run a command in a container from the pool')
+    run_parser.add_argument(
+            'socket',
+            help='path of the unix socket the pool is listening on')
+    run_parser.add_argument(
+            'cmd',
+            nargs='+',
+            help='command (and arguments) to run')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.command == 'serve':
+        config = config_from_args(serve_parser, args)
+        if config.net == 'slirp':
+            serve_parser.error('--net slirp is not supported by the pool')
+        if config.id_slice:
+            serve_parser.error('--id-slice is not supported by the pool')
+        pool = Pool(config, args.max_idle)
+        try:
+            serve(pool, args.socket)
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    env: dict[str, str] = {}
+    if 'TERM' in os.environ:
+        env['TERM'] = os.environ['TERM']
+
+    exitcode = run(args.socket, args.cmd, env)
+    if exitcode < 0:
+        print(f'child process exited with signal {-exitcode}', file=sys.stderr)
+        return 1
+
+    return exitcode
+
+
+if __name__ == '__main__':
+    sys.exit(main())
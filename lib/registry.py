@@ -0,0 +1,284 @@
+import argparse
+from dataclasses import asdict, dataclass
+import json
+import os
+import secrets
+import select
+import signal
+import sqlite3
+import sys
+import time
+
+from .cgroup import Cgroup
+from .container import default_state_dir
+from .overlay import remove_upper_dir
+from .supervisor import process_alive, process_start_time
+
+# Seconds gc waits for an orphaned container to exit after killing it.
+_KILL_TIMEOUT = 5.0
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS containers (
+    id TEXT PRIMARY KEY,
+    pid INTEGER NOT NULL,
+    start_time INTEGER NOT NULL,
+    launcher_pid INTEGER NOT NULL,
+    launcher_start_time INTEGER NOT NULL,
+    namespaces INTEGER NOT NULL,
+    root TEXT,
+    cgroup TEXT,
+    upper_dir TEXT,
+    keep_upper INTEGER NOT NULL,
+    uid_maps TEXT NOT NULL,
+    gid_maps TEXT NOT NULL,
+    argv TEXT NOT NULL,
+    started REAL NOT NULL,
+    exitcode INTEGER
+);
+CREATE INDEX IF NOT EXISTS containers_pid ON containers (pid);
+CREATE INDEX IF NOT EXISTS containers_started ON containers (started);
+'''
+
+_COLUMNS = ('id, pid, start_time, launcher_pid, launcher_start_time, '
+            'namespaces, root, cgroup, upper_dir, keep_upper, uid_maps, '
+            'gid_maps, argv, started, exitcode')
+
+
+def default_registry_path() -> str:
+    return os.path.join(default_state_dir(), 'registry.db')
+
+
+@dataclass
+class Entry:
+    '''
+    A container as recorded in the registry. pid and start_time identify
+    its first process, and launcher_pid and launcher_start_time the process
+    that started it and is responsible for cleaning up after it. namespaces
+    are the CLONE_NEW* flags it was cloned with. uid_maps and gid_maps are
+    kept for removing upper_dir. exitcode is set once the launcher has seen
+    the container exit.
+    '''
+    id: str
+    pid: int
+    start_time: int
+    launcher_pid: int
+    launcher_start_time: int
+    namespaces: int
+    root: str | None
+    cgroup: str | None
+    upper_dir: str | None
+    keep_upper: bool
+    uid_maps: list[str]
+    gid_maps: list[str]
+    argv: list[str]
+    started: float
+    exitcode: int | None = None
+
+    def status(self) -> str:
+        '''
+        Return 'exited' if the launcher saw the container exit, 'dead' if it
+        exited without the launcher recording it, 'orphaned' if it's running
+        but its launcher isn't, and 'running' otherwise.
+        '''
+        if self.exitcode is not None:
+            return 'exited'
+        if not process_alive(self.pid, self.start_time):
+            return 'dead'
+        if not process_alive(self.launcher_pid, self.launcher_start_time):
+            return 'orphaned'
+        return 'running'
+
+
+def _entry(row: tuple[object, ...]) -> Entry:
+    values = list(row)
+    # keep_upper, uid_maps, gid_maps and argv are stored as an int and JSON.
+    values[9] = bool(values[9])
+    for i in (10, 11, 12):
+        values[i] = json.loads(str(values[i]))
+    return Entry(*values)  # type: ignore[arg-type]
+
+
+class Registry:
+    '''
+    A record of running containers in an SQLite database, so that they can
+    be listed and inspected, and cleaned up after if their launcher crashes.
+    The database is in WAL mode without a sync on every commit, so each
+    change is one cheap transaction that survives a crash of the launcher
+    (though not necessarily of the machine), and any number of launchers
+    can use it at once.
+
+    A launcher adds a container once it's cloned, records its exit code
+    once it's reaped, and removes it once its cgroup and overlay directory
+    are gone. Anything left over is for gc.
+    '''
+
+    def __init__(self, path: str) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+
+        # Autocommit, since every change is a single statement.
+        self._db = sqlite3.connect(path, timeout=10.0, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(_SCHEMA)
+        self._launcher = (os.getpid(), process_start_time(os.getpid()))
+
+    def close(self) -> None:
+        self._db.close()
+
+    def add(self, pid: int, namespaces: int, argv: list[str],
+            root: str | None = None, cgroup: str | None = None,
+            upper_dir: str | None = None, keep_upper: bool = False,
+            uid_maps: list[str] | None = None,
+            gid_maps: list[str] | None = None) -> str:
+        '''
+        Record a container that this process just cloned, and return its
+        new id.
+        '''
+        id_ = secrets.token_hex(6)
+        # gc can run from anywhere.
+        root = root and os.path.abspath(root)
+        upper_dir = upper_dir and os.path.abspath(upper_dir)
+        self._db.execute(
+                f'INSERT INTO containers ({_COLUMNS}) '
+                f'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL)',
+                (id_, pid, process_start_time(pid), *self._launcher,
+                 namespaces, root, cgroup, upper_dir, int(keep_upper),
+                 json.dumps(uid_maps or []), json.dumps(gid_maps or []),
+                 json.dumps(argv), time.time()))
+        return id_
+
+    def exited(self, id_: str, exitcode: int) -> None:
+        self._db.execute('UPDATE containers SET exitcode = ? WHERE id = ?',
+                         (exitcode, id_))
+
+    def remove(self, id_: str) -> None:
+        self._db.execute('DELETE FROM containers WHERE id = ?', (id_,))
+
+    def get(self, id_: str) -> Entry | None:
+        row = self._db.execute(
+                f'SELECT {_COLUMNS} FROM containers WHERE id = ?',
+                (id_,)).fetchone()
+        return None if row is None else _entry(row)
+
+    def find_pid(self, pid: int) -> list[Entry]:
+        '''
+        Return the entries with pid, of which only one can be running.
+        '''
+        rows = self._db.execute(
+                f'SELECT {_COLUMNS} FROM containers WHERE pid = ?', (pid,))
+        return [_entry(row) for row in rows]
+
+    def entries(self) -> list[Entry]:
+        '''
+        Return every entry, oldest first.
+        '''
+        rows = self._db.execute(
+                f'SELECT {_COLUMNS} FROM containers ORDER BY started')
+        return [_entry(row) for row in rows]
+
+    def gc(self, kill_orphans: bool = False) -> list[Entry]:
+        '''
+        Clean up after containers whose launcher exited without cleaning up
+        after them, by removing their cgroups and overlay directories, and
+        remove them from the registry. With kill_orphans, containers that
+        are still running after their launcher exited are killed first.
+        Returns the entries that were removed.
+        '''
+        removed: list[Entry] = []
+        for entry in self.entries():
+            # A live launcher may still be cleaning up after its container.
+            if process_alive(entry.launcher_pid, entry.launcher_start_time):
+                continue
+
+            status = entry.status()
+            if status == 'orphaned':
+                if not kill_orphans or not _kill(entry):
+                    continue
+
+            if entry.cgroup and os.path.isdir(entry.cgroup):
+                Cgroup(entry.cgroup).remove()
+            if (entry.upper_dir and not entry.keep_upper and
+                    os.path.isdir(entry.upper_dir)):
+                remove_upper_dir(entry.upper_dir, entry.uid_maps,
+                                 entry.gid_maps)
+
+            self.remove(entry.id)
+            removed.append(entry)
+
+        return removed
+
+
+def _kill(entry: Entry) -> bool:
+    # Returns True once the container has exited.
+    try:
+        pidfd = os.pidfd_open(entry.pid)
+    except ProcessLookupError:
+        return True
+
+    try:
+        if not process_alive(entry.pid, entry.start_time):
+            return True
+        signal.pidfd_send_signal(pidfd, signal.SIGKILL)
+        readable, _, _ = select.select([pidfd], [], [], _KILL_TIMEOUT)
+        return bool(readable)
+    finally:
+        os.close(pidfd)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+            description='List, inspect and clean up after containers')
+    parser.add_argument(
+            '--db',
+            default=default_registry_path(),
+            metavar='FILE',
+            help='the registry database (default: %(default)s)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser(
+            'list',
+            help='list recorded containers')
+
+    inspect_parser = subparsers.add_parser(
+            'inspect',
+            help='show everything recorded about a container, as JSON')
+    inspect_parser.add_argument('id')
+
+    gc_parser = subparsers.add_parser(
+            'gc',
+            help='clean up after containers whose launcher did not')
+    gc_parser.add_argument(
+            '--kill-orphans',
+            action='store_true',
+            help='also kill containers whose launcher has exited')
+
+    args = parser.parse_args(sys.argv[1:])
+    registry = Registry(args.db)
+    try:
+        if args.command == 'list':
+            for entry in registry.entries():
+                started = time.strftime('%Y-%m-%d %H:%M:%S',
+                                        time.localtime(entry.started))
+                print(f'{entry.id}  {entry.pid:>7}  {entry.status():<8}  '
+                      f'{started}  {entry.root or "/"}  '
+                      f'{" ".join(entry.argv)}')
+        elif args.command == 'inspect':
+            found = registry.get(args.id)
+            if found is None:
+                print(f'No container {args.id}', file=sys.stderr)
+                return 1
+            print(json.dumps(asdict(found) | {'status': found.status()},
+                             indent=2))
+        else:
+            for entry in registry.gc(args.kill_orphans):
+                print(f'removed {entry.id}')
+    finally:
+        registry.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
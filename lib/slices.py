@@ -0,0 +1,284 @@
+import argparse
+from dataclasses import dataclass
+import fcntl
+import hashlib
+import os
+import stat
+import struct
+import sys
+
+from .container import (
+        default_state_dir,
+        make_id_maps,
+        read_subgids,
+        read_subuids,
+)
+from .supervisor import process_alive, process_start_time
+
+# Ids in each slice, enough for a whole distribution's users and groups.
+SLICE_SIZE = 65536
+
+# Header of the lease file: magic, slice size, slice count, and a hash of
+# the subid ranges the slices were carved from.
+_HEADER = struct.Struct('<4sII8s')
+_MAGIC = b'IDS1'
+
+# The owner of a lease: pid and start time (see process_start_time).
+_OWNER = struct.Struct('<IQ')
+
+
+@dataclass
+class IdSlice:
+    '''
+    A slice of the user's subordinate uids and gids, leased to the container
+    whose first process is pid. index is its place in the lease file.
+    '''
+    index: int
+    uids: range
+    gids: range
+    pid: int
+    start_time: int
+
+    def id_maps(self, map_uid: int | None,
+                map_gid: int | None) -> tuple[list[str], list[str]]:
+        '''
+        Return the uid and gid maps for a container using this slice, as
+        make_id_maps would make them from the whole subid ranges. Only the
+        first slice maps ids where those maps do, so a root chowned for them,
+        as by lib/store.py or lib/importer.py, isn't owned by the container's
+        ids in any other slice.
+        '''
+        return (make_id_maps([self.uids], map_uid, os.geteuid()),
+                make_id_maps([self.gids], map_gid, os.getegid()))
+
+
+def _carve(ranges: list[range], size: int) -> list[range]:
+    slices: list[range] = []
+    for r in sorted(ranges, key=lambda r: r.start):
+        for start in range(r.start, r.stop - size + 1, size):
+            slices.append(range(start, start + size))
+
+    return slices
+
+
+class SliceAllocator:
+    '''
+    Leases disjoint slices of a user's subordinate uids and gids to
+    containers, so that containers of one user don't share host ids. Slice i
+    is the ith block of size ids in both the subuid and the subgid ranges.
+
+    Leases are kept in a file shared by every launcher of the user: a bitmap
+    of the slices in use, then the pid and start time that own each one. Each
+    operation holds an flock on the file, and a lease is a fixed number of
+    reads and writes of it whatever the number of slices. A lease is freed by
+    release, or taken back by the next lease that finds no free slice once
+    its owner has exited, as when a launcher crashes.
+    '''
+
+    def __init__(self, uid_ranges: list[range], gid_ranges: list[range],
+                 path: str, size: int = SLICE_SIZE) -> None:
+        uid_slices = _carve(uid_ranges, size)
+        gid_slices = _carve(gid_ranges, size)
+        count = min(len(uid_slices), len(gid_slices))
+        if not count:
+            raise Exception(f'Subordinate id ranges are too small for a '
+                            f'slice of {size} ids')
+
+        self.path = path
+        self.size = size
+        self.uid_slices = uid_slices[:count]
+        self.gid_slices = gid_slices[:count]
+        digest = hashlib.sha256(repr((self.uid_slices,
+                                      self.gid_slices)).encode())
+        self._header = _HEADER.pack(_MAGIC, size, count, digest.digest()[:8])
+        self._bitmap_size = (count + 7) // 8
+
+    @property
+    def count(self) -> int:
+        return len(self.uid_slices)
+
+    def _owner_offset(self, index: int) -> int:
+        return _HEADER.size + self._bitmap_size + index * _OWNER.size
+
+    def _open(self) -> int:
+        # Returns the lease file's fd, locked, and set up for these slices.
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW |
+                     os.O_CLOEXEC, 0o600)
+        try:
+            st = os.fstat(fd)
+            if (not stat.S_ISREG(st.st_mode) or st.st_uid != os.geteuid() or
+                    st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+                raise Exception(f'{self.path} is not a private file of this '
+                                f'user')
+
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.pread(fd, _HEADER.size, 0) != self._header:
+                self._reset(fd)
+        except BaseException:
+            os.close(fd)
+            raise
+
+        return fd
+
+    def _reset(self, fd: int) -> None:
+        # The file is new, or was made for other subid ranges. Leases in it
+        # can only be dropped if their owners are gone.
+        if os.fstat(fd).st_size:
+            for index, pid, start_time in self._read_leases(fd):
+                if process_alive(pid, start_time):
+                    raise Exception(f'{self.path} has leases for other '
+                                    f'subordinate id ranges still in use')
+
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, self._header + bytes(self._owner_offset(self.count) -
+                                           _HEADER.size), 0)
+
+    def _read_leases(self, fd: int) -> list[tuple[int, int, int]]:
+        # Returns (index, pid, start_time) of each lease in the file, which
+        # may have a different layout from this allocator's.
+        _, _, count, _ = _HEADER.unpack(os.pread(fd, _HEADER.size, 0))
+        bitmap_size = (count + 7) // 8
+        bits = int.from_bytes(os.pread(fd, bitmap_size, _HEADER.size),
+                              'little')
+        owners = os.pread(fd, count * _OWNER.size,
+                          _HEADER.size + bitmap_size)
+
+        leases: list[tuple[int, int, int]] = []
+        for index in range(count):
+            if bits >> index & 1:
+                pid, start_time = _OWNER.unpack_from(owners,
+                                                     index * _OWNER.size)
+                leases.append((index, pid, start_time))
+
+        return leases
+
+    def _set(self, fd: int, index: int, pid: int, start_time: int,
+             used: bool) -> None:
+        offset = _HEADER.size + index // 8
+        byte = os.pread(fd, 1, offset)[0]
+        if used:
+            byte |= 1 << index % 8
+        else:
+            byte &= ~(1 << index % 8)
+        os.pwrite(fd, _OWNER.pack(pid, start_time), self._owner_offset(index))
+        os.pwrite(fd, bytes([byte]), offset)
+
+    def _reclaim(self, fd: int) -> int:
+        reclaimed = 0
+        for index, pid, start_time in self._read_leases(fd):
+            if not process_alive(pid, start_time):
+                self._set(fd, index, 0, 0, False)
+                reclaimed += 1
+
+        return reclaimed
+
+    def lease(self, pid: int) -> IdSlice:
+        '''
+        Lease a free slice to the container whose first process is pid.
+        '''
+        start_time = process_start_time(pid)
+        fd = self._open()
+        try:
+            bitmap = os.pread(fd, self._bitmap_size, _HEADER.size)
+            bits = int.from_bytes(bitmap, 'little')
+            # The lowest clear bit.
+            index = (~bits & (bits + 1)).bit_length() - 1
+            if index >= self.count and self._reclaim(fd):
+                bitmap = os.pread(fd, self._bitmap_size, _HEADER.size)
+                bits = int.from_bytes(bitmap, 'little')
+                index = (~bits & (bits + 1)).bit_length() - 1
+            if index >= self.count:
+                raise Exception(f'All {self.count} id slices are leased')
+
+            self._set(fd, index, pid, start_time, True)
+        finally:
+            os.close(fd)
+
+        return IdSlice(index, self.uid_slices[index], self.gid_slices[index],
+                       pid, start_time)
+
+    def release(self, id_slice: IdSlice) -> None:
+        '''
+        Free id_slice, unless it has been taken back and leased again.
+        '''
+        fd = self._open()
+        try:
+            owner = os.pread(fd, _OWNER.size,
+                             self._owner_offset(id_slice.index))
+            if _OWNER.unpack(owner) == (id_slice.pid, id_slice.start_time):
+                self._set(fd, id_slice.index, 0, 0, False)
+        finally:
+            os.close(fd)
+
+    def leases(self) -> list[IdSlice]:
+        '''
+        Return the slices that are leased, including those whose owner has
+        exited without releasing them.
+        '''
+        fd = self._open()
+        try:
+            leases = self._read_leases(fd)
+        finally:
+            os.close(fd)
+
+        return [IdSlice(index, self.uid_slices[index],
+                        self.gid_slices[index], pid, start_time)
+                for index, pid, start_time in leases]
+
+    def reclaim(self) -> int:
+        '''
+        Free the slices whose owner has exited, and return how many.
+        '''
+        fd = self._open()
+        try:
+            return self._reclaim(fd)
+        finally:
+            os.close(fd)
+
+
+def default_allocator() -> SliceAllocator:
+    '''
+    Return an allocator for this user's subordinate ids, with its lease
+    file in the state directory.
+    '''
+    return SliceAllocator(read_subuids(os.geteuid()),
+                          read_subgids(os.getegid()),
+                          os.path.join(default_state_dir(), 'id-slices'))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+            description='Show the id slices leased to containers, see '
+                        '--id-slice')
+    parser.add_argument(
+            '--reclaim',
+            action='store_true',
+            help='first free the slices of containers that have exited')
+    args = parser.parse_args(sys.argv[1:])
+
+    allocator = default_allocator()
+    if args.reclaim:
+        print(f'reclaimed {allocator.reclaim()} slices')
+
+    leases = allocator.leases()
+    live = 0
+    for id_slice in leases:
+        alive = process_alive(id_slice.pid, id_slice.start_time)
+        live += alive
+        print(f'{id_slice.index:>5}  uids {id_slice.uids.start}-'
+              f'{id_slice.uids.stop - 1}  gids {id_slice.gids.start}-'
+              f'{id_slice.gids.stop - 1}  pid {id_slice.pid}'
+              f'{"" if alive else " (exited)"}')
+
+    print(f'{len(leases)} of {allocator.count} slices of {allocator.size} '
+          f'ids leased ({len(leases) / allocator.count:.0%}), {live} to '
+          f'running containers')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,506 @@
+import argparse
+import asyncio
+from dataclasses import dataclass, field
+import hashlib
+import json
+import marshal
+import os
+from pathlib import Path
+import pwd
+import sys
+import time
+import tomllib
+from typing import Any
+
+from .aio import Container
+from .cgroup import CgroupLimits
+from .common import open_private
+from .container import (
+        Config,
+        default_image_dir,
+        default_state_dir,
+        make_id_maps,
+        parse_volumes,
+        plan_mounts,
+        read_subgids,
+        read_subuids,
+)
+from .devfs import DEFAULT_DEV, DevSpec
+from .idmap import can_write_id_maps
+from .image import mount_image
+from .mounts import Mount
+from .net import BACKENDS
+from .overlay import Overlay
+
+# Bump this when the layout of LaunchPlan or of the cache files changes.
+_PLAN_VERSION = 4
+
+# Files whose contents go into a plan, apart from the spec itself and the
+# root's passwd file. A plan is compiled again when any of them changes.
+_HOST_FILES = ('/etc/subuid', '/etc/subgid', '/etc/passwd', '/etc/group')
+
+# Keys allowed at the top level of a spec, and the types of their values.
+_SPEC_KEYS: dict[str, type | tuple[type, ...]] = {
+        'command': list,
+        'env': dict,
+        'root': str,
+        'image': str,
+        'hostname': str,
+        'user': (str, int),
+        'map_uid': int,
+        'map_gid': int,
+        'volumes': list,
+        'devices': list,
+        'overlay': (bool, dict),
+        'cgroup': dict,
+        'init': bool,
+        'net': str,
+        'id_slice': bool,
+}
+
+_OVERLAY_KEYS: dict[str, type | tuple[type, ...]] = {
+        'dir': str,
+        'keep': bool,
+}
+
+_CGROUP_KEYS: dict[str, type | tuple[type, ...]] = {
+        'cpu': str,
+        'memory': str,
+        'pids': (str, int),
+        'io': list,
+        'parent': str,
+}
+
+
+@dataclass
+class LaunchPlan:
+    '''
+    Everything needed to launch a container described by a spec file, with
+    all lookups already done: the Config with paths made absolute and the
+    user as a number, the command and its environment, the id maps and the
+    mount table. key is the hash that the plan is cached under.
+    '''
+    config: Config
+    argv: list[str]
+    env: dict[str, str] = field(default_factory=dict)
+    uid_maps: list[str] = field(default_factory=list)
+    gid_maps: list[str] = field(default_factory=list)
+    mounts: list[Mount] = field(default_factory=list)
+    key: str = ''
+
+
+def read_spec(path: str) -> dict[str, Any]:
+    '''
+    Read a spec file, which is TOML if its name ends in .toml and JSON
+    otherwise.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    try:
+        if path.endswith('.toml'):
+            spec = tomllib.loads(data.decode())
+        else:
+            spec = json.loads(data)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise Exception(f'{path}: {e}') from None
+
+    if not isinstance(spec, dict):
+        raise Exception(f'{path}: a spec must be a table or object')
+
+    return spec
+
+
+def _check_keys(path: str, where: str, table: dict[str, Any],
+                allowed: dict[str, type | tuple[type, ...]]) -> None:
+    for key, value in table.items():
+        if key not in allowed:
+            raise Exception(f'{path}: unknown key {where}{key}')
+
+        types = allowed[key]
+        if not isinstance(types, tuple):
+            types = (types,)
+        # bool is a kind of int, but true isn't a uid.
+        if (not isinstance(value, types) or
+                (isinstance(value, bool) and bool not in types)):
+            raise Exception(f'{path}: wrong type for {where}{key}')
+
+
+def _check_strings(path: str, key: str, values: list[Any]) -> list[str]:
+    if not all(isinstance(v, str) for v in values):
+        raise Exception(f'{path}: {key} must be a list of strings')
+
+    return values
+
+
+def _lookup_user(root: str | None, user: str | int) -> int:
+    # Names are looked up in the container's passwd file, as they would be
+    # after the chroot.
+    if isinstance(user, int):
+        return user
+    if user.isdigit():
+        return int(user)
+
+    if root is None:
+        return pwd.getpwnam(user).pw_uid
+
+    try:
+        with open(os.path.join(root, 'etc/passwd')) as f:
+            for line in f:
+                fields = line.split(':')
+                if len(fields) > 2 and fields[0] == user:
+                    return int(fields[2])
+    except FileNotFoundError:
+        pass
+
+    raise Exception(f'User {user} not found in {root}/etc/passwd')
+
+
+def compile_spec(path: str) -> LaunchPlan:
+    '''
+    Read and check the spec file at path and resolve everything in it into a
+    LaunchPlan: relative paths are taken from the spec's directory, the user
+    is looked up in the root's passwd file, and the id maps and mounts are
+    worked out. Any problem with the spec raises an Exception here, rather
+    than in the child.
+    '''
+    spec = read_spec(path)
+    _check_keys(path, '', spec, _SPEC_KEYS)
+    base = Path(path).resolve().parent
+
+    if 'command' not in spec or not spec['command']:
+        raise Exception(f'{path}: command is required')
+    argv = _check_strings(path, 'command', spec['command'])
+
+    env = spec.get('env', {})
+    if not all(isinstance(v, str) for v in env.values()):
+        raise Exception(f'{path}: env values must be strings')
+
+    root = None
+    image = None
+    if 'root' in spec and 'image' in spec:
+        raise Exception(f'{path}: root and image can not be used together')
+    if spec.get('id_slice') and ('root' in spec or 'image' in spec):
+        raise Exception(f'{path}: id_slice can not be used with root or '
+                        f'image')
+    if 'root' in spec:
+        root = str(base / spec['root'])
+        if not os.path.isdir(root):
+            raise Exception(f'{path}: root {root} is not a directory')
+    if 'image' in spec:
+        image = str(base / spec['image'])
+        root = mount_image(image, default_image_dir())
+
+    volumes = []
+    for volume in _check_strings(path, 'volumes', spec.get('volumes', [])):
+        host, sep, rest = volume.partition(':')
+        volumes.append(f'{base / host}{sep}{rest}')
+    parsed_volumes = parse_volumes(volumes)
+    if parsed_volumes and root is None:
+        raise Exception(f'{path}: volumes can only be used with root')
+    for host_dir, _, _, _ in parsed_volumes:
+        if not os.path.exists(host_dir):
+            raise Exception(f'{path}: volume {host_dir} does not exist')
+
+    dev = DEFAULT_DEV
+    devices = _check_strings(path, 'devices', spec.get('devices', []))
+    if devices:
+        dev = DevSpec(DEFAULT_DEV.devices + devices, DEFAULT_DEV.dirs,
+                      DEFAULT_DEV.mounts, DEFAULT_DEV.symlinks)
+
+    overlay = None
+    if spec.get('overlay'):
+        if root is None:
+            raise Exception(f'{path}: overlay can only be used with root')
+        overlay = Overlay()
+        if isinstance(spec['overlay'], dict):
+            _check_keys(path, 'overlay.', spec['overlay'], _OVERLAY_KEYS)
+            if 'dir' in spec['overlay']:
+                overlay.upper_base = str(base / spec['overlay']['dir'])
+            overlay.keep = spec['overlay'].get('keep', False)
+
+    cgroup = None
+    if 'cgroup' in spec:
+        table = spec['cgroup']
+        _check_keys(path, 'cgroup.', table, _CGROUP_KEYS)
+        pids = table.get('pids')
+        cgroup = CgroupLimits(
+                table.get('cpu'), table.get('memory'),
+                None if pids is None else str(pids),
+                _check_strings(path, 'cgroup.io', table.get('io', [])),
+                table.get('parent'))
+
+    net = spec.get('net', 'host')
+    if net not in BACKENDS:
+        raise Exception(f'{path}: net must be one of '
+                        f'{", ".join(sorted(BACKENDS))}')
+
+    user = None
+    if 'user' in spec:
+        user = str(_lookup_user(root, spec['user']))
+
+    config = Config(
+            root=root,
+            hostname=spec.get('hostname'),
+            user=user,
+            map_uid=spec.get('map_uid', 1100),
+            map_gid=spec.get('map_gid', 1100),
+            volumes=parsed_volumes,
+            dev=dev,
+            overlay=overlay,
+            cgroup=cgroup,
+            init=spec.get('init', False),
+            net=net,
+            id_slice=spec.get('id_slice', False),
+            image=image)
+
+    # With id_slice the maps are those of the slice leased at start.
+    plan = LaunchPlan(config, argv, env, mounts=plan_mounts(config))
+    if not config.id_slice:
+        uid = os.geteuid()
+        gid = os.getegid()
+        plan.uid_maps = make_id_maps(read_subuids(uid), config.map_uid, uid)
+        plan.gid_maps = make_id_maps(read_subgids(gid), config.map_gid, gid)
+
+    return plan
+
+
+# (st_dev, st_ino, st_mtime_ns, st_size) of a file, or None if it's missing.
+_FileKey = tuple[int, int, int, int] | None
+
+
+def _file_key(path: str) -> _FileKey:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _source_keys(plan: LaunchPlan) -> list[tuple[str, _FileKey]]:
+    # The files a plan was resolved from, apart from the spec.
+    files = list(_HOST_FILES)
+    if plan.config.image:
+        files.append(plan.config.image)
+    if plan.config.root:
+        files.append(os.path.join(plan.config.root, 'etc/passwd'))
+
+    return [(f, _file_key(f)) for f in files]
+
+
+def plan_key(path: str) -> str:
+    '''
+    Return the hash a compiled spec is cached under. It covers the spec's
+    contents and directory, which relative paths in it are taken from, and
+    this process's ids. The files the plan was resolved from are checked
+    separately when it's loaded.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    h = hashlib.sha256(data)
+    h.update(repr((_PLAN_VERSION, str(Path(path).resolve().parent),
+                   os.geteuid(), os.getegid())).encode())
+    return h.hexdigest()
+
+
+def _plan_to_data(plan: LaunchPlan) -> tuple[Any, ...]:
+    # Only types marshal can store.
+    config = plan.config
+    overlay = config.overlay
+    cgroup = config.cgroup
+    return (
+        config.root, config.hostname, config.user, config.map_uid,
+        config.map_gid, config.volumes, config.dev.devices,
+        None if overlay is None else (overlay.upper_base, overlay.keep),
+        None if cgroup is None else (cgroup.cpu, cgroup.memory, cgroup.pids,
+                                     cgroup.io, cgroup.parent),
+        config.init, config.net, config.id_slice, config.image, plan.argv,
+        plan.env,
+        plan.uid_maps, plan.gid_maps, plan.mounts, _source_keys(plan))
+
+
+def _plan_from_data(data: tuple[Any, ...], key: str) -> LaunchPlan | None:
+    # Returns None if any of the files the plan came from has changed.
+    (root, hostname, user, map_uid, map_gid, volumes, devices, overlay,
+     cgroup, init, net, id_slice, image, argv, env, uid_maps, gid_maps,
+     mounts, sources) = data
+    if any(_file_key(f) != file_key for f, file_key in sources):
+        return None
+
+    dev = DEFAULT_DEV
+    if devices != DEFAULT_DEV.devices:
+        dev = DevSpec(devices, DEFAULT_DEV.dirs, DEFAULT_DEV.mounts,
+                      DEFAULT_DEV.symlinks)
+
+    config = Config(
+            root=root, hostname=hostname, user=user, map_uid=map_uid,
+            map_gid=map_gid, volumes=volumes, dev=dev,
+            overlay=None if overlay is None else Overlay(*overlay),
+            cgroup=None if cgroup is None else CgroupLimits(*cgroup),
+            init=init, net=net, id_slice=id_slice, image=image)
+    return LaunchPlan(config, argv, env, uid_maps, gid_maps, mounts, key)
+
+
+def _refresh_plan(plan: LaunchPlan) -> bool:
+    # Redo the parts of a cached plan that depend on the state of the system
+    # rather than on files, which _source_keys can't check. Returns False if
+    # the plan has to be compiled again. A plan with id_slice has no id maps,
+    # since they're those of the slice leased at start.
+    if not all(os.path.exists(host_dir)
+               for host_dir, _, _, _ in plan.config.volumes):
+        # So that compiling reports the missing volume.
+        return False
+
+    if plan.config.image:
+        # The image may have been unmounted since, or the machine rebooted.
+        # This is cheap when it's still mounted, and the mount point only
+        # changes with the image, which _source_keys already checks.
+        root = mount_image(plan.config.image, default_image_dir())
+        if root != plan.config.root:
+            return False
+
+    if can_write_id_maps() and not plan.config.id_slice:
+        uid = os.geteuid()
+        gid = os.getegid()
+        plan.uid_maps = make_id_maps(read_subuids(uid), plan.config.map_uid,
+                                     uid)
+        plan.gid_maps = make_id_maps(read_subgids(gid), plan.config.map_gid,
+                                     gid)
+
+    return True
+
+
+def load_plan(path: str, cache_dir: str | None = None) -> LaunchPlan:
+    '''
+    Return the LaunchPlan for the spec at path, from cache_dir if it was
+    compiled before with the same key, or compiled now and saved there. With
+    no cache_dir the spec is always compiled. A cached plan is compiled
+    again if any of /etc/subuid, /etc/subgid, /etc/passwd, /etc/group or the
+    root's etc/passwd has changed since.
+
+    Whatever in a plan depends on the state of the system rather than on
+    files is checked again on every load rather than trusted: an image root
+    is mounted again if it isn't mounted any more, and when this process
+    writes id maps itself, nothing else checks them against /etc/subuid and
+    /etc/subgid, so the cached maps are rebuilt, which is cheap next to the
+    rest of compiling.
+    '''
+    if cache_dir is None:
+        return compile_spec(path)
+
+    key = plan_key(path)
+    cache_path = os.path.join(cache_dir, f'{key}.plan')
+
+    plan = None
+    f = open_private(cache_path)
+    if f is not None:
+        with f:
+            try:
+                version, data = marshal.load(f)
+                if version == _PLAN_VERSION:
+                    plan = _plan_from_data(data, key)
+            except (EOFError, ValueError, TypeError):
+                pass
+
+    if plan is not None and _refresh_plan(plan):
+        return plan
+
+    plan = compile_spec(path)
+    plan.key = key
+
+    tmp = f'{cache_path}.{os.getpid()}'
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600),
+                  'wb') as f:
+            marshal.dump((_PLAN_VERSION, _plan_to_data(plan)), f)
+        os.replace(tmp, cache_path)
+    except OSError:
+        # The cache is only an optimization.
+        Path(tmp).unlink(missing_ok=True)
+
+    return plan
+
+
+def container_from_plan(plan: LaunchPlan,
+                        argv: list[str] | None = None,
+                        **kwargs: Any) -> Container:
+    '''
+    Return an aio Container that runs plan's command, or argv in its place.
+    kwargs are passed on to Container, as registry or sem.
+    '''
+    env = dict(plan.env)
+    if 'TERM' in os.environ:
+        env.setdefault('TERM', os.environ['TERM'])
+
+    return Container(plan.config, argv or plan.argv, env,
+                     uid_maps=plan.uid_maps, gid_maps=plan.gid_maps,
+                     mounts=plan.mounts, **kwargs)
+
+
+async def _run(plan: LaunchPlan, argv: list[str] | None) -> int:
+    container = container_from_plan(plan, argv)
+    await container.start()
+    return await container.wait()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+            description='Run containers described by spec files')
+    parser.add_argument(
+            '--cache-dir',
+            default=os.path.join(default_state_dir(), 'plans'),
+            metavar='DIR',
+            help='where to keep compiled specs (default: %(default)s)')
+    parser.add_argument(
+            '--no-cache',
+            action='store_true',
+            help='compile the spec even if it was compiled before')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    compile_parser = subparsers.add_parser(
+            'compile',
+            help='check a spec and show its launch plan')
+    compile_parser.add_argument('spec')
+
+    run_parser = subparsers.add_parser(
+            'run',
+            help='run the container described by a spec')
+    run_parser.add_argument('spec')
+    run_parser.add_argument(
+            'cmd',
+            nargs='*',
+            help="command (and arguments) to run in place of the spec's")
+
+    args = parser.parse_args(sys.argv[1:])
+    cache_dir = None if args.no_cache else args.cache_dir
+
+    start = time.perf_counter()
+    plan = load_plan(args.spec, cache_dir)
+    elapsed = time.perf_counter() - start
+
+    if args.command == 'compile':
+        print(f'key:      {plan.key or "(not cached)"}')
+        print(f'command:  {plan.argv}')
+        print(f'root:     {plan.config.root}')
+        print(f'user:     {plan.config.user}')
+        print(f'uid_maps: {" ".join(plan.uid_maps)}')
+        print(f'gid_maps: {" ".join(plan.gid_maps)}')
+        for source, target, fstype, flags in plan.mounts:
+            print(f'mount:    {os.fsdecode(source)} on {os.fsdecode(target)} '
+                  f'type {os.fsdecode(fstype) or "bind"} flags {flags:#x}')
+        print(f'loaded in {elapsed * 1e3:.3f} ms')
+        return 0
+
+    exitcode = asyncio.run(_run(plan, args.cmd))
+    if exitcode < 0:
+        print(f'child process exited with signal {-exitcode}', file=sys.stderr)
+        return 1
+
+    return exitcode
+
+
+if __name__ == '__main__':
+    sys.exit(main())
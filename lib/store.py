@@ -0,0 +1,309 @@
+import argparse
+from dataclasses import dataclass
+import errno
+import fcntl
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+from . import libc
+from .container import make_id_maps, read_subgids, read_subuids
+from .idmap import run_in_userns
+
+# Size of reads while hashing and copying files.
+_CHUNK = 1 << 20
+
+
+@dataclass
+class Entry:
+    '''
+    One item in a snapshot. kind is 'dir', 'file', 'symlink' or 'fifo'. For
+    files, object is the name of the store object holding the contents, and
+    for symlinks, target is the link target. Ids are as seen by the process
+    that took the snapshot, see RootStore.
+    '''
+    path: str
+    kind: str
+    mode: int
+    uid: int
+    gid: int
+    object: str | None = None
+    target: str | None = None
+
+
+def _hash_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(_CHUNK):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def _reflink(src: str, dest: str) -> None:
+    # Share the source's blocks with FICLONE, falling back to a plain copy on
+    # file systems that can't.
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        try:
+            fcntl.ioctl(fdest.fileno(), libc.FICLONE, fsrc.fileno())
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL):
+                raise
+            shutil.copyfileobj(fsrc, fdest, _CHUNK)
+
+
+class RootStore:
+    '''
+    A content addressed store of root file systems. ingest records a directory
+    tree as a named snapshot, storing each distinct file once under
+    objects/, and materialize builds a new root from a snapshot by hard
+    linking (or reflinking) the stored files instead of copying them.
+
+    Hard links share an inode, so objects are keyed by mode and owner as well
+    as contents, and all files with the same key share a modification time.
+    Files in a hard linked root must not be modified in place, since that
+    would change every root using them. Run such roots with --overlay, or
+    materialize with reflinks.
+
+    Ownership is recorded and restored as seen by the calling process. Run
+    the store in a user namespace with a container's id maps (see main) to
+    keep ownership consistent with what the container sees.
+    '''
+
+    def __init__(self, path: str) -> None:
+        self.path = Path(path)
+        self.objects = self.path / 'objects'
+        self.snapshots = self.path / 'snapshots'
+
+    def _object_path(self, name: str) -> Path:
+        return self.objects / name[:2] / name
+
+    def _snapshot_path(self, name: str) -> Path:
+        if '/' in name or name.startswith('.'):
+            raise Exception(f'Invalid snapshot name {name}')
+
+        return self.snapshots / f'{name}.json'
+
+    def _store_file(self, path: str, st: os.stat_result) -> str:
+        mode = stat.S_IMODE(st.st_mode)
+        name = f'{_hash_file(path)}-{mode:o}-{st.st_uid}-{st.st_gid}'
+        obj = self._object_path(name)
+        if obj.exists():
+            return name
+
+        obj.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=obj.parent)
+        os.close(fd)
+        try:
+            shutil.copyfile(path, tmp)
+            os.chown(tmp, st.st_uid, st.st_gid)
+            os.chmod(tmp, mode)
+            os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+            os.replace(tmp, obj)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        return name
+
+    def ingest(self, source: str, name: str) -> list[Entry]:
+        '''
+        Record the tree at source as snapshot name, replacing any snapshot
+        with that name. Device nodes and sockets are skipped, since they
+        can't be created in a user namespace anyway.
+        '''
+        entries: list[Entry] = []
+        for dirpath, dirnames, filenames in os.walk(source):
+            dirnames.sort()
+            for item in [''] + sorted(dirnames + filenames):
+                full = os.path.join(dirpath, item)
+                rel = os.path.relpath(full, source)
+                st = os.lstat(full)
+                mode = stat.S_IMODE(st.st_mode)
+                entry = Entry(rel, '', mode, st.st_uid, st.st_gid)
+
+                if item == '':
+                    entry.kind = 'dir'
+                elif stat.S_ISDIR(st.st_mode):
+                    # Recorded when os.walk reaches it.
+                    continue
+                elif stat.S_ISREG(st.st_mode):
+                    entry.kind = 'file'
+                    entry.object = self._store_file(full, st)
+                elif stat.S_ISLNK(st.st_mode):
+                    entry.kind = 'symlink'
+                    entry.target = os.readlink(full)
+                elif stat.S_ISFIFO(st.st_mode):
+                    entry.kind = 'fifo'
+                else:
+                    continue
+
+                entries.append(entry)
+
+        self.snapshots.mkdir(parents=True, exist_ok=True)
+        snapshot = self._snapshot_path(name)
+        tmp = snapshot.with_name(f'{snapshot.name}.{os.getpid()}')
+        with open(tmp, 'w') as f:
+            json.dump([vars(e) for e in entries], f)
+        os.replace(tmp, snapshot)
+
+        return entries
+
+    def load(self, name: str) -> list[Entry]:
+        with open(self._snapshot_path(name)) as f:
+            return [Entry(**e) for e in json.load(f)]
+
+    def names(self) -> list[str]:
+        if not self.snapshots.exists():
+            return []
+
+        return sorted(p.stem for p in self.snapshots.glob('*.json'))
+
+    def materialize(self, name: str, dest: str, reflink: bool = False) -> None:
+        '''
+        Create a root at dest, which must not exist, from snapshot name.
+        Files are hard linked to the store objects, or reflinked (copied where
+        reflinks aren't supported) if reflink is True.
+        '''
+        entries = self.load(name)
+        dirs: list[Entry] = []
+
+        for entry in entries:
+            path = os.path.normpath(os.path.join(dest, entry.path))
+            match entry.kind:
+                case 'dir':
+                    # Create writable for now, the real mode is set once the
+                    # contents are in place.
+                    os.mkdir(path, 0o700)
+                    dirs.append(entry)
+                case 'file':
+                    assert entry.object is not None
+                    obj = str(self._object_path(entry.object))
+                    if reflink:
+                        _reflink(obj, path)
+                        # chown first, since it clears setuid and setgid.
+                        os.chown(path, entry.uid, entry.gid)
+                        shutil.copystat(obj, path)
+                    else:
+                        os.link(obj, path)
+                case 'symlink':
+                    assert entry.target is not None
+                    os.symlink(entry.target, path)
+                    os.lchown(path, entry.uid, entry.gid)
+                case 'fifo':
+                    os.mkfifo(path, entry.mode)
+                    os.chown(path, entry.uid, entry.gid)
+
+        # Deepest first, so parents are still writable while children are
+        # done.
+        for entry in reversed(dirs):
+            path = os.path.normpath(os.path.join(dest, entry.path))
+            os.chown(path, entry.uid, entry.gid)
+            os.chmod(path, entry.mode)
+
+    def delete(self, name: str) -> None:
+        self._snapshot_path(name).unlink()
+
+    def gc(self) -> int:
+        '''
+        Remove objects that no snapshot refers to. Roots materialized with
+        hard links keep their own links to removed objects, so they're not
+        affected. Returns the number of objects removed.
+        '''
+        used = {e.object for name in self.names() for e in self.load(name)}
+        removed = 0
+        for obj in self.objects.glob('*/*'):
+            if obj.name not in used:
+                obj.unlink()
+                removed += 1
+
+        return removed
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+            description='Store root file systems by content and create roots '
+                        'from them')
+    parser.add_argument(
+            '--store', '-s',
+            required=True,
+            help='directory of the store')
+    parser.add_argument(
+            '--map-uid', '-m',
+            type=int,
+            default=1100,
+            help="uid to which the current user's uid is mapped, as used "
+                 "when running containers")
+    parser.add_argument(
+            '--map-gid', '-g',
+            type=int,
+            default=1100,
+            help="gid to which the current user's gid is mapped, as used "
+                 "when running containers")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ingest_parser = subparsers.add_parser(
+            'ingest', help='record a directory tree as a snapshot')
+    ingest_parser.add_argument('source')
+    ingest_parser.add_argument('name')
+
+    create_parser = subparsers.add_parser(
+            'create', help='create a root from a snapshot')
+    create_parser.add_argument(
+            '--reflink',
+            action='store_true',
+            help='reflink or copy files instead of hard linking them')
+    create_parser.add_argument('name')
+    create_parser.add_argument('dest')
+
+    subparsers.add_parser('list', help='list snapshots')
+
+    delete_parser = subparsers.add_parser('delete', help='delete a snapshot')
+    delete_parser.add_argument('name')
+
+    subparsers.add_parser('gc', help='remove unused objects')
+
+    args = parser.parse_args(sys.argv[1:])
+    store = RootStore(args.store)
+
+    def command() -> int:
+        start = time.monotonic()
+        match args.command:
+            case 'ingest':
+                entries = store.ingest(args.source, args.name)
+                print(f'{len(entries)} entries')
+            case 'create':
+                store.materialize(args.name, args.dest, args.reflink)
+            case 'list':
+                for name in store.names():
+                    print(name)
+            case 'delete':
+                store.delete(args.name)
+            case 'gc':
+                print(f'{store.gc()} objects removed')
+
+        if args.command in ('ingest', 'create'):
+            elapsed = time.monotonic() - start
+            print(f'{args.command} took {elapsed * 1000:.1f} ms')
+
+        return 0
+
+    # Work in a user namespace with the same id maps as the containers, so
+    # that ids in snapshots are container ids and files can be given any of
+    # them.
+    uid = os.geteuid()
+    gid = os.getegid()
+    uid_maps = make_id_maps(read_subuids(uid), args.map_uid, uid)
+    gid_maps = make_id_maps(read_subgids(gid), args.map_gid, gid)
+
+    return run_in_userns(command, uid_maps, gid_maps)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,238 @@
+from collections.abc import Callable
+import grp
+import marshal
+import os
+from pathlib import Path
+import pwd
+from typing import TypeGuard
+
+from .common import open_private
+
+# Bump this when the layout of the cache file changes.
+_CACHE_VERSION = 2
+
+# Setting this environment variable to a directory enables the on-disk cache,
+# which lets short-lived launchers skip parsing and name lookups entirely.
+CACHE_DIR_ENV = 'SUBID_CACHE_DIR'
+
+# (st_dev, st_ino, st_mtime_ns, st_size) of a file.
+_FileKey = tuple[int, int, int, int]
+
+# The keys of the subuid/subgid file and of the file names are looked up in.
+_StatKey = tuple[_FileKey, _FileKey | None]
+
+# Maps ids to their (start, count) pairs.
+_Resolved = dict[int, list[tuple[int, int]]]
+
+# Maps a subuid/subgid entry (a name or a number) to the (line, start, count)
+# triples for that entry, in file order.
+_Entries = dict[str, list[tuple[int, int, int]]]
+
+
+def _file_key(path: str) -> _FileKey:
+    st = os.stat(path)
+    return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _names_key(path: str | None) -> _FileKey | None:
+    if path is None:
+        return None
+
+    try:
+        return _file_key(path)
+    except FileNotFoundError:
+        return None
+
+
+def _valid_resolved(resolved: object) -> TypeGuard[_Resolved]:
+    # Check that a value loaded from a cache file has the layout of
+    # SubidIndex._resolved.
+    if not isinstance(resolved, dict):
+        return False
+
+    for id_, pairs in resolved.items():
+        if type(id_) is not int or not isinstance(pairs, list):
+            return False
+
+        for pair in pairs:
+            if (not isinstance(pair, tuple) or len(pair) != 2 or
+                    not all(type(x) is int and x >= 0 for x in pair)):
+                return False
+
+    return True
+
+
+def parse_subid_file(path: str) -> _Entries:
+    '''
+    Parse a file in subuid(5)/subgid(5) format. Entries that appear on more
+    than one line get all of their ranges.
+    '''
+    entries: _Entries = {}
+    with open(path, 'r') as f:
+        for lineno, line in enumerate(f):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            entry, start, count = line.split(':')
+            entries.setdefault(entry, []).append(
+                    (lineno, int(start), int(count)))
+
+    return entries
+
+
+class SubidIndex:
+    '''
+    An index of a subuid or subgid file. lookup_name converts an id to the
+    user or group name that may appear in the file. The file is parsed on
+    first use and again only when its inode, size or modification time
+    changes. The ranges found for each id are remembered, so repeat lookups
+    don't parse or look up names.
+
+    If cache_path is given, the ranges found for each id are also saved there,
+    so that other processes can look up the same ids without parsing the file
+    or looking up names at all. The cache is dropped when the file changes,
+    or when names_path (the file lookup_name reads, like /etc/passwd) does.
+    Names that come from other NSS sources aren't tracked. A cache file is
+    only read if it belongs to this process's effective user and no one else
+    can write it.
+    '''
+
+    def __init__(self, path: str, lookup_name: Callable[[int], str],
+                 cache_path: str | None = None,
+                 names_path: str | None = None) -> None:
+        self.path = path
+        self.cache_path = cache_path
+        self.names_path = names_path
+        self._lookup_name = lookup_name
+        self._key: _StatKey | None = None
+        self._entries: _Entries | None = None
+        self._resolved: _Resolved = {}
+        # Ids in _resolved that came from the cache file rather than from
+        # parsing path in this process.
+        self._from_cache: set[int] = set()
+
+    def _refresh(self) -> _StatKey:
+        key = (_file_key(self.path), _names_key(self.names_path))
+        if key != self._key:
+            self._key = key
+            self._entries = None
+            self._resolved = self._load_cache(key)
+            self._from_cache = set(self._resolved)
+
+        return key
+
+    def _load_cache(self, key: _StatKey) -> _Resolved:
+        if self.cache_path is None:
+            return {}
+
+        # Whoever can write the cache chooses the host ids containers get,
+        # so only trust a file nobody but us could have written.
+        f = open_private(self.cache_path)
+        if f is None:
+            return {}
+
+        with f:
+            try:
+                version, cached_key, resolved = marshal.load(f)
+            except (OSError, EOFError, ValueError, TypeError):
+                return {}
+
+        if (version, cached_key) != (_CACHE_VERSION, key):
+            return {}
+
+        if not _valid_resolved(resolved):
+            return {}
+
+        return resolved
+
+    def _save_cache(self, key: _StatKey) -> None:
+        if self.cache_path is None:
+            return
+
+        path = Path(self.cache_path)
+        tmp = path.with_name(f'{path.name}.{os.getpid()}')
+        try:
+            path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                              0o600), 'wb') as f:
+                marshal.dump((_CACHE_VERSION, key, self._resolved), f)
+            # Replace atomically so concurrent readers never see a partial
+            # file.
+            os.replace(tmp, path)
+        except OSError:
+            # The cache is only an optimization.
+            tmp.unlink(missing_ok=True)
+
+    def _resolve(self, id_: int) -> list[tuple[int, int]]:
+        if self._entries is None:
+            self._entries = parse_subid_file(self.path)
+
+        # subuid/subgid can use names or numbers, so we check for both.
+        found = list(self._entries.get(str(id_), []))
+        try:
+            name = self._lookup_name(id_)
+        except KeyError:
+            name = None
+
+        if name is not None and name != str(id_):
+            found = sorted(found + self._entries.get(name, []))
+
+        return [(start, count) for _, start, count in found]
+
+    def ranges(self, id_: int, verify: bool = False) -> list[range]:
+        '''
+        Return all ranges listed for id_, whether by number or by name, in
+        file order. Returns an empty list if there are none.
+
+        If verify is True, ranges that came from the cache file are checked
+        against the file itself. Use this when the ranges will be written to
+        uid_map or gid_map directly, since newuidmap and newgidmap aren't
+        there to check them.
+        '''
+        key = self._refresh()
+
+        if id_ in self._from_cache and verify:
+            self._from_cache.discard(id_)
+            parsed = self._resolve(id_)
+            if parsed != self._resolved[id_]:
+                self._resolved[id_] = parsed
+                self._save_cache(key)
+
+        if id_ not in self._resolved:
+            self._resolved[id_] = self._resolve(id_)
+            self._save_cache(key)
+
+        return [range(start, start + count)
+                for start, count in self._resolved[id_]]
+
+    def require(self, id_: int, verify: bool = False) -> list[range]:
+        '''
+        Like ranges, but raise an Exception if there are none.
+        '''
+        found = self.ranges(id_, verify)
+        if not found:
+            raise Exception(f'Id {id_} not found in {self.path}')
+
+        return found
+
+
+def _cache_path(filename: str) -> str | None:
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if not cache_dir:
+        return None
+
+    return str(Path(cache_dir) / f'{filename}.cache')
+
+
+subuids = SubidIndex(
+        '/etc/subuid',
+        lambda uid: pwd.getpwuid(uid).pw_name,
+        _cache_path('subuid'),
+        '/etc/passwd')
+
+subgids = SubidIndex(
+        '/etc/subgid',
+        lambda gid: grp.getgrgid(gid).gr_name,
+        _cache_path('subgid'),
+        '/etc/group')
@@ -0,0 +1,178 @@
+import asyncio
+from collections.abc import Callable
+from dataclasses import dataclass
+import os
+import selectors
+import signal
+from typing import Generic, TypeVar
+
+from . import libc
+
+T = TypeVar('T')
+
+
+@dataclass
+class Exited(Generic[T]):
+    '''
+    A child that has exited. exitcode is as from os.waitstatus_to_exitcode,
+    negative if the child was killed by a signal. data is what was given
+    when the child was added.
+    '''
+    pid: int
+    exitcode: int
+    data: T
+
+
+def waitid_exitcode(result: os.waitid_result) -> int:
+    '''
+    Convert the result of os.waitid for an exited child to an exit code, as
+    os.waitstatus_to_exitcode does for os.waitpid.
+    '''
+    if result.si_code == os.CLD_EXITED:
+        return result.si_status
+
+    return -result.si_status
+
+
+def process_start_time(pid: int) -> int:
+    '''
+    Return the start time of pid in clock ticks since boot, from
+    /proc/PID/stat. Together with the PID this identifies a process even if
+    the PID is reused.
+    '''
+    with open(f'/proc/{pid}/stat') as f:
+        stat = f.read()
+
+    # The command name is in parentheses and can contain anything, so split
+    # after it. starttime is the 22nd field, the 20th after the name.
+    return int(stat[stat.rindex(')') + 2:].split()[19])
+
+
+def process_alive(pid: int, start_time: int) -> bool:
+    '''
+    Return True if pid is running and is the process that started at
+    start_time. A zombie doesn't count, since it has exited and is only
+    waiting to be reaped.
+    '''
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            stat = f.read()
+    except FileNotFoundError:
+        return False
+
+    # The state is the first field after the name.
+    fields = stat[stat.rindex(')') + 2:].split()
+    return fields[0] not in ('Z', 'X') and int(fields[19]) == start_time
+
+
+async def wait_pidfd(pidfd: int) -> int:
+    '''
+    Wait on the running asyncio loop for the child referred to by pidfd to
+    exit, reap it and return its exit code as from waitid_exitcode. pidfd
+    is left open.
+    '''
+    loop = asyncio.get_running_loop()
+    exited: asyncio.Future[None] = loop.create_future()
+
+    def readable() -> None:
+        if not exited.done():
+            exited.set_result(None)
+
+    loop.add_reader(pidfd, readable)
+    try:
+        await exited
+    finally:
+        loop.remove_reader(pidfd)
+
+    result = os.waitid(os.P_PIDFD, pidfd, os.WEXITED)
+    # waitid returns None only with WNOHANG.
+    assert result is not None
+    return waitid_exitcode(result)
+
+
+class Supervisor(Generic[T]):
+    '''
+    Waits for any number of children at once through their pidfds, using one
+    epoll set. There's no thread per child and no SIGCHLD handler, and since
+    pidfds refer to one process, a child is never confused with a later one
+    that got the same PID. The epoll fd itself, from fileno, becomes readable
+    when a child has exited, so a supervisor can be waited for along with
+    other fds in a selector or event loop.
+
+    Each child is added with a data object of the caller's choice, which is
+    returned when the child exits.
+    '''
+
+    def __init__(self) -> None:
+        self._selector = selectors.EpollSelector()
+        self._children: dict[int, tuple[int, T]] = {}
+
+    def __len__(self) -> int:
+        return len(self._children)
+
+    def fileno(self) -> int:
+        return self._selector.fileno()
+
+    def add(self, pid: int, pidfd: int, data: T) -> None:
+        '''
+        Supervise pid, with pidfd from clone3 or os.pidfd_open. The
+        supervisor takes ownership of pidfd.
+        '''
+        self._selector.register(pidfd, selectors.EVENT_READ, pid)
+        self._children[pid] = (pidfd, data)
+
+    def spawn(self, fn: Callable[[], int], flags: int, data: T,
+              cgroup_fd: int | None = None) -> int:
+        '''
+        Start fn in a child with libc.clone3 and supervise it. Returns the
+        child's PID.
+        '''
+        pid, pidfd = libc.clone3(fn, flags, cgroup_fd)
+        self.add(pid, pidfd, data)
+        return pid
+
+    def send_signal(self, pid: int, sig: int) -> None:
+        pidfd, _ = self._children[pid]
+        signal.pidfd_send_signal(pidfd, sig)
+
+    def wait(self, timeout: float | None = None) -> list[Exited[T]]:
+        '''
+        Wait up to timeout seconds (forever if None) for at least one child
+        to exit, then reap and return all that have. Returns an empty list on
+        timeout, or if there are no children.
+        '''
+        if not self._children:
+            return []
+
+        exited: list[Exited[T]] = []
+        for key, _ in self._selector.select(timeout):
+            pid: int = key.data
+            pidfd, data = self._children.pop(pid)
+            self._selector.unregister(pidfd)
+
+            result = os.waitid(os.P_PIDFD, pidfd, os.WEXITED)
+            os.close(pidfd)
+            # waitid returns None only with WNOHANG.
+            assert result is not None
+            exited.append(Exited(pid, waitid_exitcode(result), data))
+
+        return exited
+
+    def wait_all(self) -> list[Exited[T]]:
+        '''
+        Wait for every child to exit, and return them in the order they did.
+        '''
+        exited: list[Exited[T]] = []
+        while self._children:
+            exited += self.wait()
+
+        return exited
+
+    def close(self) -> None:
+        '''
+        Stop supervising. Children that are still running are left alone.
+        '''
+        for pidfd, _ in self._children.values():
+            os.close(pidfd)
+        self._children.clear()
+        self._selector.close()
@@ -0,0 +1,349 @@
+import argparse
+from dataclasses import dataclass, field, replace
+import json
+import os
+import select
+import sys
+import time
+from typing import Any, TextIO
+
+from .cgroup import STAT_FILES, Cgroup, parse_stat
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+# Big enough for any of the files read for a process, or a cgroup.procs with
+# a few thousand processes.
+_READ_SIZE = 64 * 1024
+
+
+def _open(path: str) -> int | None:
+    try:
+        return os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    except OSError:
+        # Gone already, or not readable, as /proc/PID/io can be.
+        return None
+
+
+def _pread(fd: int | None) -> bytes:
+    if fd is None:
+        return b''
+
+    return os.pread(fd, _READ_SIZE, 0)
+
+
+@dataclass
+class Counters:
+    '''
+    Totals over some processes. cpu is in clock ticks, rss in kB.
+    '''
+    cpu: int = 0
+    rss_kb: int = 0
+    read_bytes: int = 0
+    write_bytes: int = 0
+    ctxt_switches: int = 0
+
+    def add(self, other: 'Counters') -> None:
+        self.cpu += other.cpu
+        self.rss_kb += other.rss_kb
+        self.read_bytes += other.read_bytes
+        self.write_bytes += other.write_bytes
+        self.ctxt_switches += other.ctxt_switches
+
+
+class _Process:
+    '''
+    The open /proc files of one process. The files are opened once and read
+    again from the start for each sample, which is much cheaper than opening
+    them each time.
+    '''
+
+    def __init__(self, pid: int) -> None:
+        self.stat = _open(f'/proc/{pid}/stat')
+        self.status = _open(f'/proc/{pid}/status')
+        self.io = _open(f'/proc/{pid}/io')
+        self.last = Counters()
+
+    def read(self) -> Counters | None:
+        '''
+        Return the process's counters, or None if it has exited.
+        '''
+        try:
+            stat = _pread(self.stat)
+            status = _pread(self.status)
+            io = _pread(self.io)
+        except ProcessLookupError:
+            return None
+        if not stat:
+            return None
+
+        counters = Counters()
+        # The command name in parentheses can hold spaces, so count fields
+        # from the end of it. utime and stime are fields 14 and 15.
+        fields = stat[stat.rindex(b')') + 2:].split()
+        counters.cpu = int(fields[11]) + int(fields[12])
+
+        for line in status.splitlines():
+            if line.startswith(b'VmRSS:'):
+                counters.rss_kb = int(line.split()[1])
+            elif b'ctxt_switches:' in line:
+                # Both voluntary and nonvoluntary.
+                counters.ctxt_switches += int(line.split()[1])
+
+        for line in io.splitlines():
+            if line.startswith(b'read_bytes:'):
+                counters.read_bytes = int(line.split()[1])
+            elif line.startswith(b'write_bytes:'):
+                counters.write_bytes = int(line.split()[1])
+
+        self.last = counters
+        return counters
+
+    def close(self) -> None:
+        for fd in (self.stat, self.status, self.io):
+            if fd is not None:
+                os.close(fd)
+
+
+@dataclass
+class Sample:
+    '''
+    Resource use of a container at one point. time is seconds since sampling
+    started. cpu (in seconds), read_bytes, write_bytes and ctxt_switches are
+    totals since the container started, rss_kb and procs are for the
+    processes running at the time. cgroup is the cgroup's accounting, if
+    there is one, as from Cgroup.stats.
+    '''
+    time: float
+    procs: int
+    cpu: float
+    rss_kb: int
+    read_bytes: int
+    write_bytes: int
+    ctxt_switches: int
+    cgroup: dict[str, int] = field(default_factory=dict)
+
+    def to_json(self) -> dict[str, Any]:
+        # Short keys, since there's one of these per sample.
+        record: dict[str, Any] = {
+            't': round(self.time, 3),
+            'n': self.procs,
+            'cpu': round(self.cpu, 3),
+            'rss': self.rss_kb,
+            'rd': self.read_bytes,
+            'wr': self.write_bytes,
+            'cs': self.ctxt_switches,
+        }
+        if self.cgroup:
+            record['cg'] = self.cgroup
+
+        return record
+
+
+class Sampler:
+    '''
+    Samples the resource use of the processes in a container, found as those
+    in the PID namespace of pid, the container's first process. With a
+    cgroup, the processes are the ones in the cgroup instead, and the
+    cgroup's own accounting is included in each sample.
+
+    Processes that exit between samples still count toward the totals with
+    what they had used at the last sample. The cgroup accounting, where
+    there is one, also includes what they used after it.
+    '''
+
+    def __init__(self, pid: int, cgroup: Cgroup | None = None) -> None:
+        st = os.stat(f'/proc/{pid}/ns/pid')
+        self._ns = (st.st_dev, st.st_ino)
+        self._start = time.monotonic()
+        self._procs: dict[int, _Process] = {}
+        # PIDs seen in the last scan that aren't in the container, so each
+        # process only needs checking once.
+        self._foreign: set[int] = set()
+        self._exited = Counters()
+        self.samples: list[Sample] = []
+
+        self._procs_fd = None
+        self._stat_fds: dict[str, int | None] = {}
+        if cgroup:
+            self._procs_fd = _open(os.path.join(cgroup.path, 'cgroup.procs'))
+            for name in STAT_FILES:
+                self._stat_fds[name] = _open(os.path.join(cgroup.path, name))
+
+    def _in_container(self, pid: int) -> bool:
+        try:
+            st = os.stat(f'/proc/{pid}/ns/pid')
+        except OSError:
+            return False
+
+        return (st.st_dev, st.st_ino) == self._ns
+
+    def _find_pids(self) -> set[int]:
+        if self._procs_fd is not None:
+            return {int(pid) for pid in _pread(self._procs_fd).split()}
+
+        pids = {int(name) for name in os.listdir('/proc') if name.isdigit()}
+        self._foreign &= pids
+        for pid in pids - self._procs.keys() - self._foreign:
+            if not self._in_container(pid):
+                self._foreign.add(pid)
+
+        return pids - self._foreign
+
+    def sample(self) -> Sample:
+        '''
+        Take a sample, and add it to samples.
+        '''
+        now = time.monotonic()
+        pids = self._find_pids()
+        for pid in pids - self._procs.keys():
+            self._procs[pid] = _Process(pid)
+
+        running = Counters()
+        for pid, proc in list(self._procs.items()):
+            counters = proc.read() if pid in pids else None
+            if counters is None:
+                # Memory is only counted for running processes.
+                self._exited.add(replace(proc.last, rss_kb=0))
+                proc.close()
+                del self._procs[pid]
+            else:
+                running.add(counters)
+
+        total = Counters()
+        total.add(running)
+        total.add(self._exited)
+
+        cgroup: dict[str, int] = {}
+        for name, fd in self._stat_fds.items():
+            parse_stat(name, _pread(fd).decode(), cgroup)
+
+        sample = Sample(now - self._start, len(self._procs),
+                        total.cpu / CLOCK_TICKS, total.rss_kb,
+                        total.read_bytes, total.write_bytes,
+                        total.ctxt_switches, cgroup)
+        self.samples.append(sample)
+        return sample
+
+    def run(self, pidfd: int, interval: float,
+            output: TextIO | None = None) -> list[Sample]:
+        '''
+        Sample every interval seconds until pidfd, a pidfd for the
+        container's first process, shows that it has exited, then once more
+        for the final totals. Returns samples, and writes each new one to
+        output as a line of JSON if given.
+        '''
+        deadline = time.monotonic()
+        while True:
+            timeout = max(deadline - time.monotonic(), 0)
+            exited = bool(select.select([pidfd], [], [], timeout)[0])
+
+            sample = self.sample()
+            if output:
+                output.write(json.dumps(sample.to_json(),
+                                        separators=(',', ':')) + '\n')
+
+            if exited:
+                return self.samples
+            deadline += interval
+
+    def close(self) -> None:
+        for proc in self._procs.values():
+            proc.close()
+        self._procs.clear()
+
+        fds = [self._procs_fd, *self._stat_fds.values()]
+        for fd in fds:
+            if fd is not None:
+                os.close(fd)
+        self._procs_fd = None
+        self._stat_fds.clear()
+
+
+def summarize(samples: list[Sample]) -> dict[str, Any]:
+    '''
+    Summarize the samples of one run: totals from the last sample, peaks
+    over all of them, and the average number of CPUs used.
+    '''
+    if not samples:
+        return {}
+
+    last = samples[-1]
+    summary: dict[str, Any] = {
+        'duration_s': last.time,
+        'samples': len(samples),
+        'cpu_s': last.cpu,
+        'cpus_avg': last.cpu / last.time if last.time > 0 else 0.0,
+        'procs_max': max(s.procs for s in samples),
+        'rss_max_kb': max(s.rss_kb for s in samples),
+        'read_bytes': last.read_bytes,
+        'write_bytes': last.write_bytes,
+        'ctxt_switches': last.ctxt_switches,
+    }
+    for key, value in last.cgroup.items():
+        summary[f'cgroup_{key}'] = value
+
+    return summary
+
+
+def print_summary(summary: dict[str, Any], file: TextIO = sys.stderr) -> None:
+    for key, value in summary.items():
+        if isinstance(value, float):
+            print(f'{key:<24} {value:12.3f}', file=file)
+        else:
+            print(f'{key:<24} {value:12}', file=file)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+            description="Sample a running container's resource use until it "
+                        'exits')
+    parser.add_argument(
+            '--interval', '-i',
+            type=float,
+            default=1.0,
+            help='seconds between samples (default: %(default)s)')
+    parser.add_argument(
+            '--output', '-o',
+            help='write each sample to this file as a line of JSON')
+    parser.add_argument(
+            '--cgroup',
+            metavar='PATH',
+            help="the container's cgroup, to sample instead of its PID "
+                 'namespace')
+    parser.add_argument(
+            '--json',
+            action='store_true',
+            help='print the summary as JSON')
+    parser.add_argument(
+            'pid',
+            type=int,
+            help="PID of the container's first process")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    cgroup = Cgroup(args.cgroup) if args.cgroup else None
+    sampler = Sampler(args.pid, cgroup)
+    pidfd = os.pidfd_open(args.pid)
+    output = open(args.output, 'w') if args.output else None
+    try:
+        sampler.run(pidfd, args.interval, output)
+    except KeyboardInterrupt:
+        sampler.sample()
+    finally:
+        os.close(pidfd)
+        sampler.close()
+        if output:
+            output.close()
+
+    summary = summarize(sampler.samples)
+    if args.json:
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    else:
+        print_summary(summary, sys.stdout)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,220 @@
+import argparse
+import json
+import math
+import mmap
+import os
+import statistics
+import struct
+import sys
+import time
+from typing import Any, TextIO
+
+# Points in a launch that get a timestamp, in the order they happen. Events are
+# marked by the parent (start, cloned, id_maps, volumes, net, released,
+# exec_done) or the child (woke, mounts, chroot, user, exec_start).
+EVENTS = [
+        'start',
+        'cloned',
+        'id_maps',
+        'volumes',
+        'net',
+        'released',
+        'woke',
+        'mounts',
+        'chroot',
+        'user',
+        'exec_start',
+        'exec_done',
+]
+
+# Each phase is the time between two events.
+PHASES = {
+        'clone': ('start', 'cloned'),
+        'id_maps': ('cloned', 'id_maps'),
+        'volumes': ('id_maps', 'volumes'),
+        'net': ('volumes', 'net'),
+        'wake': ('released', 'woke'),
+        'mounts': ('woke', 'mounts'),
+        'chroot': ('mounts', 'chroot'),
+        'user': ('chroot', 'user'),
+        'exec': ('exec_start', 'exec_done'),
+        'total': ('start', 'exec_done'),
+}
+
+_INDEX = {event: i for i, event in enumerate(EVENTS)}
+
+
+class LaunchTrace:
+    '''
+    Timestamps for the phases of one container launch. The timestamps are
+    CLOCK_MONOTONIC, which is the same in every process, and are kept in
+    shared memory so the child's marks can be read by the parent. buf can be
+    an existing shared mmap with SIZE bytes free at offset, such as the one
+    holding the launch semaphore, or None to make a new one.
+
+    The parent marks start, creates the child, calls cloned, and marks
+    id_maps, volumes, net and released as it goes. The child marks its
+    events, the last being exec_start just before exec. The parent then
+    calls wait_exec to mark exec_done when the exec has happened.
+    '''
+    SIZE = 8 * len(EVENTS)
+
+    def __init__(self, buf: mmap.mmap | None = None, offset: int = 0) -> None:
+        if buf is None:
+            buf = mmap.mmap(-1, self.SIZE,
+                            mmap.MAP_SHARED | mmap.MAP_ANONYMOUS)
+            offset = 0
+
+        self._buf = buf
+        self._offset = offset
+        for event in EVENTS:
+            self._set(event, math.nan)
+
+        # Both ends are close-on-exec, so once the child has exec'd and the
+        # parent has closed its write end, reads give EOF.
+        self._exec_read, self._exec_write = os.pipe()
+
+    def _set(self, event: str, value: float) -> None:
+        struct.pack_into('d', self._buf, self._offset + 8 * _INDEX[event],
+                         value)
+
+    def mark(self, event: str) -> None:
+        self._set(event, time.monotonic())
+
+    def cloned(self) -> None:
+        '''
+        Mark cloned, in the parent right after the child is created.
+        '''
+        self.mark('cloned')
+        os.close(self._exec_write)
+
+    def detach(self) -> None:
+        '''
+        In the child, stop holding exec_done back without exec'ing, once it
+        has started another process that does, as an init does.
+        '''
+        os.close(self._exec_write)
+
+    def wait_exec(self) -> None:
+        '''
+        Wait until the child has exec'd (or exited) and mark exec_done.
+        '''
+        while os.read(self._exec_read, 1):
+            pass
+        self.mark('exec_done')
+        os.close(self._exec_read)
+
+    def times(self) -> dict[str, float]:
+        '''
+        Return the marked events as seconds since start.
+        '''
+        values = struct.unpack_from(f'{len(EVENTS)}d', self._buf,
+                                    self._offset)
+        start = values[_INDEX['start']]
+        return {event: value - start
+                for event, value in zip(EVENTS, values)
+                if not math.isnan(value)}
+
+    def record(self, **extra: Any) -> dict[str, Any]:
+        '''
+        Return a JSON-able record of this launch, with event times and phase
+        durations in milliseconds. extra is added to it.
+        '''
+        times = self.times()
+        phases = {name: (times[end] - times[begin]) * 1000
+                  for name, (begin, end) in PHASES.items()
+                  if begin in times and end in times}
+        return {
+            'events': {event: t * 1000 for event, t in times.items()},
+            'phases': phases,
+            **extra,
+        }
+
+
+def append_record(path: str, record: dict[str, Any]) -> None:
+    '''
+    Append record to path as one line of JSON.
+    '''
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    '''
+    Return the p50, p95 and p99 of values, as well as the count and maximum.
+    '''
+    if len(values) > 1:
+        cuts = statistics.quantiles(values, n=100, method='inclusive')
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    else:
+        p50 = p95 = p99 = values[0]
+
+    return {'n': len(values), 'p50': p50, 'p95': p95, 'p99': p99,
+            'max': max(values)}
+
+
+def summarize(files: list[TextIO]) -> dict[str, dict[str, float]]:
+    '''
+    Read launch records from files and return percentiles for each phase.
+    A negative phase can only come from events marked out of order, so
+    those are left out, and counted as negative for the phase.
+    '''
+    values: dict[str, list[float]] = {name: [] for name in PHASES}
+    negative: dict[str, int] = {}
+    for f in files:
+        for line in f:
+            if not line.strip():
+                continue
+            for name, ms in json.loads(line)['phases'].items():
+                if ms < 0:
+                    negative[name] = negative.get(name, 0) + 1
+                else:
+                    values.setdefault(name, []).append(ms)
+
+    summary = {name: percentiles(v) for name, v in values.items() if v}
+    for name, count in negative.items():
+        summary.setdefault(name, {})['negative'] = count
+
+    return summary
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+            description='Summarize launch traces written with --trace')
+    parser.add_argument(
+            '--json',
+            action='store_true',
+            help='print the summary as JSON')
+    parser.add_argument(
+            'files',
+            nargs='*',
+            default=['-'],
+            help='trace files, or - for stdin (the default)')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    files = [sys.stdin if path == '-' else open(path)
+             for path in args.files]
+    summary = summarize(files)
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return 0
+
+    print(f'{"phase":<10} {"n":>6} {"p50 ms":>9} {"p95 ms":>9} '
+          f'{"p99 ms":>9} {"max ms":>9}')
+    for name, stats in summary.items():
+        if 'negative' in stats:
+            print(f'warning: left out {stats["negative"]} negative {name} '
+                  'times', file=sys.stderr)
+        if 'n' not in stats:
+            continue
+        print(f'{name:<10} {stats["n"]:>6} {stats["p50"]:>9.3f} '
+              f'{stats["p95"]:>9.3f} {stats["p99"]:>9.3f} '
+              f'{stats["max"]:>9.3f}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
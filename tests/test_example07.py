@@ -0,0 +1,50 @@
+import importlib.util
+import os
+import pathlib
+import sys
+from types import ModuleType
+
+import pytest
+
+from lib import slices
+from lib.container import STATE_DIR_ENV
+from lib.registry import Registry
+
+_EXAMPLE = (pathlib.Path(__file__).parent.parent / '07-sharing-files' /
+            'example07.py')
+
+
+def _load_example() -> ModuleType:
+    spec = importlib.util.spec_from_file_location('example07', _EXAMPLE)
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_failed_id_maps_leave_nothing_behind(
+        tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    example = _load_example()
+    db = str(tmp_path / 'registry.db')
+    subids = [range(100000, 100000 + 2 * slices.SLICE_SIZE)]
+
+    def fail(*args: object) -> None:
+        raise OSError('apply_id_maps failed')
+
+    monkeypatch.setenv(STATE_DIR_ENV, str(tmp_path))
+    monkeypatch.setattr(slices, 'read_subuids', lambda uid: subids)
+    monkeypatch.setattr(slices, 'read_subgids', lambda gid: subids)
+    monkeypatch.setattr(example, 'apply_id_maps', fail)
+    monkeypatch.setattr(sys, 'argv', ['example07.py', '--id-slice',
+                                      '--registry', db, '--', 'true'])
+
+    with pytest.raises(OSError, match='apply_id_maps failed'):
+        example.main()
+
+    registry = Registry(db)
+    try:
+        assert registry.entries() == []
+    finally:
+        registry.close()
+    assert slices.default_allocator().leases() == []
+    assert os.path.exists(tmp_path / 'id-slices')
@@ -0,0 +1,72 @@
+import gzip
+import io
+import os
+import pathlib
+import tarfile
+
+from lib.importer import _is_apk_metadata, import_archive
+
+
+def _tar_segment(files: dict[str, bytes], end: bool) -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w',
+                      format=tarfile.USTAR_FORMAT) as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(data))
+    data = buf.getvalue()
+    if not end:
+        # abuild cuts the end of archive blocks off all but the last piece.
+        data = data.rstrip(b'\0')
+        data += b'\0' * (-len(data) % tarfile.BLOCKSIZE)
+    return data
+
+
+def _apk() -> bytes:
+    # Signature, control and data, each gzipped on its own and concatenated
+    # the way abuild writes them.
+    return (gzip.compress(_tar_segment({'.SIGN.RSA.test.rsa.pub': b'sig'},
+                                       False)) +
+            gzip.compress(_tar_segment({'.PKGINFO': b'pkgname = test\n'},
+                                       False)) +
+            gzip.compress(_tar_segment({'usr/bin/hello': b'hello\n',
+                                        'etc/hello.conf': b'conf\n'}, True)))
+
+
+def test_import_apk(tmp_path: pathlib.Path) -> None:
+    path = os.path.join(tmp_path, 'test.apk')
+    with open(path, 'wb') as f:
+        f.write(_apk())
+
+    dest = os.path.join(tmp_path, 'root')
+    uid = os.geteuid()
+    gid = os.getegid()
+    with open(path, 'rb') as f:
+        stats = import_archive(f, dest, lambda _: uid, lambda _: gid,
+                               skip=_is_apk_metadata)
+
+    assert stats.files == 2
+    assert stats.skipped == 2
+    with open(os.path.join(dest, 'usr/bin/hello'), 'rb') as f:
+        assert f.read() == b'hello\n'
+    with open(os.path.join(dest, 'etc/hello.conf'), 'rb') as f:
+        assert f.read() == b'conf\n'
+    assert not os.path.exists(os.path.join(dest, '.PKGINFO'))
+
+
+def test_import_plain_tar(tmp_path: pathlib.Path) -> None:
+    path = os.path.join(tmp_path, 'test.tar')
+    with open(path, 'wb') as f:
+        f.write(_tar_segment({'hello': b'hello\n'}, True))
+
+    dest = os.path.join(tmp_path, 'root')
+    uid = os.geteuid()
+    gid = os.getegid()
+    with open(path, 'rb') as f:
+        stats = import_archive(f, dest, lambda _: uid, lambda _: gid)
+
+    assert stats.files == 1
+    with open(os.path.join(dest, 'hello'), 'rb') as f:
+        assert f.read() == b'hello\n'
@@ -1,20 +1,33 @@
 #define _GNU_SOURCE
+#include <fcntl.h>
+#include <linux/fs.h>
+#include <linux/loop.h>
+#include <linux/sched.h>
+#include <net/if.h>
 #include <sched.h>
 #include <semaphore.h>
+#include <signal.h>
+#include <stddef.h>
 #include <stdio.h>
+#include <sys/capability.h>
+#include <sys/ioctl.h>
+#include <sys/mman.h>
 #include <sys/mount.h>
+#include <sys/prctl.h>
+#include <sys/syscall.h>
 
 #define WRITE_CLONE_FLAG(f) do { printf(#f " = %#010x\n", f); } while (0)
+#define WRITE_CLONE3_FLAG(f) do { printf(#f " = %#012llx\n", (unsigned long long)f); } while (0)
+#define WRITE_INT_CONST(c) do { printf(#c " = %d\n", c); } while (0)
 #define WRITE_MOUNT_FLAG(f) do { printf(#f " = %#010lx\n", (unsigned long)f); } while (0)
+#define WRITE_UINT_FLAG(f) do { printf(#f " = %#010x\n", (unsigned)f); } while (0)
 
 void write_clone_flags(void) {
     WRITE_CLONE_FLAG(CLONE_CHILD_CLEARTID);
     WRITE_CLONE_FLAG(CLONE_CHILD_SETTID);
-    //WRITE_CLONE_FLAG(CLONE_CLEAR_SIGHAND);
     WRITE_CLONE_FLAG(CLONE_DETACHED);
     WRITE_CLONE_FLAG(CLONE_FILES);
     WRITE_CLONE_FLAG(CLONE_FS);
-    //WRITE_CLONE_FLAG(CLONE_INTO_CGROUP);
     WRITE_CLONE_FLAG(CLONE_IO);
     WRITE_CLONE_FLAG(CLONE_NEWCGROUP);
     WRITE_CLONE_FLAG(CLONE_NEWIPC);
@@ -38,6 +51,12 @@ void write_clone_flags(void) {
     WRITE_CLONE_FLAG(CLONE_VM);
 }
 
+// Flags that only fit in the 64-bit flags of clone3.
+void write_clone3_flags(void) {
+    WRITE_CLONE3_FLAG(CLONE_CLEAR_SIGHAND);
+    WRITE_CLONE3_FLAG(CLONE_INTO_CGROUP);
+}
+
 void write_mount_flags(void) {
     WRITE_MOUNT_FLAG(MS_REMOUNT);
     WRITE_MOUNT_FLAG(MS_BIND);
@@ -61,15 +80,107 @@ void write_mount_flags(void) {
     WRITE_MOUNT_FLAG(MS_STRICTATIME);
     WRITE_MOUNT_FLAG(MS_SYNCHRONOUS);
     WRITE_MOUNT_FLAG(MS_NOSYMFOLLOW);
+    WRITE_UINT_FLAG(MNT_DETACH);
+}
+
+void write_mount_api_vals(void) {
+    WRITE_INT_CONST(AT_FDCWD);
+    WRITE_UINT_FLAG(AT_EMPTY_PATH);
+    WRITE_UINT_FLAG(AT_RECURSIVE);
+    WRITE_UINT_FLAG(OPEN_TREE_CLONE);
+    WRITE_UINT_FLAG(OPEN_TREE_CLOEXEC);
+    WRITE_UINT_FLAG(MOVE_MOUNT_F_EMPTY_PATH);
+    WRITE_UINT_FLAG(MOUNT_ATTR_RDONLY);
+    WRITE_UINT_FLAG(MOUNT_ATTR_NOSUID);
+    WRITE_UINT_FLAG(MOUNT_ATTR_NODEV);
+    WRITE_UINT_FLAG(MOUNT_ATTR_NOEXEC);
+    WRITE_UINT_FLAG(MOUNT_ATTR__ATIME);
+    WRITE_UINT_FLAG(MOUNT_ATTR_RELATIME);
+    WRITE_UINT_FLAG(MOUNT_ATTR_NOATIME);
+    WRITE_UINT_FLAG(MOUNT_ATTR_STRICTATIME);
+    WRITE_UINT_FLAG(MOUNT_ATTR_NODIRATIME);
+    WRITE_UINT_FLAG(MOUNT_ATTR_IDMAP);
+    WRITE_UINT_FLAG(MOUNT_ATTR_NOSYMFOLLOW);
+}
+
+void write_mmap_flags(void) {
+    WRITE_UINT_FLAG(MAP_STACK);
+    WRITE_INT_CONST(PROT_NONE);
+}
+
+void write_ioctls(void) {
+    WRITE_UINT_FLAG(FICLONE);
+    WRITE_UINT_FLAG(SIOCGIFFLAGS);
+    WRITE_UINT_FLAG(SIOCSIFFLAGS);
+    WRITE_UINT_FLAG(LOOP_CTL_GET_FREE);
+    WRITE_UINT_FLAG(LOOP_CONFIGURE);
+}
+
+void write_net_vals(void) {
+    WRITE_UINT_FLAG(IFF_UP);
+    WRITE_INT_CONST(IFNAMSIZ);
+}
+
+void write_loop_vals(void) {
+    WRITE_UINT_FLAG(LO_FLAGS_READ_ONLY);
+    WRITE_UINT_FLAG(LO_FLAGS_AUTOCLEAR);
+}
+
+void write_syscalls(void) {
+    WRITE_INT_CONST(SYS_clone3);
+    WRITE_INT_CONST(SYS_open_tree);
+    WRITE_INT_CONST(SYS_move_mount);
+    WRITE_INT_CONST(SYS_mount_setattr);
+}
+
+void write_signal_vals(void) {
+    WRITE_INT_CONST(SI_KERNEL);
+}
+
+void write_capabilities(void) {
+    WRITE_INT_CONST(CAP_EFFECTIVE);
+    WRITE_INT_CONST(CAP_PERMITTED);
+    WRITE_INT_CONST(CAP_INHERITABLE);
+    WRITE_INT_CONST(CAP_SETGID);
+    WRITE_INT_CONST(CAP_SETUID);
+    WRITE_INT_CONST(CAP_SYS_ADMIN);
+}
+
+void write_prctl_options(void) {
+    WRITE_INT_CONST(PR_SET_PDEATHSIG);
 }
 
 int main(void) {
     printf("# This file is generated, do not edit by hand.\n\n");
     write_clone_flags();
     printf("\n");
+    write_clone3_flags();
+    printf("\n");
+    write_syscalls();
+    printf("\n");
     write_mount_flags();
     printf("\n");
+    write_mount_api_vals();
+    printf("\n");
+    write_prctl_options();
+    printf("\n");
+    write_capabilities();
+    printf("\n");
+    write_mmap_flags();
+    printf("\n");
+    write_ioctls();
+    printf("\n");
+    write_net_vals();
+    printf("\n");
+    write_loop_vals();
+    printf("\n");
+    write_signal_vals();
+    printf("\n");
     printf("SIZEOF_SEM_T = %zd\n", sizeof(sem_t));
+    printf("SIZEOF_IFREQ = %zd\n", sizeof(struct ifreq));
+    printf("SIZEOF_LOOP_CONFIG = %zd\n", sizeof(struct loop_config));
+    printf("LOOP_CONFIG_FLAGS_OFFSET = %zd\n",
+           offsetof(struct loop_config, info.lo_flags));
 
     return 0;
 }